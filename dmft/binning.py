@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+r"""
+Binning analysis of Monte Carlo time series
+===========================================
+
+Streaming estimators of the statistical error and the integrated
+autocorrelation time of Monte Carlo measurements. Samples are reduced into
+a logarithmic hierarchy of bins as they arrive so that nothing besides
+:math:`O(\log N)` partial sums and a bounded set of coarse bins is kept
+in memory.
+"""
+
+from __future__ import division, absolute_import, print_function
+import numpy as np
+
+
+class LogBinning(object):
+    r"""Logarithmic binning of a stream of measurements
+
+    At level :math:`l` the time series is averaged into bins of
+    :math:`2^l` consecutive samples, and the sums of the bin means and of
+    their squares are kept. Once the bins are longer than the
+    autocorrelation time the error estimate stops growing with the level,
+    then
+
+    .. math:: \sigma^2_l = \sigma^2_0 (1 + 2\tau_{int})
+
+    Besides it keeps at most 2 max_bins coarse bins of equal size for
+    jackknife analysis, merging them pairwise whenever they fill up.
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of each measurement
+    dtype : data-type
+        of the measurements, for complex ones the error is that of the
+        modulus of the deviation from the mean
+    max_bins : int
+        half the maximum number of coarse bins kept
+    """
+
+    def __init__(self, shape=(), dtype=float, max_bins=64):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.max_bins = max_bins
+        self.count = []
+        self.sum = []
+        self.sumsq = []
+        self.carry = []
+        self.bin_size = 1
+        self.bins = []
+        self.block = np.zeros(self.shape, self.dtype)
+        self.block_count = 0
+
+    def add(self, sample):
+        """Adds one measurement into the binning hierarchy"""
+        sample = np.array(sample, dtype=self.dtype).reshape(self.shape)
+
+        self.block += sample
+        self.block_count += 1
+        if self.block_count == self.bin_size:
+            self.bins.append(self.block / self.bin_size)
+            self.block = np.zeros(self.shape, self.dtype)
+            self.block_count = 0
+            if len(self.bins) == 2 * self.max_bins:
+                self.bins = [(a + b) / 2
+                             for a, b in zip(self.bins[::2], self.bins[1::2])]
+                self.bin_size *= 2
+
+        level = 0
+        while True:
+            if level == len(self.count):
+                self.count.append(0)
+                self.sum.append(np.zeros(self.shape, self.dtype))
+                self.sumsq.append(np.zeros(self.shape))
+                self.carry.append(None)
+            self.count[level] += 1
+            self.sum[level] += sample
+            self.sumsq[level] += np.abs(sample)**2
+            if self.carry[level] is None:
+                self.carry[level] = sample
+                break
+            sample = (self.carry[level] + sample) / 2
+            self.carry[level] = None
+            level += 1
+
+    def mean(self):
+        """Average of all measurements"""
+        return self.sum[0] / self.count[0]
+
+    def level_errors(self):
+        """Standard error of the mean estimated at each binning level
+        holding at least two bins"""
+        errors = []
+        for count, bsum, bsumsq in zip(self.count, self.sum, self.sumsq):
+            if count < 2:
+                break
+            var = (bsumsq / count - np.abs(bsum / count)**2).clip(0)
+            errors.append(np.sqrt(var / (count - 1)))
+        return np.array(errors)
+
+    def analysis_level(self, min_bins=32):
+        """Highest binning level with at least min_bins bins"""
+        levels = [l for l, count in enumerate(self.count) if count >= min_bins]
+        return levels[-1] if levels else 0
+
+    def error(self, min_bins=32):
+        """Standard error of the mean at the highest reliable level"""
+        errors = self.level_errors()
+        if not len(errors):
+            return np.zeros(self.shape)
+        return errors[min(self.analysis_level(min_bins), len(errors) - 1)]
+
+    def tau_int(self, min_bins=32):
+        """Integrated autocorrelation time in units of measurements"""
+        errors = self.level_errors()
+        if not len(errors):
+            return np.zeros(self.shape)
+        naive = errors[0]
+        binned = errors[min(self.analysis_level(min_bins), len(errors) - 1)]
+        ratio = np.divide(binned**2, naive**2, out=np.ones_like(naive),
+                          where=naive > 0)
+        return (ratio - 1) / 2
+
+
+def jackknife(bins, func=None):
+    r"""Jackknife estimate and error of a function of the mean
+
+    Parameters
+    ----------
+    bins : ndarray
+        bin averages along the first axis, bins need to be longer than the
+        autocorrelation time
+    func : callable
+        function of the mean, defaults to the identity
+
+    Returns
+    -------
+    tuple of ndarrays : bias corrected estimate and its standard error
+    """
+    if func is None:
+        func = lambda x: x
+    bins = np.asarray(bins)
+    nbins = len(bins)
+    total = bins.sum(0)
+    f_loo = np.array([func((total - b) / (nbins - 1)) for b in bins])
+    f_bar = f_loo.mean(0)
+    estimate = nbins * func(total / nbins) - (nbins - 1) * f_bar
+    error = np.sqrt((nbins - 1) / nbins * (np.abs(f_loo - f_bar)**2).sum(0))
+    return estimate, error
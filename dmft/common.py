@@ -11,7 +11,10 @@ from __future__ import absolute_import, division, print_function
 
 import numpy as np
 from numpy.fft import fft, ifft
+from numpy.polynomial.legendre import leggauss
+from scipy.interpolate import CubicSpline
 from scipy.linalg import lstsq
+from scipy.special import eval_legendre, spherical_jn
 
 
 def matsubara_freq(beta=16., size=256, fer=1):
@@ -137,13 +140,9 @@ def gt_fouriertrans(g_tau, tau, w_n, tail_coef=(1., 0., 0.)):
     See also
     --------
     freq_tail_fourier
-    gt_fouriertrans"""
+    FourierPlan"""
 
-    beta = tau[1] + tau[-1]
-    freq_tail, time_tail = freq_tail_fourier(tail_coef, beta, tau, w_n)
-
-    gtau = g_tau - time_tail
-    return beta * ifft(gtau * np.exp(1j * np.pi * tau / beta))[..., :len(w_n)] + freq_tail
+    return fourier_plan(tau, w_n).forward(g_tau, tail_coef)
 
 
 def fermi_dist(energy, beta):
@@ -228,16 +227,224 @@ def gw_invfouriertrans(g_iwn, tau, w_n, tail_coef=(1., 0., 0.)):
     --------
     gt_fouriertrans
     freq_tail_fourier
+    FourierPlan
+    """
+
+    return fourier_plan(tau, w_n).inverse(g_iwn, tail_coef)
+
+
+class FourierPlan(object):
+    r"""Fourier transforms between a fixed imaginary time grid and the
+    positive fermionic Matsubara frequencies
+
+    The phase factors :math:`e^{\pm i\pi\tau/\beta}` and the three tail
+    functions of :func:`freq_tail_fourier` on both grids are computed once,
+    so that repeated transforms on the same grids, as in the iterations of
+    the self-consistency loops, do just the FFT and a few vector
+    operations. :func:`gt_fouriertrans` and :func:`gw_invfouriertrans`
+    run on the plans of :func:`fourier_plan`.
+
+    A plan holds no work buffers, as the cached plans are shared by all
+    callers, threads included. The transforms allocate their intermediate
+    arrays on every call.
+
+    Parameters
+    ----------
+    tau : real float array
+            Imaginary time points, equally spaced on :math:`[0, \beta)`
+    w_n : real float array
+            fermionic matsubara frequencies. Only use the positive ones
+    """
+
+    def __init__(self, tau, w_n):
+        self.tau = np.array(tau, dtype=float)
+        self.w_n = np.array(w_n, dtype=float)
+        self.beta = self.tau[1] + self.tau[-1]
+        self.phase = np.exp(1j * np.pi * self.tau / self.beta)
+        self.phase_conj = self.phase.conj()
+        iw_n = 1.j * self.w_n
+        self.freq_basis = np.array([1 / iw_n, 1 / iw_n**2, 1 / iw_n**3])
+        self.time_basis = np.array(
+            [np.full_like(self.tau, -1 / 2), (self.tau - self.beta / 2) / 2,
+             -(self.tau**2 - self.beta * self.tau) / 4])
+        for arr in (self.tau, self.w_n, self.phase, self.phase_conj,
+                    self.freq_basis, self.time_basis):
+            arr.flags.writeable = False
+
+    def tails(self, tail_coef):
+        """Tails of tail_coef on the Matsubara and imaginary time grids, as
+        :func:`freq_tail_fourier` returns them"""
+        freq_tail = tail_coef[0] * self.freq_basis[0] + \
+            tail_coef[1] * self.freq_basis[1] + \
+            tail_coef[2] * self.freq_basis[2]
+        time_tail = tail_coef[0] * self.time_basis[0] + \
+            tail_coef[1] * self.time_basis[1] + \
+            tail_coef[2] * self.time_basis[2]
+        return freq_tail, time_tail
+
+    def forward(self, g_tau, tail_coef=(1., 0., 0.), out=None):
+        """Transform of :func:`gt_fouriertrans` of g_tau, written into the
+        complex array out when given. out only saves the copy of the
+        result, the tails and the FFT still take temporaries"""
+        freq_tail, time_tail = self.tails(tail_coef)
+        work = np.subtract(g_tau, time_tail, dtype=complex)
+        work *= self.phase
+        work = ifft(work)[..., :len(self.w_n)]
+        if out is None:
+            out = np.empty(work.shape, complex)
+        np.multiply(work, self.beta, out=out)
+        out += freq_tail
+        return out
+
+    def inverse(self, g_iwn, tail_coef=(1., 0., 0.), out=None):
+        """Transform of :func:`gw_invfouriertrans` of g_iwn, written into
+        the real array out when given. out only saves the copy of the
+        result, the tails and the FFT still take temporaries"""
+        freq_tail, time_tail = self.tails(tail_coef)
+        work = fft(g_iwn - freq_tail, len(self.tau))
+        work *= self.phase_conj
+        if out is None:
+            out = np.empty(work.shape)
+        np.multiply(work.real, 2 / self.beta, out=out)
+        out += time_tail
+        return out
+
+
+_FOURIER_PLANS = {}
+
+
+def fourier_plan(tau, w_n):
+    r"""The :class:`FourierPlan` of the grids tau and w_n, reused from a
+    previous call on the same grids, which are told apart by :math:`\beta`,
+    their sizes and end points"""
+    key = (tau[1] + tau[-1], len(tau), tau[0], len(w_n), w_n[0], w_n[-1])
+    plan = _FOURIER_PLANS.get(key)
+    if plan is None:
+        if len(_FOURIER_PLANS) >= 32:
+            _FOURIER_PLANS.clear()
+        plan = _FOURIER_PLANS[key] = FourierPlan(tau, w_n)
+    return plan
+
+
+def gt_spline(g_tau, tau, g_beta=None):
+    r"""Cubic spline of the imaginary time Green function on the closed
+    interval :math:`[0;\beta]`, to evaluate it on other time grids
+
+    Parameters
+    ----------
+    g_tau : real float array
+            Imaginary time Green function, time on the last axis
+    tau : real float array
+            Imaginary time points, evenly spaced in :math:`[0;\beta)`
+    g_beta : real float array
+            :math:`G(\beta^-)` to close the interval, defaults to
+            :math:`-1 - G(0^+)` the value of a diagonal Green function
+
+    Returns
+    -------
+    scipy.interpolate.CubicSpline
+    """
+
+    beta = tau[1] + tau[-1]
+    if g_beta is None:
+        g_beta = -1. - g_tau[..., 0]
+    g_closed = np.concatenate((g_tau, np.asarray(g_beta)[..., None] +
+                               np.zeros_like(g_tau[..., :1])), -1)
+    return CubicSpline(np.append(tau, beta), g_closed, axis=-1)
+
+
+def gt_legendretrans(g_tau, tau, n_coef, g_beta=None):
+    r"""Expands the imaginary time Green function in Legendre polynomials
+    [boehnke]_
+
+    .. math:: G_l = \sqrt{2l+1} \int_0^\beta P_l(x(\tau)) G(\tau) d\tau
+        \qquad x(\tau) = \frac{2\tau}{\beta} - 1
+
+    :math:`G(\tau)` is interpolated by a cubic spline through the time
+    points and the integral done by Gauss-Legendre quadrature.
+
+    Parameters
+    ----------
+    g_tau : real float array
+            Imaginary time Green function, time on the last axis
+    tau : real float array
+            Imaginary time points, evenly spaced in :math:`[0;\beta)`
+    n_coef : int
+            Number of Legendre coefficients
+    g_beta : real float array
+            :math:`G(\beta^-)` to close the interval, defaults to
+            :math:`-1 - G(0^+)` the value of a diagonal Green function
+
+    Returns
+    -------
+    real ndarray
+            Legendre coefficients on the last axis
+
+    References
+    ----------
+    .. [boehnke] L. Boehnke et al., Phys. Rev. B 84, 075145 (2011)
     """
 
     beta = tau[1] + tau[-1]
-    freq_tail, time_tail = freq_tail_fourier(tail_coef, beta, tau, w_n)
+    spline = gt_spline(g_tau, tau, g_beta)
+
+    x, weights = leggauss(2 * (n_coef + len(tau)))
+    l = np.arange(n_coef)
+    projector = np.sqrt(2 * l + 1)[:, None] * eval_legendre(l[:, None], x) * \
+        weights * beta / 2
+    return np.dot(spline(beta * (x + 1) / 2), projector.T)
+
+
+def gl_invlegendretrans(g_l, tau, beta):
+    r"""Imaginary time Green function from its Legendre coefficients
 
-    giwn = g_iwn - freq_tail
+    .. math:: G(\tau) = \sum_l \frac{\sqrt{2l+1}}{\beta}
+        P_l(x(\tau)) G_l
+
+    See also
+    --------
+    gt_legendretrans
+    """
+    l = np.arange(g_l.shape[-1])
+    basis = np.sqrt(2 * l + 1)[:, None] / beta * \
+        eval_legendre(l[:, None], 2 * np.asarray(tau) / beta - 1)
+    return np.dot(g_l, basis)
 
-    g_tau = fft(giwn, len(tau)) * np.exp(-1j * np.pi * tau / beta)
 
-    return (g_tau * 2 / beta).real + time_tail
+def gl_fouriertrans(g_l, w_n, beta):
+    r"""Matsubara frequency Green function from its Legendre coefficients
+
+    .. math:: G(i\omega_n) = \sum_l T_{nl} G_l \qquad
+        T_{nl} = (-1)^n i^{l+1} \sqrt{2l+1}
+        j_l\left(\frac{\omega_n\beta}{2}\right)
+
+    with :math:`j_l` the spherical Bessel functions. As the transformation
+    is analytic the high frequencies carry no noise beyond that of the
+    coefficients.
+
+    Parameters
+    ----------
+    g_l : real float array
+            Legendre coefficients on the last axis
+    w_n : real float array
+            fermionic matsubara frequencies. Only use the positive ones
+    beta : float
+            Inverse temperature
+
+    Returns
+    -------
+    complex ndarray
+            Green function in matsubara frequencies
+
+    See also
+    --------
+    gt_legendretrans
+    """
+    l = np.arange(g_l.shape[-1])
+    n = np.rint((np.asarray(w_n) * beta / np.pi - 1) / 2)
+    transform = (-1)**n[:, None] * 1j**(l + 1) * np.sqrt(2 * l + 1) * \
+        spherical_jn(l, np.asarray(w_n)[:, None] * beta / 2)
+    return np.dot(g_l, transform.T)
 
 
 def tail(w_n, coef, powers):
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+r"""
+Discrete Lehmann representation
+===============================
+
+Compact representation of fermionic imaginary time Green functions [DLR]_.
+Every Green function whose spectrum lies within :math:`[-\omega_{max},
+\omega_{max}]` is, up to a tolerance :math:`\epsilon`, a sum of poles at a
+fixed set of real frequencies :math:`\omega_k`
+
+.. math:: G(\tau) = \sum_k g_k K(\tau, \omega_k) \qquad
+    G(i\omega_n) = \sum_k \frac{g_k}{i\omega_n - \omega_k}
+
+with :math:`K(\tau, \omega) = -e^{-\tau\omega}/(1 + e^{-\beta\omega})`.
+Their number grows as :math:`\log(\Lambda)\log(1/\epsilon)` with
+:math:`\Lambda = \beta\omega_{max}`, a few tens even at very low
+temperature. The coefficients :math:`g_k` follow from the values at as
+many imaginary times :math:`\tau_k` or Matsubara frequencies
+:math:`\omega_{n_k}`, so that solvers can work on those sparse nodes
+instead of the grids of :func:`dmft.common.tau_wn_setup`.
+
+As in :mod:`dmft.common` the Green functions are real in imaginary time
+and only the positive Matsubara frequencies are used.
+
+References
+----------
+.. [DLR] J. Kaye, K. Chen and O. Parcollet, Phys. Rev. B 105, 235115 (2022)
+"""
+
+from __future__ import division, absolute_import, print_function
+import numpy as np
+from numpy.polynomial.legendre import leggauss
+import scipy.linalg as la
+
+
+def kernel_tau(tau, omega, beta):
+    r"""Imaginary time kernel of the poles at omega,
+    :math:`K(\tau, \omega) = -e^{-\tau\omega}/(1 + e^{-\beta\omega})`,
+    evaluated without overflow, with shape (tau, omega)"""
+    tau = np.asarray(tau, float)[:, None]
+    omega = np.asarray(omega, float)[None, :]
+    positive = omega >= 0
+    exponent = np.where(positive, -tau * omega, (beta - tau) * omega)
+    denominator = 1. + np.exp(-beta * np.abs(omega))
+    return -np.exp(exponent) / denominator
+
+
+def kernel_iw(w_n, omega):
+    r"""Matsubara kernel of the poles at omega,
+    :math:`1/(i\omega_n - \omega)`, with shape (w_n, omega)"""
+    return 1. / (1j * np.asarray(w_n, float)[:, None] -
+                 np.asarray(omega, float)[None, :])
+
+
+def dyadic_panels(lower, upper, levels, points):
+    """Gauss-Legendre points on panels between lower and upper whose
+    lengths halve towards lower, levels of them"""
+    edges = lower + (upper - lower) * np.concatenate(
+        ([0.], 2.**np.arange(-levels + 1, 1)))
+    x, _ = leggauss(points)
+    return np.concatenate([(a + b) / 2 + (b - a) / 2 * x
+                           for a, b in zip(edges[:-1], edges[1:])])
+
+
+def pivoted_rows(matrix, rank=None, eps=None):
+    """Indices of the most linearly independent rows of the real or
+    complex matrix by a pivoted QR decomposition, rank of them or those
+    above the relative tolerance eps"""
+    _, r_mat, piv = la.qr(matrix.T, mode='economic', pivoting=True)
+    if rank is None:
+        diag = np.abs(np.diag(r_mat))
+        rank = int(np.sum(diag > eps * diag[0]))
+    return piv[:rank]
+
+
+class DLR(object):
+    r"""Discrete Lehmann representation basis and its sampling nodes
+
+    The real frequencies of the basis are picked among a composite
+    Gauss-Legendre grid of :math:`[-\omega_{max}, \omega_{max}]` refined
+    dyadically towards zero, by a pivoted QR decomposition of the imaginary
+    time kernel. The imaginary time nodes are picked in the same way among
+    the grid of :math:`[0, \beta]` refined towards both ends, and the
+    Matsubara nodes among the positive frequencies up to about
+    :math:`\Lambda` times the lowest one.
+
+    Parameters
+    ----------
+    beta : float
+        Inverse temperature
+    omega_max : float
+        Spectral width, all the spectral weight lies within
+        :math:`[-\omega_{max}, \omega_{max}]`
+    eps : float
+        Relative accuracy of the representation
+    points : int
+        Gauss-Legendre points on each panel of the fine grids
+
+    Attributes
+    ----------
+    omega : real 1D ndarray
+        real frequencies of the poles
+    tau : real 1D ndarray
+        imaginary time nodes
+    n : int 1D ndarray
+        indices of the Matsubara nodes
+    w_n : real 1D ndarray
+        Matsubara frequency nodes :math:`\pi(2n+1)/\beta`
+    """
+
+    def __init__(self, beta, omega_max, eps=1e-12, points=24):
+        self.beta = beta
+        self.omega_max = omega_max
+        self.lamb = beta * omega_max
+        self.eps = eps
+        levels = max(int(np.ceil(np.log2(self.lamb))), 1)
+
+        omega_fine = dyadic_panels(0., omega_max, levels, points)
+        omega_fine = np.concatenate((-omega_fine[::-1], omega_fine))
+        tau_fine = dyadic_panels(0., beta / 2, levels + 1, points)
+        tau_fine = np.concatenate((tau_fine, beta - tau_fine[::-1]))
+
+        columns = pivoted_rows(kernel_tau(tau_fine, omega_fine, beta).T,
+                               eps=eps)
+        self.omega = np.sort(omega_fine[columns])
+        self.rank = len(self.omega)
+
+        k_tau = kernel_tau(tau_fine, self.omega, beta)
+        self.tau = np.sort(tau_fine[pivoted_rows(k_tau, self.rank)])
+
+        n_max = max(int(self.lamb), 256)
+        candidates = np.unique(np.concatenate(
+            (np.arange(128), np.geomspace(128, n_max, 512).astype(int))))
+        k_iw = kernel_iw(np.pi * (2 * candidates + 1) / beta, self.omega)
+        self.n = np.sort(candidates[pivoted_rows(k_iw, self.rank)])
+        self.w_n = np.pi * (2 * self.n + 1) / beta
+
+        self._tau_lu = la.lu_factor(kernel_tau(self.tau, self.omega, beta))
+        k_iw = kernel_iw(self.w_n, self.omega)
+        self._iw_qr = la.qr(np.concatenate((k_iw.real, k_iw.imag)),
+                            mode='economic')
+
+    def fit_tau(self, g_tau, tau=None):
+        """Coefficients of the poles of g_tau, given along its last axis
+        at the imaginary time nodes or else at the times tau"""
+        g_tau = np.asarray(g_tau, float)
+        values = g_tau.reshape(-1, g_tau.shape[-1]).T
+        if tau is None:
+            coef = la.lu_solve(self._tau_lu, values)
+        else:
+            coef = la.lstsq(kernel_tau(tau, self.omega, self.beta),
+                            values)[0]
+        return coef.T.reshape(g_tau.shape[:-1] + (self.rank, ))
+
+    def fit_iw(self, g_iw, w_n=None):
+        """Coefficients of the poles of g_iw, given along its last axis at
+        the Matsubara nodes or else at the positive frequencies w_n"""
+        g_iw = np.asarray(g_iw, complex)
+        values = g_iw.reshape(-1, g_iw.shape[-1]).T
+        values = np.concatenate((values.real, values.imag))
+        if w_n is None:
+            q_mat, r_mat = self._iw_qr
+            coef = la.solve_triangular(r_mat, np.dot(q_mat.T, values))
+        else:
+            k_iw = kernel_iw(w_n, self.omega)
+            coef = la.lstsq(np.concatenate((k_iw.real, k_iw.imag)),
+                            values)[0]
+        return coef.T.reshape(g_iw.shape[:-1] + (self.rank, ))
+
+    def eval_tau(self, coef, tau=None):
+        """Green function of the pole coefficients coef at the imaginary
+        times tau, by default at the nodes"""
+        tau = self.tau if tau is None else tau
+        return np.dot(coef, kernel_tau(tau, self.omega, self.beta).T)
+
+    def eval_iw(self, coef, w_n=None):
+        """Green function of the pole coefficients coef at the Matsubara
+        frequencies w_n, by default at the nodes"""
+        w_n = self.w_n if w_n is None else w_n
+        return np.dot(coef, kernel_iw(w_n, self.omega).T)
+
+    def tau_to_iw(self, g_tau, w_n=None):
+        """Matsubara values of g_tau given at the imaginary time nodes"""
+        return self.eval_iw(self.fit_tau(g_tau), w_n)
+
+    def iw_to_tau(self, g_iw, tau=None):
+        """Imaginary time values of g_iw given at the Matsubara nodes"""
+        return self.eval_tau(self.fit_iw(g_iw), tau)
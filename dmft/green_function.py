@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+r"""
+Green function container
+========================
+
+Holds a Green function on the imaginary time grid and the positive
+fermionic Matsubara frequencies of :mod:`dmft.common` together with its
+high frequency tail and block structure. Only the representation it was
+given is stored, the other one is transformed when first asked for and
+kept until the data change. Declared symmetries reduce the storage to the
+independent components.
+"""
+
+from __future__ import division, absolute_import, print_function
+import numpy as np
+from dmft.common import fourier_plan
+
+SYMMETRIES = ('paramagnetic', 'particle_hole')
+
+
+class GreenFunction(object):
+    r"""Green function with lazy imaginary time and Matsubara
+    representations
+
+    The data have the shape (blocks, ) + shape + (points, ) or
+    shape + (points, ) without blocks. The tail moments enter the Fourier
+    transforms of :class:`dmft.common.FourierPlan`.
+
+    With the 'paramagnetic' symmetry all blocks, the spin species, are the
+    same and a single one is stored. Data given for all of them are
+    averaged. With 'particle_hole' :math:`G(i\omega_n)` is stored as a real
+    array, its imaginary part on the diagonal and its real part off the
+    diagonal of the site matrices. That is the particle-hole symmetric
+    Green function of a bipartite cluster whose off diagonal entries join
+    both sublattices, like the dimer with giw_d.imag and giw_o.real. The
+    discarded parts are dropped from the data given.
+
+    The arrays returned by giw and gtau are read only. To change the data
+    assign a new array, which drops the other representation, as does
+    setting new tail moments when that representation was transformed.
+
+    Parameters
+    ----------
+    tau : real float array
+        Imaginary time points, equally spaced on :math:`[0, \beta)`
+    w_n : real float array
+        fermionic matsubara frequencies. Only use the positive ones
+    shape : tuple
+        shape of each block, () for a single orbital or (sites, sites) for
+        the matrix of a cluster
+    blocks : sequence of strings or None
+        names of the blocks
+    tail : array like
+        first three moments of the high frequency tail, as the tail_coef
+        of :func:`dmft.common.gt_fouriertrans`, either numbers or arrays of
+        the block shape
+    symmetry : string or sequence of strings
+        any of SYMMETRIES
+    giw, gtau : complex or real ndarray
+        initial data in Matsubara frequencies or imaginary time
+    """
+
+    def __init__(self, tau, w_n, shape=(), blocks=None, tail=(1., 0., 0.),
+                 symmetry=(), giw=None, gtau=None):
+        self.plan = fourier_plan(tau, w_n)
+        self.tau, self.w_n, self.beta = (self.plan.tau, self.plan.w_n,
+                                         self.plan.beta)
+        self.shape = tuple(shape)
+        self.blocks = None if blocks is None else tuple(blocks)
+        if isinstance(symmetry, str):
+            symmetry = (symmetry, )
+        self.symmetry = frozenset(symmetry)
+        unknown = self.symmetry.difference(SYMMETRIES)
+        if unknown:
+            raise ValueError('Unknown symmetries {}'.format(sorted(unknown)))
+        if 'paramagnetic' in self.symmetry and not self.blocks:
+            raise ValueError('The paramagnetic symmetry needs spin blocks')
+
+        if len(self.shape) == 2 and self.shape[0] == self.shape[1]:
+            self._diagonal = np.eye(self.shape[0], dtype=bool)[..., None]
+        else:
+            self._diagonal = np.ones(self.shape + (1, ), bool)
+        self._iw = self._tau = self._derived = None
+        self._tail = None
+        self.tail = tail
+        if giw is not None:
+            self.giw = giw
+        elif gtau is not None:
+            self.gtau = gtau
+
+    @property
+    def full_shape(self):
+        """Shape of the data without the grid axis"""
+        if self.blocks is None:
+            return self.shape
+        return (len(self.blocks), ) + self.shape
+
+    @property
+    def stored_shape(self):
+        """Shape of the stored data without the grid axis"""
+        if 'paramagnetic' in self.symmetry:
+            return (1, ) + self.shape
+        return self.full_shape
+
+    @property
+    def tail(self):
+        """Moments of the high frequency tail, with shape (3, ) + shape"""
+        return self._tail
+
+    @tail.setter
+    def tail(self, tail):
+        tail = np.array(np.broadcast_to(np.asarray(tail, float).T,
+                                        self.shape[::-1] + (3, )).T)
+        tail.flags.writeable = False
+        if self._tail is not None and np.array_equal(tail, self._tail):
+            return
+        self._tail = tail
+        if self._derived == 'iw':
+            self._iw = None
+        elif self._derived == 'tau':
+            self._tau = None
+        self._derived = None
+
+    def _tail_coef(self):
+        """Tail moments broadcasting against the data"""
+        return [coef[..., None] for coef in self._tail]
+
+    def _reduce_blocks(self, data, points):
+        """Data in the stored shape, averaging the blocks when they are
+        the same"""
+        data = np.broadcast_to(data, self.full_shape + (points, ))
+        if 'paramagnetic' in self.symmetry:
+            return data.mean(0, keepdims=True)
+        return np.array(data)
+
+    def _reduce_iw(self, giw):
+        """Independent components of the Matsubara data"""
+        if 'particle_hole' in self.symmetry:
+            return np.where(self._diagonal, giw.imag, giw.real)
+        return np.asarray(giw, complex)
+
+    def _expand_iw(self):
+        """Complex Matsubara data in the stored shape"""
+        if 'particle_hole' in self.symmetry:
+            return np.where(self._diagonal, 1j * self._iw, self._iw + 0j)
+        return self._iw
+
+    def _full(self, data):
+        """Read only view of stored data with all the blocks"""
+        if 'paramagnetic' in self.symmetry:
+            return np.broadcast_to(data, self.full_shape + data.shape[-1:])
+        view = data.view()
+        view.flags.writeable = False
+        return view.reshape(self.full_shape + data.shape[-1:])
+
+    @property
+    def giw(self):
+        """Green function on the Matsubara frequencies, transformed from
+        the imaginary time data if needed"""
+        if self._iw is None:
+            if self._tau is None:
+                raise ValueError('The Green function holds no data')
+            self._iw = self._reduce_iw(self.plan.forward(self._tau,
+                                                         self._tail_coef()))
+            self._derived = 'iw'
+        return self._full(self._expand_iw())
+
+    @giw.setter
+    def giw(self, giw):
+        self._iw = self._reduce_iw(self._reduce_blocks(giw, len(self.w_n)))
+        self._tau = self._derived = None
+
+    @property
+    def gtau(self):
+        """Green function on the imaginary time grid, transformed from the
+        Matsubara data if needed"""
+        if self._tau is None:
+            if self._iw is None:
+                raise ValueError('The Green function holds no data')
+            self._tau = self.plan.inverse(self._expand_iw(),
+                                          self._tail_coef())
+            self._derived = 'tau'
+        return self._full(self._tau)
+
+    @gtau.setter
+    def gtau(self, gtau):
+        self._tau = np.asarray(self._reduce_blocks(gtau, len(self.tau)),
+                               float)
+        self._iw = self._derived = None
+
+    def __getitem__(self, name):
+        """Matsubara Green function of the block name
+
+        Raises
+        ------
+        KeyError
+            If the Green function has no blocks or none called name
+        """
+        if self.blocks is None:
+            raise KeyError('{}: the Green function has no blocks, '
+                           'use the giw attribute'.format(name))
+        if name not in self.blocks:
+            raise KeyError(name)
+        return self.giw[self.blocks.index(name)]
+
+    @property
+    def nbytes(self):
+        """Memory taken by the stored data"""
+        return sum(data.nbytes for data in (self._iw, self._tau)
+                   if data is not None)
+
+    def save(self, filename):
+        """Stores the grids, structure and data in the npz file filename"""
+        empty = np.zeros(0)
+        np.savez(filename, tau=self.tau, w_n=self.w_n,
+                 shape=np.array(self.shape, int),
+                 blocks=np.array(self.blocks or (), str),
+                 has_blocks=self.blocks is not None, tail=self._tail,
+                 symmetry=np.array(sorted(self.symmetry), str),
+                 iw=empty if self._iw is None else self._iw,
+                 gtau=empty if self._tau is None else self._tau,
+                 derived=self._derived or '')
+
+    @classmethod
+    def load(cls, filename):
+        """Reads back a Green function stored by save without transforming
+        it again"""
+        data = np.load(filename)
+        blocks = [str(name) for name in data['blocks']] \
+            if data['has_blocks'] else None
+        gfunc = cls(data['tau'], data['w_n'], tuple(data['shape']), blocks,
+                    data['tail'], [str(sym) for sym in data['symmetry']])
+        if data['iw'].size:
+            gfunc._iw = data['iw']
+        if data['gtau'].size:
+            gfunc._tau = data['gtau']
+        gfunc._derived = str(data['derived']) or None
+        return gfunc
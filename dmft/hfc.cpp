@@ -70,3 +70,397 @@ void cg2flip(size_t N, double *g, double *dv, size_t l, size_t k){
   cblas_dgemm (CblasColMajor, CblasNoTrans, CblasNoTrans,
 	       N, N, n, -1, &U[0], N, &V[0], n, 1., &g[0], N);
 }
+
+// Delayed updates: the accepted flips are kept as the columns of X and Yt
+// (both N x m, column major) such that the current Green function is
+// g + X Yt^T, and are applied at once by cdelayed_flush
+double cdelayed_diag(size_t N, double *g, double *X, double *Yt, size_t m,
+                     size_t k){
+    double d = g[k*N + k];
+    for(size_t l=0; l<m; l++)
+        d += X[l*N + k] * Yt[l*N + k];
+    return d;
+}
+
+void cdelayed_push(size_t N, double *g, double *X, double *Yt, size_t m,
+                   double dv, size_t k){
+    double ee, a;
+    double *x = X + m*N;
+    double *y = Yt + m*N;
+
+    std::copy (g + k*N, g + (k+1)*N, x);//column fortran
+    cblas_dcopy (N, g + k, N, y, 1);//row fortran
+    if(m > 0){
+        cblas_dgemv (CblasColMajor, CblasNoTrans, N, m, 1., X, N,
+                     Yt + k, N, 1., x, 1);
+        cblas_dgemv (CblasColMajor, CblasNoTrans, N, m, 1., Yt, N,
+                     X + k, N, 1., y, 1);
+    }
+
+    ee = exp(dv)-1.;
+    a = ee/(1. + (1.-x[k])*ee);
+    x[k] -= 1;
+    cblas_dscal (N, a, x, 1);
+}
+
+void cdelayed_flush(size_t N, double *g, double *X, double *Yt, size_t m){
+    if(m == 0)
+        return;
+    cblas_dgemm (CblasColMajor, CblasNoTrans, CblasTrans,
+                 N, N, m, 1., X, N, Yt, N, 1., g, N);
+}
+
+// Single precision Green functions for the mixed precision sweeps. The
+// weights are computed in double precision and only the rank-1 and rank-2
+// updates run in float
+void sgnew(size_t N, float *g, double dv, size_t k){
+    double ee;
+    float a;
+
+    ee = exp(dv)-1.;
+    a = ee/(1. + (1.-g[k*N + k])*ee);
+
+    std::vector<float> x(N);
+    std::copy (g + k*N, g + (k+1)*N, x.begin());//column fortran
+    x[k] -= 1;
+
+    std::vector<float> y(N);
+
+    for(unsigned int i=0; i<N; i++)
+        y[i] = g[i*N + k];//row fortran
+
+    cblas_sger (CblasColMajor, N, N, a, &x[0], 1, &y[0], 1, &g[0], N);
+}
+
+void sg2flip(size_t N, float *g, double *dv, size_t l, size_t k){
+  std::valarray<float> id2 (0., 4);
+  id2[0] = id2[3] = 1.;
+
+  std::valarray<float> U (2*N);
+  std::copy (g + l*N, g + (l+1)*N, std::begin(U));//column fortran
+  std::copy (g + k*N, g + (k+1)*N, std::begin(U) + N);//column fortran
+  U[l] -= 1.;
+  U[N+k] -= 1.;
+
+  U[std::slice(0, N, 1)] *= std::valarray<float>(exp(dv[0])-1., N);
+  U[std::slice(N, N, 1)] *= std::valarray<float>(exp(dv[1])-1., N);
+
+  std::valarray<float> V (2*N);
+  for(size_t i=0; i<N; i++){
+      V[i*2] = g[i*N + l];
+      V[i*2+1] = g[i*N + k];
+  }
+
+  size_t sel[] = {l, k, l+N, k+N};
+  std::valarray<size_t> myselection (sel,4);
+  std::valarray<float> mat (U[myselection]);
+  mat -= id2;
+  int n = 2, info;
+  std::valarray<int> ipiv(n);
+  info = LAPACKE_sgesv(LAPACK_COL_MAJOR, n, N, &mat[0], n, &ipiv[0], &V[0], n);
+  cblas_sgemm (CblasColMajor, CblasNoTrans, CblasNoTrans,
+	       N, N, n, -1, &U[0], N, &V[0], n, 1., &g[0], N);
+}
+
+float sdelayed_diag(size_t N, float *g, float *X, float *Yt, size_t m,
+                    size_t k){
+    double d = g[k*N + k];
+    for(size_t l=0; l<m; l++)
+        d += X[l*N + k] * Yt[l*N + k];
+    return d;
+}
+
+void sdelayed_push(size_t N, float *g, float *X, float *Yt, size_t m,
+                   double dv, size_t k){
+    double ee;
+    float a;
+    float *x = X + m*N;
+    float *y = Yt + m*N;
+
+    std::copy (g + k*N, g + (k+1)*N, x);//column fortran
+    cblas_scopy (N, g + k, N, y, 1);//row fortran
+    if(m > 0){
+        cblas_sgemv (CblasColMajor, CblasNoTrans, N, m, 1., X, N,
+                     Yt + k, N, 1., x, 1);
+        cblas_sgemv (CblasColMajor, CblasNoTrans, N, m, 1., Yt, N,
+                     X + k, N, 1., y, 1);
+    }
+
+    ee = exp(dv)-1.;
+    a = ee/(1. + (1.-x[k])*ee);
+    x[k] -= 1;
+    cblas_sscal (N, a, x, 1);
+}
+
+void sdelayed_flush(size_t N, float *g, float *X, float *Yt, size_t m){
+    if(m == 0)
+        return;
+    cblas_sgemm (CblasColMajor, CblasNoTrans, CblasTrans,
+                 N, N, m, 1., X, N, Yt, N, 1., g, N);
+}
+
+// Complex Green functions, same updates as above using the unconjugated
+// zgeru and zgemm
+void zgnew(size_t N, dcomplex *g, double dv, size_t k){
+    double ee;
+    dcomplex a;
+
+    ee = exp(dv)-1.;
+    a = ee/(1. + (1.-g[k*N + k])*ee);
+
+    std::vector<dcomplex> x(N);
+    std::copy (g + k*N, g + (k+1)*N, x.begin());//column fortran
+    x[k] -= 1;
+
+    std::vector<dcomplex> y(N);
+
+    for(unsigned int i=0; i<N; i++)
+        y[i] = g[i*N + k];//row fortran
+
+    cblas_zgeru (CblasColMajor, N, N, &a, &x[0], 1, &y[0], 1, &g[0], N);
+}
+
+void zg2flip(size_t N, dcomplex *g, double *dv, size_t l, size_t k){
+  std::valarray<dcomplex> id2 (0., 4);
+  id2[0] = id2[3] = 1.;
+
+  std::valarray<dcomplex> U (2*N);
+  std::copy (g + l*N, g + (l+1)*N, std::begin(U));//column fortran
+  std::copy (g + k*N, g + (k+1)*N, std::begin(U) + N);//column fortran
+  U[l] -= 1.;
+  U[N+k] -= 1.;
+
+  U[std::slice(0, N, 1)] *= std::valarray<dcomplex>(exp(dv[0])-1., N);
+  U[std::slice(N, N, 1)] *= std::valarray<dcomplex>(exp(dv[1])-1., N);
+
+  std::valarray<dcomplex> V (2*N);
+  for(size_t i=0; i<N; i++){
+      V[i*2] = g[i*N + l];
+      V[i*2+1] = g[i*N + k];
+  }
+
+  size_t sel[] = {l, k, l+N, k+N};
+  std::valarray<size_t> myselection (sel,4);
+  std::valarray<dcomplex> mat (U[myselection]);
+  mat -= id2;
+  int n = 2, info;
+  std::valarray<int> ipiv(n);
+  info = LAPACKE_zgesv(LAPACK_COL_MAJOR, n, N,
+                       reinterpret_cast<lapack_complex_double*>(&mat[0]), n,
+                       &ipiv[0],
+                       reinterpret_cast<lapack_complex_double*>(&V[0]), n);
+  dcomplex alpha = -1., beta = 1.;
+  cblas_zgemm (CblasColMajor, CblasNoTrans, CblasNoTrans,
+	       N, N, n, &alpha, &U[0], N, &V[0], n, &beta, &g[0], N);
+}
+
+dcomplex zdelayed_diag(size_t N, dcomplex *g, dcomplex *X, dcomplex *Yt,
+                       size_t m, size_t k){
+    dcomplex d = g[k*N + k];
+    for(size_t l=0; l<m; l++)
+        d += X[l*N + k] * Yt[l*N + k];
+    return d;
+}
+
+void zdelayed_push(size_t N, dcomplex *g, dcomplex *X, dcomplex *Yt,
+                   size_t m, double dv, size_t k){
+    double ee;
+    dcomplex a, one = 1.;
+    dcomplex *x = X + m*N;
+    dcomplex *y = Yt + m*N;
+
+    std::copy (g + k*N, g + (k+1)*N, x);//column fortran
+    cblas_zcopy (N, g + k, N, y, 1);//row fortran
+    if(m > 0){
+        cblas_zgemv (CblasColMajor, CblasNoTrans, N, m, &one, X, N,
+                     Yt + k, N, &one, x, 1);
+        cblas_zgemv (CblasColMajor, CblasNoTrans, N, m, &one, Yt, N,
+                     X + k, N, &one, y, 1);
+    }
+
+    ee = exp(dv)-1.;
+    a = ee/(1. + (1.-x[k])*ee);
+    x[k] -= 1;
+    cblas_zscal (N, &a, x, 1);
+}
+
+void zdelayed_flush(size_t N, dcomplex *g, dcomplex *X, dcomplex *Yt,
+                    size_t m){
+    dcomplex one = 1.;
+    if(m == 0)
+        return;
+    cblas_zgemm (CblasColMajor, CblasNoTrans, CblasTrans,
+                 N, N, m, &one, X, N, Yt, N, &one, g, N);
+}
+
+// Cluster moves: flipping the Ising fields l_1..l_k at once changes the
+// Green function by the rank-k Woodbury update
+//   G' = G - U (U_l - 1)^{-1} G_l
+// with U_{if} = (G_{il_f} - \delta_{il_f})(e^{dv_f} - 1), U_l its rows l and
+// G_l the rows l of G. The weight ratio is det(1 - U_l). All buffers are
+// preallocated by the caller: U is N x k, V k x N, mat k x k and ipiv k,
+// the LU factors of U_l - 1 computed for the ratio are reused by the
+// update.
+template <typename T>
+static T small_lu(size_t k, T *a, int *ipiv){
+    T det = 1.;
+    for(size_t c=0; c<k; c++){
+        size_t p = c;
+        for(size_t r=c+1; r<k; r++)
+            if(std::abs(a[r + c*k]) > std::abs(a[p + c*k]))
+                p = r;
+        ipiv[c] = p;
+        if(p != c){
+            for(size_t j=0; j<k; j++)
+                std::swap(a[c + j*k], a[p + j*k]);
+            det = -det;
+        }
+        det *= a[c + c*k];
+        if(a[c + c*k] == T(0.))
+            return det;
+        for(size_t r=c+1; r<k; r++){
+            a[r + c*k] /= a[c + c*k];
+            for(size_t j=c+1; j<k; j++)
+                a[r + j*k] -= a[r + c*k] * a[c + j*k];
+        }
+    }
+    return det;
+}
+
+template <typename T>
+static void small_lu_solve(size_t k, size_t n, T *a, int *ipiv, T *b){
+    for(size_t j=0; j<n; j++){
+        T *x = b + j*k;
+        for(size_t c=0; c<k; c++)
+            if((size_t)ipiv[c] != c)
+                std::swap(x[c], x[ipiv[c]]);
+        for(size_t r=1; r<k; r++)
+            for(size_t c=0; c<r; c++)
+                x[r] -= a[r + c*k] * x[c];
+        for(size_t r=k; r-- > 0;){
+            for(size_t c=r+1; c<k; c++)
+                x[r] -= a[r + c*k] * x[c];
+            x[r] /= a[r + r*k];
+        }
+    }
+}
+
+static void rank_update(size_t N, size_t k, double *U, double *V, double *g){
+    cblas_dgemm (CblasColMajor, CblasNoTrans, CblasNoTrans,
+                 N, N, k, -1., U, N, V, k, 1., g, N);
+}
+
+static void rank_update(size_t N, size_t k, float *U, float *V, float *g){
+    cblas_sgemm (CblasColMajor, CblasNoTrans, CblasNoTrans,
+                 N, N, k, -1., U, N, V, k, 1., g, N);
+}
+
+static void rank_update(size_t N, size_t k, dcomplex *U, dcomplex *V,
+                        dcomplex *g){
+    dcomplex alpha = -1., beta = 1.;
+    cblas_zgemm (CblasColMajor, CblasNoTrans, CblasNoTrans,
+                 N, N, k, &alpha, U, N, V, k, &beta, g, N);
+}
+
+template <typename T>
+static T kflip_ratio(size_t N, T *g, double *dv, size_t *l, size_t k,
+                     T *U, T *mat, int *ipiv){
+    for(size_t f=0; f<k; f++){
+        T ee = exp(dv[f]) - 1.;
+        T *u = U + f*N;
+        std::copy (g + l[f]*N, g + (l[f]+1)*N, u);//column fortran
+        u[l[f]] -= 1.;
+        for(size_t i=0; i<N; i++)
+            u[i] *= ee;
+    }
+    for(size_t f=0; f<k; f++)
+        for(size_t e=0; e<k; e++)
+            mat[e + f*k] = U[f*N + l[e]] - T(e == f ? 1. : 0.);
+    T det = small_lu(k, mat, ipiv);
+    return k % 2 ? -det : det;
+}
+
+template <typename T>
+static void kflip_update(size_t N, T *g, size_t *l, size_t k, T *U, T *V,
+                         T *mat, int *ipiv){
+    for(size_t i=0; i<N; i++)
+        for(size_t f=0; f<k; f++)
+            V[f + i*k] = g[i*N + l[f]];//row fortran
+    small_lu_solve(k, N, mat, ipiv, V);
+    rank_update(N, k, U, V, g);
+}
+
+double ckflip_ratio(size_t N, double *g, double *dv, size_t *l, size_t k,
+                    double *U, double *mat, int *ipiv){
+    return kflip_ratio(N, g, dv, l, k, U, mat, ipiv);
+}
+
+void ckflip_update(size_t N, double *g, size_t *l, size_t k, double *U,
+                   double *V, double *mat, int *ipiv){
+    kflip_update(N, g, l, k, U, V, mat, ipiv);
+}
+
+float skflip_ratio(size_t N, float *g, double *dv, size_t *l, size_t k,
+                   float *U, float *mat, int *ipiv){
+    return kflip_ratio(N, g, dv, l, k, U, mat, ipiv);
+}
+
+void skflip_update(size_t N, float *g, size_t *l, size_t k, float *U,
+                   float *V, float *mat, int *ipiv){
+    kflip_update(N, g, l, k, U, V, mat, ipiv);
+}
+
+dcomplex zkflip_ratio(size_t N, dcomplex *g, double *dv, size_t *l, size_t k,
+                      dcomplex *U, dcomplex *mat, int *ipiv){
+    return kflip_ratio(N, g, dv, l, k, U, mat, ipiv);
+}
+
+void zkflip_update(size_t N, dcomplex *g, size_t *l, size_t k, dcomplex *U,
+                   dcomplex *V, dcomplex *mat, int *ipiv){
+    kflip_update(N, g, l, k, U, V, mat, ipiv);
+}
+
+static int gesv(int N, double *a, int *ipiv, double *b){
+    return LAPACKE_dgesv(LAPACK_COL_MAJOR, N, N, a, N, ipiv, b, N);
+}
+
+static int gesv(int N, dcomplex *a, int *ipiv, dcomplex *b){
+    return LAPACKE_zgesv(LAPACK_COL_MAJOR, N, N,
+                         reinterpret_cast<lapack_complex_double*>(a), N, ipiv,
+                         reinterpret_cast<lapack_complex_double*>(b), N);
+}
+
+// Clean recomputation of the Green function g from the retarded Weiss field
+// g0t, solving (1 - (g0t - 1) u) g = g0t with u_j = exp(v_j) - 1 scaling the
+// columns. a and x are N x N work matrices. The largest deviation of the fast
+// updated g from the clean one, which replaces it, is stored in drift
+template <typename T>
+static int gclean(size_t N, T *g0t, double *v, T *g, T *a, T *x, int *ipiv,
+                  double *drift){
+    int info;
+    for(size_t j=0; j<N; j++){
+        double u = exp(v[j]) - 1.;
+        for(size_t i=0; i<N; i++)
+            a[i + j*N] = T(i == j ? 1. : 0.) -
+                u*(g0t[i + j*N] - T(i == j ? 1. : 0.));
+    }
+    std::copy (g0t, g0t + N*N, x);
+    info = gesv(N, a, ipiv, x);
+    if(info != 0)
+        return info;
+    *drift = 0.;
+    for(size_t i=0; i<N*N; i++)
+        *drift = std::max(*drift, (double)std::abs(x[i] - g[i]));
+    std::copy (x, x + N*N, g);
+    return 0;
+}
+
+int cgclean(size_t N, double *g0t, double *v, double *g, double *a,
+            double *x, int *ipiv, double *drift){
+    return gclean(N, g0t, v, g, a, x, ipiv, drift);
+}
+
+int zgclean(size_t N, dcomplex *g0t, double *v, dcomplex *g, dcomplex *a,
+            dcomplex *x, int *ipiv, double *drift){
+    return gclean(N, g0t, v, g, a, x, ipiv, drift);
+}
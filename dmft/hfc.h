@@ -25,6 +25,8 @@
 #include <valarray>
 #include <iostream>
 #include <cmath>
+#include <complex>
+#include <algorithm>
 
 #include <cblas.h>
 #include <lapacke.h>
@@ -33,4 +35,51 @@
 void cgnew(size_t N, double *g, double dv, size_t k);
 void cg2flip(size_t N, double *g, double *dv, size_t l, size_t k);
 
+double cdelayed_diag(size_t N, double *g, double *X, double *Yt, size_t m,
+                     size_t k);
+void cdelayed_push(size_t N, double *g, double *X, double *Yt, size_t m,
+                   double dv, size_t k);
+void cdelayed_flush(size_t N, double *g, double *X, double *Yt, size_t m);
+
+void sgnew(size_t N, float *g, double dv, size_t k);
+void sg2flip(size_t N, float *g, double *dv, size_t l, size_t k);
+
+float sdelayed_diag(size_t N, float *g, float *X, float *Yt, size_t m,
+                    size_t k);
+void sdelayed_push(size_t N, float *g, float *X, float *Yt, size_t m,
+                   double dv, size_t k);
+void sdelayed_flush(size_t N, float *g, float *X, float *Yt, size_t m);
+
+typedef std::complex<double> dcomplex;
+
+void zgnew(size_t N, dcomplex *g, double dv, size_t k);
+void zg2flip(size_t N, dcomplex *g, double *dv, size_t l, size_t k);
+
+dcomplex zdelayed_diag(size_t N, dcomplex *g, dcomplex *X, dcomplex *Yt,
+                       size_t m, size_t k);
+void zdelayed_push(size_t N, dcomplex *g, dcomplex *X, dcomplex *Yt,
+                   size_t m, double dv, size_t k);
+void zdelayed_flush(size_t N, dcomplex *g, dcomplex *X, dcomplex *Yt,
+                    size_t m);
+
+// Cluster moves flipping the k Ising fields l at once
+double ckflip_ratio(size_t N, double *g, double *dv, size_t *l, size_t k,
+                    double *U, double *mat, int *ipiv);
+void ckflip_update(size_t N, double *g, size_t *l, size_t k, double *U,
+                   double *V, double *mat, int *ipiv);
+float skflip_ratio(size_t N, float *g, double *dv, size_t *l, size_t k,
+                   float *U, float *mat, int *ipiv);
+void skflip_update(size_t N, float *g, size_t *l, size_t k, float *U,
+                   float *V, float *mat, int *ipiv);
+dcomplex zkflip_ratio(size_t N, dcomplex *g, double *dv, size_t *l, size_t k,
+                      dcomplex *U, dcomplex *mat, int *ipiv);
+void zkflip_update(size_t N, dcomplex *g, size_t *l, size_t k, dcomplex *U,
+                   dcomplex *V, dcomplex *mat, int *ipiv);
+
+// Clean recomputation of the Green functions from the retarded Weiss field
+int cgclean(size_t N, double *g0t, double *v, double *g, double *a,
+            double *x, int *ipiv, double *drift);
+int zgclean(size_t N, dcomplex *g0t, double *v, dcomplex *g, dcomplex *a,
+            dcomplex *x, int *ipiv, double *drift);
+
 #endif // HFC_H
@@ -1,27 +1,93 @@
 # -*- coding: utf-8 -*-
-"""
+r"""
 QMC Hirsch - Fye Impurity solver
 ================================
 
 To treat the Anderson impurity model and solve it using the Hirsch - Fye
 Quantum Monte Carlo algorithm
+
+Solver options
+--------------
+
+The parameters of :func:`imp_solver` are completed by
+:func:`solver_parms`, the command line flags of :func:`do_input` set them.
+
+Parallel chains
+    The measurements are reduced over the ranks of the communicator comm,
+    any object with the interface of an mpi4py communicator.
+    With parms['chains'] > 1 every rank runs that many independent Markov
+    chains, each with its own random number generator seeded from
+    parms['SEED'], and merges them before the MPI reduction. The first
+    chain updates v in place, the others start from a copy of it.
+    parms['backend'] 'threads' runs them in a thread pool, 'processes' in
+    a process pool of up to one worker per core.
+
+Sweeps
+    Between the sweeps that need Python, global flips, binned
+    measurements or checkpoints, the chains run in the compiled
+    driver :func:`hffast.run_sweeps`, which samples the same Markov chain
+    as the Python loop forced by parms['compiled_driver'] = False. Several
+    bands take one block per flavor and the fields of
+    :func:`interaction_matrix`, all updated in a single compiled pass.
+    parms['double_flip_prob'] is the fraction of moves that flip together
+    the fields at one time slice of parms['cluster_size'] consecutive
+    sites, 0 for all of them. parms['precision'] 'single' keeps the Green
+    functions in float32 during the sweeps, 'therm' only while
+    thermalizing, see :func:`precision_check`. Complex Weiss fields run
+    the complex128 updates and count negative weights in nsign.
+
+Clean updates
+    The Green functions are recomputed from scratch every
+    parms['clean_interval'] sweeps and the drift of the fast updated ones
+    is saved to drift.npy, its largest value to the stats. With
+    parms['drift_tol'] > 0 the interval adapts to it, up to 8 times
+    parms['clean_interval'], see :func:`adapt_clean_interval`. With
+    parms['toeplitz_weiss'] the Weiss field is kept as its generating
+    :math:`\mathcal{G}^0(\tau)`, see :class:`ToeplitzWeiss`.
+
+Measurements
+    parms['error_analysis'] streams every measurement into a logarithmic
+    binning analysis, see :func:`binning_errors`. With
+    parms['target_error'] > 0 the chains thermalize until a drift test
+    passes and measure until the error of parms['target_observable'] is
+    below the target, see :func:`target_reached`. The stats record the
+    sweeps spent thermalizing and the measurements. parms['chi_interval']
+    sets how often :math:`\chi(\tau)` is measured, see
+    :func:`measure_chi`, parms['legendre'] > 0 reduces :math:`G(\tau)` as
+    Legendre coefficients and parms['improved_sigma'] measures the
+    self-energy of :func:`improved_sigma`.
+
+Output and restarts
+    Everything is saved in parms['work_dir'], see :func:`save_output`,
+    among it the :class:`dmft.solver_stats.SolverStats` in stats.npz.
+    parms['checkpoint'] > 0 saves the state of every chain that many
+    sweeps apart, see :func:`save_checkpoint`, to resume an interrupted
+    run. The checkpoints are removed once the chains finish.
+    parms['warm_start'] starts the chains from the Ising fields of another
+    run, see :func:`warm_start`.
 """
 
 from __future__ import division, absolute_import, print_function
 import argparse
+import glob
+import multiprocessing
 import os
+import pickle
 import struct
 import time
-from itertools import combinations, product
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from math import exp
 
-from mpi4py import MPI
 from scipy.linalg.blas import dger, zgeru
 import scipy.linalg as la
-import numba
 import numpy as np
 
-from dmft.common import tau_wn_setup, gw_invfouriertrans, greenF
+from dmft.common import tau_wn_setup, gw_invfouriertrans, greenF, \
+    gt_fouriertrans, gt_legendretrans, gl_invlegendretrans, gt_spline
+from dmft.binning import LogBinning
+from dmft.parallel import default_comm, threaded_collectives, SerialComm, \
+    LAND
+from dmft.solver_stats import SolverStats
 import dmft.hffast as hffast
 
 
@@ -56,16 +122,301 @@ def ising_v(dtau, U, L, fields=1, polar=0.5):
     return vis * lam
 
 
-def imp_solver(g0_blocks, v, interaction, parms_user):
+def imp_solver(g0_blocks, v, interaction, parms_user, comm=None):
     r"""Impurity solver call. Calcutaltes the interacting Green function
     as given by the contribution of the auxiliary discretized spin field.
+
+    Parameters
+    ----------
+    g0_blocks : list of ndarrays
+        Weiss field :math:`\mathcal{G}^0(\tau)` of every block, real or
+        complex, of shape (SITES, SITES, 2*N_MATSUBARA) or
+        (2*N_MATSUBARA, ) for a single site
+    v : 2D ndarray
+        Ising fields, updated in place by the first Markov chain
+    interaction : 2D ndarray
+        Interaction matrix between spin species and Ising fields
+    parms_user : dictionary
+        Simulation parameters, see :func:`solver_parms` and the solver
+        options at the top of this module
+    comm : MPI communicator
+        Defaults to :func:`dmft.parallel.default_comm`
+
+    Returns
+    -------
+    list of ndarrays
+        Green function :math:`G(\tau)` of every block
+    """
+    return imp_solver_results(g0_blocks, v, interaction, parms_user,
+                              comm)['gtau']
+
+
+def imp_solver_results(g0_blocks, v, interaction, parms_user, comm=None):
+    r"""Impurity solver call returning all the reduced measurements
+
+    Parameters
+    ----------
+    As imp_solver
+
+    Returns
+    -------
+    dict
+        'gtau' the list of the Green function blocks :math:`G(\tau)`,
+        'errors' the binning analysis with parms['error_analysis'] and
+        'sigma' the self-energy with parms['improved_sigma'], else None
+    """
+
+    if comm is None:
+        comm = default_comm()
+    parms = solver_parms(parms_user)
+    if not os.path.exists(parms_user['work_dir']) and comm.rank == 0:
+        os.makedirs(parms_user['work_dir'])
+
+    # Retarded field includes the Hirsh-Fye minus sign in GF
+    if parms['toeplitz_weiss']:
+        GX = [ToeplitzWeiss(gb) for gb in g0_blocks]
+    else:
+        GX = retarded_weiss(np.asarray(g0_blocks))
+
+    chains_v = [v] + [np.copy(v) for _ in range(parms['chains'] - 1)]
+    if parms['warm_start'] and \
+            warm_start(chains_v, parms['warm_start'], comm.rank):
+        parms['therm_sweeps'] = min(parms['therm'], parms['warm_therm'])
+
+    if parms['backend'] not in ('threads', 'processes'):
+        raise ValueError('Unknown chain backend {}'.format(parms['backend']))
+    labels = ['r{}c{}'.format(comm.rank, chain)
+              for chain in range(parms['chains'])]
+    if parms['chains'] > 1 and parms['backend'] == 'processes':
+        pool = ProcessPoolExecutor(min(parms['chains'],
+                                       multiprocessing.cpu_count()))
+        rng_states = [None] * parms['chains']
+
+        def run_chains(states, until=None):
+            futures = [pool.submit(pool_chain, GX, cv, interaction, parms,
+                                   parms['SEED'] + chain, rng_states[chain],
+                                   labels[chain], states[chain], until)
+                       for chain, cv in enumerate(chains_v)]
+            done = []
+            for chain, future in enumerate(futures):
+                chain_v, state, rng_states[chain] = future.result()
+                chains_v[chain][:] = chain_v
+                done.append(state)
+            return done
+    elif parms['chains'] > 1:
+        rngs = [hffast.Rng(parms['SEED'] + chain)
+                for chain in range(parms['chains'])]
+        pool = ThreadPoolExecutor(parms['chains'])
+
+        def run_chains(states, until=None):
+            return list(pool.map(
+                lambda cv, rng, label, state: markov_chain(
+                    GX, cv, interaction, parms, rng, label, state, until),
+                chains_v, rngs, labels, states))
+    else:
+        rng = hffast.Rng(parms['SEED'])
+        pool = None
+
+        def run_chains(states, until=None):
+            return [markov_chain(GX, v, interaction, parms, rng,
+                                 'r{}'.format(comm.rank), states[0], until)]
+
+    results = [None] * parms['chains']
+    if parms['target_error'] > 0:
+        until = 0
+        while True:
+            until += parms['check_interval']
+            results = run_chains(results, until)
+            with results[0]['stats'].timer('reduction'):
+                done = target_reached(results, parms, comm)
+            if done:
+                break
+    else:
+        results = run_chains(results)
+    if pool is not None:
+        pool.shutdown()
+    if parms['checkpoint'] > 0:
+        clear_checkpoints(results)
+
+    save_ising(chains_v, parms['work_dir'], comm.rank)
+    return reduce_chains(results, v, interaction, parms, comm)
+
+
+def replica_exchange(g0_replicas, interaction, parms_user, replicas,
+                     comm=None):
+    r"""Impurity solver with parallel tempering over a ladder of replicas
+
+    Every replica is an impurity problem with its own Weiss field and
+    parameters, neighbouring values of U or of BETA at the same number of
+    time slices. The replicas are spread over the MPI ranks and those of a
+    rank run concurrently in threads. Every parms['swap_interval'] sweeps
+    the Ising configurations :math:`s` of neighbouring replicas
+    :math:`a, b`, alternating even and odd pairs, are exchanged with
+    probability
+
+    .. math:: \min\left(1, \frac{W_a(s_b) W_b(s_a)}{W_a(s_a) W_b(s_b)}
+        \right)
+
+    see :func:`replica_log_weight`, after which the Green functions of both
+    are rebuilt from scratch. Near the first order Mott transition it lets
+    the chains of the coexistence region tunnel between the metallic and
+    insulating solutions.
+
+    Parameters
+    ----------
+    g0_replicas : list of lists of ndarrays
+        Weiss fields :math:`\mathcal{G}^0(\tau)` of each block, as for
+        imp_solver, for every replica
+    interaction : 2D ndarray
+        Interaction matrix between spin species and Ising fields
+    parms_user : dictionary
+        Simulation parameters as for imp_solver
+    replicas : list of dict
+        Parameters of each replica overriding parms_user, like U. By
+        default the output of replica i goes to the subdirectory replica<i>
+        of parms_user['work_dir']
+    comm : MPI communicator
+        Defaults to :func:`dmft.parallel.default_comm`
+
+    Returns
+    -------
+    list
+        for every replica what imp_solver returns for it. The acceptance
+        rate of the swaps of each pair is saved in swap_acceptance.npy
     """
+    if comm is None:
+        comm = default_comm()
+    base = solver_parms(parms_user)
+    base['SEED'] = comm.bcast(base['SEED'])
+    slices = 2 * base['N_MATSUBARA']
+    mine = list(range(comm.rank, len(replicas), comm.size))
+    parms = {}
+    for i in mine:
+        parms[i] = dict(base, chains=1, SEED=base['SEED'] + i,
+                        work_dir=os.path.join(base['work_dir'],
+                                              'replica{}'.format(i)))
+        parms[i].update(replicas[i])
+        parms[i]['dtau_mc'] = parms[i]['BETA'] / slices
+        if not os.path.exists(parms[i]['work_dir']):
+            os.makedirs(parms[i]['work_dir'])
+    lam = {i: np.arccosh(np.exp(parms[i]['dtau_mc'] * parms[i]['U'] / 2))
+           for i in mine}
+    GX = {i: [retarded_weiss(gb) for gb in g0_replicas[i]] for i in mine}
+    v = {i: ising_v(parms[i]['dtau_mc'], parms[i]['U'],
+                    slices * parms[i]['SITES'], interaction.shape[1],
+                    parms[i].get('spin_polarization', .5)) for i in mine}
+    rngs = {i: hffast.Rng(parms[i]['SEED']) for i in mine}
+    chains = {i: None for i in mine}
+
+    swap_rng = np.random.RandomState(base['SEED'])
+    swaps = np.zeros((2, max(len(replicas) - 1, 0)))
+    total = base['sweeps'] + base['therm']
+    until, parity = 0, 0
+    with ThreadPoolExecutor(max(len(mine), 1)) as pool:
+        while until < total:
+            until = min(until + base['swap_interval'], total)
+            states = list(pool.map(
+                lambda i: markov_chain(GX[i], v[i], interaction, parms[i],
+                                       rngs[i], 'r{}'.format(i), chains[i],
+                                       until), mine))
+            chains.update(zip(mine, states))
+
+            configs = {}
+            for part in comm.allgather({i: np.sign(v[i]) for i in mine}):
+                configs.update(part)
+            pairs = [(a, a + 1)
+                     for a in range(parity, len(replicas) - 1, 2)]
+            weights = {}
+            for a, b in pairs:
+                for i, j in ((a, a), (a, b), (b, b), (b, a)):
+                    if i in mine:
+                        weights[i, j] = replica_log_weight(
+                            GX[i], lam[i] * configs[j], interaction)
+            for part in comm.allgather(weights):
+                weights.update(part)
+
+            for a, b in pairs:
+                log_ratio = weights[a, b] + weights[b, a] - \
+                    weights[a, a] - weights[b, b]
+                swaps[1, a] += 1
+                if log_ratio >= 0 or swap_rng.rand() < np.exp(log_ratio):
+                    swaps[0, a] += 1
+                    for i, j in ((a, b), (b, a)):
+                        if i in mine:
+                            v[i][:] = lam[i] * configs[j]
+                            chains[i].pop('g', None)
+            parity = 1 - parity
+    if base['checkpoint'] > 0:
+        clear_checkpoints([chains[i] for i in mine])
+
+    acceptance = swaps[0] / np.maximum(swaps[1], 1)
+    if comm.rank == 0:
+        np.save(os.path.join(base['work_dir'], 'swap_acceptance'),
+                acceptance)
+
+    solved = {i: reduce_chains([chains[i]], v[i], interaction, parms[i],
+                               SerialComm())
+              for i in mine}
+    out = {}
+    for part in comm.allgather(solved):
+        out.update(part)
+    return [out[i]['gtau'] for i in range(len(replicas))]
+
+
+def replica_log_weight(GX, v, interaction):
+    r"""Logarithm of the Hirsch-Fye weight of the Ising fields v
+
+    .. math:: \ln W(v) = \sum_\sigma \ln\left|\det\left(
+        1 - (\mathcal{G}^0_\sigma - 1)(e^{V_\sigma} - 1)\right)\right|
+
+    up to terms independent of v, that is of the inverse of the
+    interacting Green function matrices built by gnewclean
 
-    comm = MPI.COMM_WORLD
-    # Set up default values
+    Parameters
+    ----------
+    GX : list of 2D ndarrays
+        Retarded Weiss field matrices of each spin block
+    v : 2D ndarray
+        Ising fields
+    interaction : 2D ndarray
+        Interaction matrix between spin species and Ising fields
+    """
+    kroneker = np.eye(GX[0].shape[0])
+    int_v = np.dot(interaction, v)
+    log_w = 0.
+    for g_sp, lv in zip(GX, int_v):
+        lu = la.lu_factor(kroneker - (np.exp(lv) - 1.) * (g_sp - kroneker))[0]
+        log_w += np.log(np.abs(np.diag(lu))).sum()
+    return log_w
+
+
+def solver_parms(parms_user):
+    """Completes the simulation parameters with the defaults of the
+    solver. 'therm_sweeps' are the thermalization sweeps of the run,
+    parms['therm'] unless the chains are warm started"""
     parms = {'global_flip': False,
              'binned_meas': False,
              'double_flip_prob': 0.,
+             'cluster_size': 2,
+             'delay':       1,
+             'chains':      1,
+             'clean_interval': 500,
+             'checkpoint':  0,
+             'error_analysis': False,
+             'drift_tol':   0.,
+             'chi_interval': 10,
+             'legendre':    0,
+             'improved_sigma': False,
+             'toeplitz_weiss': False,
+             'compiled_driver': True,
+             'backend':     'threads',
+             'target_error': 0.,
+             'target_observable': 'gtau',
+             'check_interval': 100,
+             'swap_interval': 10,
+             'warm_start':  '',
+             'warm_therm':  200,
+             'precision':   'double',
              't':           0.5,
              'SITES':       1,
              'BANDS':       1,
@@ -75,138 +426,1025 @@ def imp_solver(g0_blocks, v, interaction, parms_user):
              'group':       'temp/' + time.asctime(),
              }
     parms.update(parms_user)
-    if not os.path.exists(parms_user['work_dir']) and comm.rank == 0:
-        os.makedirs(parms_user['work_dir'])
-
-    # Retarded field includes the Hirsh-Fye minus sign in GF
-    GX = [retarded_weiss(gb) for gb in g0_blocks]
-    kroneker = np.eye(GX[0].shape[0])  # assuming all blocks are of same shape
-    Gst = [np.zeros_like(gx) for gx in GX]
-    Gbin = [np.zeros_like(gx) for gx in GX]
+    parms.setdefault('therm_sweeps', parms.get('therm'))
+    return parms
 
-    i_pairs = np.array([c.nonzero() for c in interaction.T]).reshape(-1, 2)
 
-    vlog = []
-    ar = []
+def reduce_chains(results, v, interaction, parms, comm):
+    """Normalizes the measurements of the Markov chains of this rank,
+    reduces them over the communicator and saves them
 
-    acc, anrat = 0, 0
-    flavor_pairs = list(combinations(
-        product(range(2), range(parms['SITES'])), 2))
-    double_occ = np.zeros(len(flavor_pairs))
+    Parameters
+    ----------
+    results : list of dict
+        States of the Markov chains as returned by markov_chain
+    v : ndarray
+        Ising fields, for the acceptance rate normalization
+    interaction : 2D ndarray
+        Interaction matrix between spin species and Ising fields
+    parms : dictionary
+        Simulation parameters as completed by solver_parms
+    comm : MPI communicator
 
-    flavors = 2 * parms['BANDS'] * parms['SITES']
-    flavors_ind = list(product(range(2), range(parms['SITES'])))
-    occupation = np.zeros(flavors)
-    double_occ = np.zeros(len(flavor_pairs))
+    Returns
+    -------
+    As imp_solver_results
+    """
     ntau = 2 * parms['N_MATSUBARA']
+    start = time.time()
+    if parms['target_error'] > 0:
+        rank_meas = sum(res['measured'] for res in results)
+    else:
+        rank_meas = parms['sweeps'] * parms['chains']
+    nmeas = comm.allreduce(rank_meas)
+
+    tGst = np.sum([res['gtau'] for res in results], axis=0)
+    gl = None
+    if parms['legendre'] > 0:
+        tau = np.arange(ntau) * parms['BETA'] / ntau
+        g_rank = -tGst / rank_meas
+        g_beta = -np.eye(g_rank.shape[1]) - g_rank[..., 0]
+        tgl = gt_legendretrans(g_rank, tau, parms['legendre'], g_beta)
+        gl = np.zeros_like(tgl)
+        comm.Allreduce(tgl * rank_meas, gl)
+        gl /= nmeas
+        Gst = -gl_invlegendretrans(gl, tau, parms['BETA'])
+    else:
+        Gst = np.zeros_like(tGst)
+        comm.Allreduce(tGst, Gst)
+        Gst /= nmeas
+
+    acc = sum(res['acc'] for res in results)
+    anrat = sum(res['nsign'] for res in results)
+    occupation = np.sum([res['occupation'] for res in results], axis=0)
+    double_occ = np.sum([res['double_occ'] for res in results], axis=0)
+
+    acc /= v.size * parms['meas'] * sum(res['mcs'] for res in results)
+    occupation /= ntau * rank_meas
+    double_occ /= ntau * rank_meas
+
+    drift = np.concatenate([np.reshape(res['drift'], (-1, 3))
+                            for res in results])
+
+    print('occ', occupation)
+    print('docc', double_occ, 'acc ', acc, 'nsign', anrat, 'rank', comm.rank)
+
+    comm.Allreduce(occupation * rank_meas, occupation)
+    comm.Allreduce(double_occ * rank_meas, double_occ)
+    occupation /= nmeas
+    double_occ /= nmeas
     chi = np.zeros(ntau)
-    hffast.set_seed(parms['SEED'])
+    comm.Allreduce(np.sum([res['chi'] for res in results], axis=0), chi)
+    chi /= max(comm.allreduce(sum(res['chi_measured'] for res in results)), 1)
+
+    errors = None
+    if parms['error_analysis']:
+        errors = binning_errors([res['binning'] for res in results], comm)
+
+    sigma = None
+    if parms['improved_sigma']:
+        Fst = np.zeros_like(tGst)
+        comm.Allreduce(np.sum([res['ftau'] for res in results], axis=0), Fst)
+        Fst /= -nmeas
+        partners = block_partners(interaction, len(Fst))
+        n_flavor = 1 - occupation.reshape(len(Fst), -1)
+        n_partner = np.array([sum(n_flavor[b] for b in blk_partners)
+                              for blk_partners in partners])
+        sigma = improved_sigma(Fst, -Gst, n_partner,
+                               [len(blk_partners) for blk_partners in partners],
+                               parms['U'], parms['BETA'])
+
+    stats = SolverStats()
+    for res in results:
+        stats.merge(res['stats'])
+    stats.cleanups = len(drift)
+    stats.max_drift = drift[:, 1].max() if len(drift) else 0.
+    stats.therm_sweeps = sum(res['therm_end'] + 1 for res in results
+                             if res['therm_end'] is not None)
+    stats.measured = sum(res['measured'] for res in results)
+    stats.time['reduction'] += time.time() - start
+    stats.calls['reduction'] += 1
+    stats.allreduce(comm)
+
+    if comm.rank == 0:
+        save_output(parms, occupation, double_occ, acc, chi,
+                    results[0]['vlog'], results[0]['ar'], drift, errors, gl,
+                    stats)
+        if sigma is not None:
+            np.save(parms['work_dir'] + '/ftau', Fst)
+            np.save(parms['work_dir'] + '/sigma_iw', sigma)
+
+    # Recover Conventional GF sign in average
+    return {'gtau': [-1 * gst for gst in Gst], 'errors': errors,
+            'sigma': sigma}
+
+
+def markov_chain(GX, v, interaction, parms, rng=None, label='r0', chain=None,
+                 until=None):
+    """Samples the auxiliary Ising fields v with one Markov chain
+
+    Parameters
+    ----------
+    GX : list of 2D ndarrays
+        Retarded Weiss field matrices of each spin block
+    v : 2D ndarray
+        Ising fields, updated in place
+    interaction : 2D ndarray
+        Interaction matrix between spin species and Ising fields
+    parms : dictionary
+        Simulation parameters as completed by imp_solver
+    rng : hffast.Rng or None
+        Random number generator of this chain. If None the module wide
+        generator is used
+    label : string
+        Identifies this chain in the binned measurement files
+    chain : dict or None
+        State returned by a previous call to continue sampling from. If None
+        a new chain is started, or resumed from its checkpoint
+    until : int or None
+        Sweep at which to pause the chain. Defaults to running all the
+        sweeps of parms['sweeps'] and parms['therm_sweeps']
+
+    Returns
+    -------
+    dict
+        State of the chain with the accumulated measurements, they are not
+        normalized. 'mcs' is the next sweep to perform, 'therm_end' the
+        last thermalization sweep and 'measured' the number of
+        measurements. 'gtau' holds
+        the translation averaged :math:`G(\\tau)` of each block, still with
+        the Hirsch-Fye sign, with shape (blocks, SITES, SITES, slices).
+        Occupations and density-density correlators run over all flavors,
+        ordered by block and then site. 'drift' has one row per clean
+        update of the Green functions holding the sweep, the drift of the
+        fast updates and the interval to the next one. 'binning' maps each
+        observable to its LogBinning when parms['error_analysis'] or
+        parms['target_error'] is set. 'stats' is the SolverStats with the
+        time spent in each phase and the accepted moves of every field
+
+    With parms['target_error'] > 0 thermalization lasts until the
+    occupations and double occupations of both halves of the last
+    parms['therm'] sweeps agree, checked every parms['therm'] sweeps, see
+    :func:`thermalized`, or at most
+    parms['sweeps'] sweeps, and sampling stops after parms['sweeps']
+    measurements.
+    """
+    kroneker = np.eye(GX[0].shape[0])  # assuming all blocks are of same shape
+    ntau = 2 * parms['N_MATSUBARA']
 
-    update = False
-    for mcs in range(parms['sweeps'] + parms['therm']):
+    i_pairs = field_pairs(interaction)
+    partners = block_partners(interaction, len(GX))
+    adaptive = parms['target_error'] > 0
+    if chain is None:
+        chain = new_chain(GX, v, parms, rng, label)
+    if until is None:
+        until = parms['sweeps'] + parms['therm_sweeps']
+
+    gtau, occupation, double_occ = (chain['gtau'], chain['occupation'],
+                                    chain['double_occ'])
+    binning = chain['binning']
+    stats = chain['stats']
+    g = chain.pop('g', None)
+    update = g is None
+    if g is not None:  # pickling to a process pool loses the block layout
+        g = block_stack(g, g.dtype)
+    driver = compiled_driver(GX, parms, binning)
+    if driver:
+        gx = block_stack(GX, GX[0].dtype)
+        int_matrix = np.ascontiguousarray(interaction, dtype=float)
+
+    for mcs in range(chain['mcs'], until):
+        if mcs < chain['mcs']:  # already run by the compiled driver
+            continue
+        if adaptive and chain['measured'] >= parms['sweeps']:
+            break
         if mcs % parms['therm'] == 0 and parms['global_flip']:
             v *= -1
             update = True
-        if mcs % 500 == 0 or update:  # dirty update clean up
+        dtype = sweep_dtype(GX, parms['precision'],
+                            chain['therm_end'] is None or
+                            mcs <= chain['therm_end'])
+        if g is not None and g[0].dtype != dtype:
+            update = True
+        if mcs >= chain['next_clean'] or update:  # dirty update clean up
             int_v = np.dot(interaction, v)
-            g = [gnewclean(g_sp, lv, kroneker) for g_sp, lv in zip(GX, int_v)]
+            with stats.timer('clean'):
+                g_clean = [gnewclean(g_sp, lv, kroneker)
+                           for g_sp, lv in zip(GX, int_v)]
+            if not update:
+                err = max(np.abs(gc - gf).max() for gc, gf in zip(g_clean, g))
+                if parms['drift_tol'] > 0:
+                    chain['interval'] = adapt_clean_interval(
+                        chain['interval'], err, parms['drift_tol'],
+                        8 * parms['clean_interval'])
+                chain['drift'].append((mcs, err, chain['interval']))
+            g = block_stack(g_clean, dtype)
+            if parms['drift_tol'] > 0:
+                chain['next_clean'] = mcs + chain['interval']
+            else:
+                chain['next_clean'] = (mcs // chain['interval'] + 1) * \
+                    chain['interval']
             update = False
 
-        for _ in range(parms['meas']):
-            for i, (up, dw) in enumerate(i_pairs):
-                acr, nrat = hffast.updateDHS(g[up], g[dw], v[i], ntau,
-                                             parms['double_flip_prob'],
-                                             ['Heat_bath'])
-                acc += acr
-                anrat += nrat
-
-        if mcs > parms['therm']:
-            for i in range(interaction.shape[0]):
-                Gbin[i] += g[i]
-                Gst[i] += g[i]
+        stop = driver_stop(mcs, until, chain, parms) if driver else mcs
+        if stop > mcs + 1:
+            drift = np.empty(((stop - mcs) // chain['interval'] + 1, 2))
+            with stats.timer('driver'):
+                acr, nrat, measured, chain['next_clean'], cleans, \
+                    chi_measured = hffast.run_sweeps(
+                        g, gx, v, i_pairs, int_matrix, ntau, mcs, stop,
+                        chain['next_clean'], chain['interval'],
+                        chain['therm_end'], gtau, occupation, double_occ,
+                        drift, parms['meas'], parms['delay'],
+                        parms['double_flip_prob'], parms['Heat_bath'], rng,
+                        parms['cluster_size'], stats.accepted, chain['chi'],
+                        parms['chi_interval'], chain['measured'])
+            chain['acc'] += acr
+            chain['nsign'] += nrat
+            stats.nsign += nrat
+            stats.proposed += parms['meas'] * (stop - mcs)
+            chain['measured'] += measured
+            chain['chi_measured'] += chi_measured
+            chain['drift'].extend((int(m), err, chain['interval'])
+                                  for m, err in drift[:cleans])
+            chain['mcs'] = stop
+            if parms['checkpoint'] > 0 and stop % parms['checkpoint'] == 0:
+                with stats.timer('checkpoint'):
+                    save_checkpoint(chain, v, rng, GX, parms)
+            continue
+
+        with stats.timer('sweep'):
+            for _ in range(parms['meas']):
+                acr, nrat = hffast.updateDHS_fields(
+                    g, v, i_pairs, ntau, parms['delay'],
+                    parms['double_flip_prob'], parms['Heat_bath'], rng,
+                    parms['cluster_size'], stats.accepted)
+                chain['acc'] += acr
+                chain['nsign'] += nrat
+                stats.nsign += nrat
+        stats.proposed += parms['meas']
+
+        if chain['therm_end'] is None:
+            s_occ = np.zeros_like(occupation)
+            s_docc = np.zeros_like(double_occ)
+            with stats.timer('measure'):
+                hffast.measure(measured_g(g, GX), np.zeros_like(gtau), s_occ,
+                               s_docc, ntau)
+            chain['therm_series'].append(np.concatenate((s_occ, s_docc)) /
+                                         ntau)
+            if (mcs + 1) % parms['therm'] == 0 and \
+                    (thermalized(chain['therm_series'],
+                                 parms['therm'] // 2) or
+                     mcs + 1 >= parms['sweeps']):
+                chain['therm_end'] = mcs
+                chain['therm_series'] = []
+
+        elif mcs > chain['therm_end']:
+            chain['measured'] += 1
+            with stats.timer('measure'):
+                g_meas = measured_g(g, GX)
+                if binning:
+                    s_gtau = np.zeros_like(gtau)
+                    s_occ = np.zeros_like(occupation)
+                    s_docc = np.zeros_like(double_occ)
+                    hffast.measure(g_meas, s_gtau, s_occ, s_docc, ntau)
+                    gtau += s_gtau
+                    occupation += s_occ
+                    double_occ += s_docc
+                else:
+                    hffast.measure(g_meas, gtau, occupation, double_occ, ntau)
+                if parms['improved_sigma']:
+                    hffast.measure_f(g_meas, partners, chain['ftau'], ntau)
+                if parms['chi_interval'] > 0 and \
+                        chain['measured'] % parms['chi_interval'] == 0:
+                    measure_chi(g_meas, chain['chi'], ntau)
+                    chain['chi_measured'] += 1
+            if binning:
+                with stats.timer('binning_io'):
+                    binning['gtau'].add(-s_gtau)
+                    binning['occupation'].add(s_occ / ntau)
+                    binning['double_occ'].add(s_docc / ntau)
             if mcs % parms['therm'] == 0 and parms['binned_meas']:
-                Gbin = np.array(Gbin) / parms['therm']
-                np.save(parms['work_dir'] + '/gtau_bin_mcs{}_r{}'.format(mcs,
-                                                                         comm.rank),
-                        np.squeeze([-1 * avg_g(gst, parms) for gst in Gbin]))
-                Gbin = [np.zeros_like(gx) for gx in GX]
-
-            orbital_occupation(g, occupation, ntau, flavors_ind)
-            double_occupation(g, double_occ, ntau, flavor_pairs)
+                with stats.timer('binning_io'):
+                    gbin = (gtau - chain['gbin_start']) / parms['therm']
+                    np.save(parms['work_dir'] +
+                            '/gtau_bin_mcs{}_{}'.format(mcs, label),
+                            np.squeeze(-1 * gbin))
+                    chain['gbin_start'] = gtau.copy()
+
             if parms['save_logs']:
-                vlog.append(v > 0)
-                ar.append(acr)
+                chain['vlog'].append(v > 0)
+                chain['ar'].append(acr)
+
+        chain['mcs'] = mcs + 1
+        if parms['checkpoint'] > 0 and chain['mcs'] % parms['checkpoint'] == 0:
+            with stats.timer('checkpoint'):
+                save_checkpoint(chain, v, rng, GX, parms)
+
+    if parms['checkpoint'] > 0:
+        with stats.timer('checkpoint'):
+            save_checkpoint(chain, v, rng, GX, parms)
+
+    chain['g'] = g
+    return chain
+
+
+def compiled_driver(GX, parms, binning):
+    """Whether the sweeps of a Markov chain can run in the compiled driver
+    :func:`hffast.run_sweeps`. It keeps the Green functions in the
+    precision of the dense Weiss fields, cleans them at a fixed interval
+    and measures just G(tau), the occupations, double occupations and the
+    spin correlator, so
+    the chains logging the fields, binning their measurements or measuring
+    the improved self-energy stay in Python"""
+    return bool(parms['compiled_driver'] and not binning and
+                not parms['save_logs'] and not parms['improved_sigma'] and
+                parms['precision'] == 'double' and
+                not isinstance(GX[0], ToeplitzWeiss))
+
+
+def driver_stop(mcs, until, chain, parms):
+    """Sweep up to which the compiled driver can run from sweep mcs, the
+    first one that needs Python. Those are the global flips, the binned
+    measurements, the checkpoints and with parms['drift_tol'] the clean
+    updates, as well as the thermalization when it is not of fixed
+    length"""
+    therm_end = chain['therm_end']
+    if therm_end is None:
+        return mcs
+    stops = [until]
+    if parms['global_flip']:
+        stops.append((mcs // parms['therm'] + 1) * parms['therm'])
+    if parms['checkpoint'] > 0:
+        stops.append((mcs // parms['checkpoint'] + 1) * parms['checkpoint'])
+    if parms['drift_tol'] > 0:
+        stops.append(max(chain['next_clean'], mcs))
+    if parms['binned_meas']:
+        first = max(mcs, therm_end + 1)
+        stops.append(first + (-first) % parms['therm'])
+    return min(stops)
+
+
+def pool_chain(GX, v, interaction, parms, seed, rng_state, label, chain,
+               until):
+    """Runs markov_chain in a worker process of the process pool backend
+
+    The random generator is seeded with seed or restored from rng_state,
+    the state of a previous call. Returns the Ising fields v, the state of
+    the chain and that of its random generator"""
+    rng = hffast.Rng(seed)
+    if rng_state is not None:
+        rng.set_state(rng_state)
+    chain = markov_chain(GX, v, interaction, parms, rng, label, chain, until)
+    return v, chain, rng.get_state()
+
+
+def sweep_dtype(GX, precision, thermalizing):
+    """Data type of the Green function matrices updated by the sweeps
 
-    tGst = np.asarray(Gst)
-    Gst = np.zeros_like(tGst)
-    comm.Allreduce(tGst, Gst)
-    Gst /= parms['sweeps'] * comm.Get_size()
+    Parameters
+    ----------
+    GX : list of 2D ndarrays
+        Retarded Weiss field matrices of each spin block
+    precision : string
+        'double' sweeps in the precision of the Weiss field, 'single' in
+        float32 and 'therm' in float32 only while thermalizing
+    thermalizing : bool
+    """
+    if precision not in ('double', 'single', 'therm'):
+        raise ValueError('Unknown sweep precision {}'.format(precision))
+    if precision == 'double' or (precision == 'therm' and not thermalizing):
+        return GX[0].dtype
+    if np.iscomplexobj(GX[0]):
+        raise ValueError('Single precision sweeps need real Weiss fields')
+    return np.dtype(np.float32)
 
-    acc /= v.size * parms['meas'] * (parms['sweeps'] + parms['therm'])
-    occupation /= 2 * parms['N_MATSUBARA'] * parms['sweeps']
-    double_occ /= 2 * parms['N_MATSUBARA'] * parms['sweeps']
 
-    print('occ', occupation)
-    print('docc', double_occ, 'acc ', acc, 'nsign', anrat, 'rank', comm.rank)
+def block_stack(g, dtype):
+    """Green function matrices g in one array of shape (blocks, N, N) with
+    every block Fortran ordered, the layout the compiled updates work on.
+    Stacks already in that layout are returned as they are"""
+    return np.ascontiguousarray(np.swapaxes(g, 1, 2), dtype).swapaxes(1, 2)
+
+
+def measured_g(g, GX):
+    """Green function matrices g in the precision of the Weiss field for
+    the measurements"""
+    if g[0].dtype == GX[0].dtype:
+        return g
+    return [gb.astype(GX[0].dtype) for gb in g]
+
+
+def new_chain(GX, v, parms, rng, label):
+    """Empty state of a Markov chain for :func:`markov_chain`, or the one
+    saved in its checkpoint when parms['checkpoint'] > 0"""
+    ntau = 2 * parms['N_MATSUBARA']
+    sites = parms['SITES']
+    flavors = len(GX) * sites
+
+    chain = {'mcs': 0,
+             'gtau': np.zeros((len(GX), sites, sites, ntau), GX[0].dtype),
+             'occupation': np.zeros(flavors),
+             'double_occ': np.zeros(flavors * (flavors - 1) // 2),
+             'acc': 0, 'nsign': 0,
+             'vlog': [], 'ar': [],
+             'drift': [],
+             'interval': parms['clean_interval'],
+             'next_clean': 0,
+             'therm_end': (None if parms['target_error'] > 0
+                           else parms['therm_sweeps']),
+             'therm_series': [],
+             'measured': 0,
+             'chi': np.zeros(ntau),
+             'ftau': np.zeros((len(GX), sites, sites, ntau), GX[0].dtype),
+             'chi_measured': 0,
+             'stats': SolverStats(*v.shape),
+             'binning': {}}
+    chain['gbin_start'] = np.zeros_like(chain['gtau'])
+    if parms['error_analysis'] or parms['target_error'] > 0:
+        chain['binning'] = {
+            'gtau': LogBinning(chain['gtau'].shape, chain['gtau'].dtype),
+            'occupation': LogBinning(chain['occupation'].shape),
+            'double_occ': LogBinning(chain['double_occ'].shape)}
+
+    chain['file'] = os.path.join(parms['work_dir'],
+                                 'checkpoint_{}.pkl'.format(label))
+    if parms['checkpoint'] > 0:
+        saved = load_checkpoint(chain['file'], GX, parms)
+        if saved is not None:
+            v[:] = saved.pop('v')
+            if rng is None:
+                hffast.set_state(saved.pop('rng'))
+            else:
+                rng.set_state(saved.pop('rng'))
+            chain.update(saved)
+
+    return chain
+
+
+def thermalized(series, window):
+    """Drift test on the last two windows of a time series
+
+    Passes when the averages of every observable over both windows agree
+    within twice their naive standard error. Autocorrelation only makes
+    the test stricter.
+
+    Parameters
+    ----------
+    series : list of 1D ndarrays
+        Measurements taken along the Markov chain
+    window : int
+        Number of measurements in each window
+
+    Returns
+    -------
+    bool
+    """
+    if len(series) < 2 * window:
+        return False
+    old = np.array(series[-2 * window:-window])
+    new = np.array(series[-window:])
+    err = np.sqrt((old.var(0) + new.var(0)) / window)
+    return bool((np.abs(new.mean(0) - old.mean(0)) <= 2 * err).all())
+
+
+def save_ising(chains_v, work_dir, rank):
+    """Saves the signs of the Ising fields of every chain of this rank to
+    ising_r<rank>.npy in work_dir, from where :func:`warm_start` reads them
+    back"""
+    np.save(os.path.join(work_dir, 'ising_r{}'.format(rank)),
+            np.sign(chains_v).astype(np.int8))
+
+
+def warm_start(chains_v, source, rank):
+    """Sets the Ising fields of the chains from the configurations saved by
+    :func:`save_ising` in the directory source
+
+    The configuration of the same rank is used if saved, else the one of
+    rank modulo the number of saved ranks, so a job can resume on a
+    different number of processes. Only the signs are kept and they take
+    the magnitude of the current fields, so that a run at a different U
+    seeds this one.
+
+    Parameters
+    ----------
+    chains_v : list of 2D ndarrays
+        Ising fields of the chains of this rank, modified in place
+    source : string
+        Work directory of a previous run
+    rank : int
+
+    Returns
+    -------
+    bool
+        True if the fields were set, False if no compatible configuration
+        is found
+    """
+    saved = sorted(glob.glob(os.path.join(source, 'ising_r*.npy')),
+                   key=lambda name: int(name[:-4].rsplit('_r', 1)[1]))
+    if not saved:
+        return False
+    name = os.path.join(source, 'ising_r{}.npy'.format(rank))
+    if name not in saved:
+        name = saved[rank % len(saved)]
+    signs = np.load(name)
+    if signs.shape[1:] != chains_v[0].shape:
+        return False
+    for chain, cv in enumerate(chains_v):
+        cv[:] = np.abs(cv).max() * signs[chain % len(signs)]
+    return True
+
+
+def weiss_fingerprint(GX):
+    """First column of every retarded Weiss field matrix, it identifies the
+    impurity problem a Markov chain belongs to"""
+    return np.array([gx.first_column() if isinstance(gx, ToeplitzWeiss)
+                     else gx[:, 0] for gx in GX])
+
+
+CHECKPOINT_KEYS = ('sweeps', 'therm', 'meas', 'chains', 'U', 'BETA')
+
+
+def save_checkpoint(chain, v, rng, GX, parms):
+    """Writes the state of a Markov chain to disk, replacing atomically the
+    previous checkpoint"""
+    state = dict(chain)
+    fname = state.pop('file')
+    state['v'] = v
+    state['rng'] = hffast.get_state() if rng is None else rng.get_state()
+    state['weiss'] = weiss_fingerprint(GX)
+    state['key'] = checkpoint_key(parms)
+    with open(fname + '.tmp', 'wb') as out:
+        pickle.dump(state, out, protocol=2)
+    os.rename(fname + '.tmp', fname)
+
+
+def load_checkpoint(fname, GX, parms):
+    """Reads the state of a Markov chain saved by save_checkpoint
+
+    Returns None when there is no checkpoint or when it was written for a
+    different Weiss field or any other value of the parameters in
+    CHECKPOINT_KEYS. Otherwise the state to update the chain with,
+    including the Ising fields 'v' and the random generator state 'rng'"""
+    try:
+        with open(fname, 'rb') as saved:
+            state = pickle.load(saved)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+    weiss = state.pop('weiss')
+    if state.pop('key', None) != checkpoint_key(parms) or \
+            weiss.shape != weiss_fingerprint(GX).shape or \
+            not np.allclose(weiss, weiss_fingerprint(GX)):
+        return None
+    return state
+
+
+def checkpoint_key(parms):
+    """Values of the parameters in CHECKPOINT_KEYS, a checkpoint only
+    resumes a Markov chain run with the same ones"""
+    return tuple(parms[name] for name in CHECKPOINT_KEYS)
+
+
+def clear_checkpoints(chains):
+    """Removes the checkpoints of finished Markov chains, so that a new
+    call samples again instead of resuming them"""
+    for chain in chains:
+        if os.path.exists(chain['file']):
+            os.remove(chain['file'])
+
+
+def target_reached(chains, parms, comm):
+    """Tells all ranks whether the error target of the solver is met
+
+    Parameters
+    ----------
+    chains : list of dict
+        States of the Markov chains of this rank as given by markov_chain
+    parms : dictionary
+        Simulation parameters as completed by imp_solver
+    comm : MPI communicator
+
+    Returns
+    -------
+    bool
+        True once the error of parms['target_observable'] combined over all
+        chains is below parms['target_error'], or when every chain has
+        taken its maximum of parms['sweeps'] measurements
+    """
+    if comm.allreduce(all(c['measured'] >= parms['sweeps'] for c in chains),
+                      op=LAND):
+        return True
+    sampled = min(c['measured'] for c in chains) >= parms['check_interval']
+    if not comm.allreduce(sampled, op=LAND):
+        return False
+    errors = binning_errors([c['binning'] for c in chains], comm)
+    return errors[parms['target_observable']]['error'].max() <= \
+        parms['target_error']
+
+
+def binning_errors(binnings, comm):
+    """Combines the binning analysis of the observables of independent
+    Markov chains across all MPI ranks
+
+    Parameters
+    ----------
+    binnings : list of dict
+        for every chain of this rank the LogBinning of each observable
+    comm : MPI communicator
 
-    comm.Allreduce(occupation.copy(), occupation)
-    comm.Allreduce(double_occ.copy(), double_occ)
-    comm.Allreduce(chi.copy(), chi)
+    Returns
+    -------
+    dict
+        for each observable the 'mean' over all measurements, the 'error'
+        of the mean over all chains and the average integrated
+        autocorrelation time 'tau_int'
+    """
+    nchains = comm.allreduce(len(binnings))
+    errors = {}
+    for name in sorted(binnings[0]):
+        count = comm.allreduce(sum(bins[name].count[0] if bins[name].count
+                                   else 0 for bins in binnings))
+        total = np.sum([bins[name].sum[0] for bins in binnings
+                        if bins[name].count], axis=0)
+        var = np.sum([bins[name].error()**2 for bins in binnings], axis=0)
+        tau = np.sum([bins[name].tau_int() for bins in binnings], axis=0)
+        mean = np.zeros_like(var, dtype=np.result_type(total, var))
+        comm.Allreduce(total + mean, mean)
+        comm.Allreduce(var.copy(), var)
+        comm.Allreduce(tau.copy(), tau)
+        errors[name] = {'mean': mean / max(count, 1),
+                        'error': np.sqrt(var) / nchains,
+                        'tau_int': tau / nchains}
+    return errors
+
+
+def trotter_extrapolation(g0_blocks, tau, interaction, parms, slices,
+                          comm=None):
+    r"""Solves the impurity problem on several Trotter grids and
+    extrapolates the results to :math:`\Delta\tau \to 0`
+
+    Hirsch-Fye results carry a systematic error of order
+    :math:`\Delta\tau^2`. For each grid of L time slices,
+    :math:`\Delta\tau=\beta/L`, the Weiss fields are interpolated by a
+    cubic spline and the impurity solved with error analysis. The grids are
+    distributed over groups of MPI ranks and the grids of one group run
+    concurrently in threads, or one after the other when MPI does not
+    provide THREAD_MULTIPLE. Each observable is then fitted to
+    :math:`a + b\Delta\tau^2`, see :func:`dtau2_extrapolation`.
+
+    Parameters
+    ----------
+    g0_blocks : list of ndarrays
+        Weiss fields :math:`\mathcal{G}^0(\tau)` of each block, as for
+        imp_solver, on the time points tau
+    tau : 1D ndarray
+        Time points of the Weiss fields, the extrapolated :math:`G(\tau)`
+        is given on them too
+    interaction : 2D ndarray
+        Interaction matrix between spin species and Ising fields
+    parms : dictionary
+        Simulation parameters as for imp_solver. The output of every grid
+        goes to the subdirectory L<slices> of parms['work_dir']
+    slices : list of int
+        Number of time slices of each grid, even numbers
+    comm : MPI communicator
+        Defaults to :func:`dmft.parallel.default_comm`
+
+    Returns
+    -------
+    dict
+        for 'gtau', 'occupation' and 'double_occ' the extrapolated 'value'
+        and its 'error', and under 'grids' the same for every grid at its
+        'dtau'. They are also saved to trotter.npz in parms['work_dir']
+    """
+    if comm is None:
+        comm = default_comm()
+    groups = min(comm.size, len(slices))
+    color = comm.rank % groups
+    group = comm.Split(color, comm.rank)
+    mine = list(range(color, len(slices), groups))
+    grid_comms = [group.Dup() for _ in mine]
+
+    def solve(grid_slices, grid_comm):
+        grid = dict(parms, N_MATSUBARA=grid_slices // 2, error_analysis=True,
+                    work_dir=os.path.join(parms['work_dir'],
+                                          'L{}'.format(grid_slices)))
+        grid_tau = tau_wn_setup(grid)[0]
+        grid['dtau_mc'] = grid_tau[1]
+        g0 = []
+        for gb in g0_blocks:
+            g_beta = -np.eye(gb.shape[0]) - gb[..., 0] if gb.ndim == 3 \
+                else None
+            g0.append(gt_spline(gb, tau, g_beta)(grid_tau))
+        v = ising_v(grid['dtau_mc'], grid['U'],
+                    grid_slices * grid['SITES'], interaction.shape[1],
+                    grid.get('spin_polarization', .5))
+        errors = imp_solver_results(g0, v, interaction, grid,
+                                    grid_comm)['errors']
+
+        gtau = errors['gtau']['mean']
+        g_beta = -np.eye(gtau.shape[1]) - gtau[..., 0]
+        gerr = errors['gtau']['error']
+        errors['gtau'] = {'mean': gt_spline(gtau, grid_tau, g_beta)(tau),
+                          'error': np.abs(gt_spline(gerr, grid_tau,
+                                                    gerr[..., 0])(tau))}
+        return {name: {'value': errors[name]['mean'],
+                       'error': errors[name]['error']}
+                for name in ('gtau', 'occupation', 'double_occ')}
+
+    if threaded_collectives(group):
+        with ThreadPoolExecutor(max(len(mine), 1)) as pool:
+            solved = list(pool.map(lambda i, gc: solve(slices[i], gc),
+                                   mine, grid_comms))
+    else:
+        solved = [solve(slices[i], gc) for i, gc in zip(mine, grid_comms)]
+    for grid_comm in grid_comms:
+        grid_comm.Free()
+
+    grids = {}
+    for part in comm.allgather(dict(zip(mine, solved))
+                               if group.rank == 0 else {}):
+        grids.update(part)
+    group.Free()
+    grids = [grids[i] for i in range(len(slices))]
+    dtau = parms['BETA'] / np.asarray(slices, dtype=float)
+
+    result = {'grids': grids, 'dtau': dtau}
+    for name in ('gtau', 'occupation', 'double_occ'):
+        value, error = dtau2_extrapolation(
+            dtau, [grid[name]['value'] for grid in grids],
+            [grid[name]['error'] for grid in grids])
+        result[name] = {'value': value, 'error': error}
 
     if comm.rank == 0:
-        save_output(parms, occupation / comm.Get_size(),
-                    double_occ / comm.Get_size(), acc, chi, vlog, ar)
+        np.savez(os.path.join(parms['work_dir'], 'trotter'), dtau=dtau,
+                 **{name + '_' + key: val
+                    for name in ('gtau', 'occupation', 'double_occ')
+                    for key, val in result[name].items()})
+    return result
 
-    # Recover Conventional GF sign in average
-    return [-1 * avg_g(gst, parms) for gst in Gst]
 
+def dtau2_extrapolation(dtau, values, errors):
+    r"""Weighted least squares fit of :math:`a + b\Delta\tau^2` to
+    observables measured at several Trotter steps
+
+    Parameters
+    ----------
+    dtau : 1D ndarray
+        Trotter steps
+    values : list of ndarrays
+        Observable at each Trotter step
+    errors : list of ndarrays
+        Statistical error of each value
+
+    Returns
+    -------
+    tuple of ndarrays : extrapolation to :math:`\Delta\tau=0` and its
+        error
+    """
+    x = np.asarray(dtau)**2
+    x = x.reshape((-1,) + (1,) * np.ndim(values[0]))
+    values = np.asarray(values)
+    errors = np.asarray(errors)
+    if len(x) == 1:
+        return values[0], errors[0]
+    weight = 1 / np.maximum(errors, 1e-100)**2
+    scale = weight.max(0)
+    weight = weight / scale
+    s_0, s_x, s_xx = [np.sum(weight * x**k, 0) for k in range(3)]
+    s_y, s_xy = [np.sum(weight * x**k * values, 0) for k in range(2)]
+    det = s_0 * s_xx - s_x**2
+    return (s_xx * s_y - s_x * s_xy) / det, np.sqrt(s_xx / det / scale)
+
+
+def adapt_clean_interval(interval, drift, tol, limit):
+    """Returns the number of sweeps until the next clean update of the
+    Green functions given the drift accumulated by the fast updates during
+    the last interval. It is halved when the drift exceeds tol and doubled
+    up to limit when it stays an order of magnitude below it"""
+    if drift > tol:
+        return max(1, interval // 2)
+    if drift < tol / 10:
+        return min(2 * interval, limit)
+    return interval
+
+
+def precision_check(g0_blocks, v, interaction, parms_user, sweeps=None):
+    r"""Compares the single precision sweeps against the double precision
+    ones
+
+    Two copies of a Markov chain start from the same Ising fields and
+    random generator seed, one updating float32 Green functions and the
+    other float64 ones, and run parms['clean_interval'] sweeps without clean
+    updates. As long as both accept the same spin flips their Green
+    functions are compared, and after every sweep the float32 ones are
+    compared against a clean double precision recomputation for their
+    fields.
+
+    For a half filled single site at U=2.5-3, 32 to 64 time slices, a
+    float32 sweep drifts by about :math:`10^{-5}` from the exact Green
+    function, and the drift grows unevenly to :math:`10^{-3}` within tens
+    of sweeps and :math:`10^{-2}` over 500, against :math:`10^{-11}` in
+    float64. Still both chains accept the very same flips all along, so
+    float32 sweeps sample the same distribution and serve the
+    thermalization, while the measurements want a clean interval of some
+    tens of sweeps, a parms['drift_tol'] of about :math:`10^{-4}`, or
+    double precision.
+
+    Parameters
+    ----------
+    g0_blocks : list of ndarrays
+        Weiss fields as for imp_solver, they must be real
+    v : 2D ndarray
+        Ising fields, not modified
+    interaction : 2D ndarray
+        Interaction matrix between spin species and Ising fields
+    parms_user : dictionary
+        Simulation parameters
+    sweeps : int
+        Defaults to parms['clean_interval']
+
+    Returns
+    -------
+    dict
+        'drift' and 'drift64' hold after every sweep the largest deviation
+        of the fast updated float32 and float64 Green functions from clean
+        ones. 'deviation' the largest difference between the float32 and
+        float64 Green functions and 'agree' the number of sweeps both
+        chains accepted the same flips
+    """
+    parms = solver_parms(parms_user)
+    if sweeps is None:
+        sweeps = parms['clean_interval']
+    GX = [retarded_weiss(gb) for gb in g0_blocks]
+    ntau = 2 * parms['N_MATSUBARA']
+    kroneker = np.eye(GX[0].shape[0])
+    i_pairs = field_pairs(interaction)
+
+    out = {'drift': [], 'drift64': [], 'deviation': [], 'agree': 0}
+    chains = {}
+    for dtype in (np.float32, np.float64):
+        fields = np.copy(v)
+        g = block_stack([gnewclean(g_sp, lv, kroneker)
+                         for g_sp, lv in zip(GX, np.dot(interaction, fields))],
+                        dtype)
+        chains[dtype] = (g, fields, hffast.Rng(parms['SEED']))
+
+    for _ in range(sweeps):
+        for dtype, (g, fields, rng) in chains.items():
+            hffast.updateDHS_fields(g, fields, i_pairs, ntau, parms['delay'],
+                                    parms['double_flip_prob'],
+                                    parms['Heat_bath'], rng,
+                                    parms['cluster_size'])
+        for dtype, key in ((np.float32, 'drift'), (np.float64, 'drift64')):
+            g, fields, _ = chains[dtype]
+            out[key].append(max(
+                np.abs(gnewclean(g_sp, lv, kroneker) - gb).max()
+                for g_sp, lv, gb in zip(GX, np.dot(interaction, fields), g)))
+        g32, v32, _ = chains[np.float32]
+        g64, v64, _ = chains[np.float64]
+        if out['agree'] == len(out['drift']) - 1 and \
+                np.array_equal(v32, v64):
+            out['agree'] += 1
+            out['deviation'].append(max(np.abs(g_s - g_d).max()
+                                        for g_s, g_d in zip(g32, g64)))
+
+    return {key: np.array(val) for key, val in out.items()}
+
+
+def measure_chi(g, chi, slices):
+    r"""Accumulates the local spin correlator
+
+    .. math:: \chi(\tau_d) = \frac{1}{L}\sum_l
+        \langle S_z(\tau_{l+d}) S_z(\tau_l) \rangle
+
+    averaged over the sites, with :math:`S_z=(n_\uparrow - n_\downarrow)/2`
+    summed over the bands. By Wick's theorem in every Ising field
+    configuration it is the cyclic autocorrelation of the magnetization
+    diagonal of G, done with a FFT, plus the exchange term of each spin
+    block computed by hffast.spin_exchange.
+
+    Parameters
+    ----------
+    g : list of 2D ndarrays
+        Hirsch-Fye Green function matrices, blocks alternate spin up and
+        down
+    chi : 1D ndarray
+        Accumulator of :math:`\chi(\tau)` with one entry per time slice
+    slices : int
+        Number of time slices
+    """
+    sites = g[0].shape[0] // slices
+    spin = np.resize([.5, -.5], len(g))
+    moment = sum(s * np.diag(gb).real.reshape(sites, slices)
+                 for s, gb in zip(spin, g))
+    moment_w = np.fft.rfft(moment)
+    corr = np.fft.irfft(np.abs(moment_w)**2, slices).sum(0)
+    exchange = np.zeros(slices)
+    hffast.spin_exchange(g, exchange, slices)
+    chi += (corr + exchange / 4) / (slices * sites)
 
-@numba.jit(nopython=True)
-def measure_chi(v, slices):
-    """Estimates the susceptibility from the Ising auxiliary fields"""
-    chi = np.zeros(slices)
-    s = np.sign(v)
-    for i in range(slices):
-        for j in range(slices):
-            k = i + j
-            if k > slices:
-                k -= slices  # Ising fields are bosonic and have PBC
-            chi[i] += s[k] * s[j]
 
-    return chi
+def susceptibility(chi_tau, beta):
+    r"""Bosonic Matsubara transform of the spin correlator
 
+    .. math:: \chi(i\nu_n) = \int_0^\beta e^{i\nu_n\tau}\chi(\tau)d\tau
 
-def orbital_occupation(g, occupation, slices, flavors_ind):
-    """Calculates the orbital occupation
+    with :math:`\nu_n = 2\pi n/\beta`. :math:`\chi(\tau)` is periodic,
+    thus the rectangle rule on the time slices is the trapezoidal one.
 
-    It is relevant to remember that under this Hirsh-Fye simulation
-    the signs of the Green functions are reversed and that after this
-    observable is calculated g(0+) one has to apply n= 1-g(0+) """
+    Parameters
+    ----------
+    chi_tau : 1D ndarray
+        :math:`\chi(\tau)` on the time slices :math:`\tau_l=l\beta/L`
+    beta : float
+        Inverse temperature
+
+    Returns
+    -------
+    1D ndarray : :math:`\chi(i\nu_n)` for :math:`n=0\ldots L/2`
+    """
+    slices = len(chi_tau)
+    return np.fft.rfft(chi_tau).real * beta / slices
 
-    for k, (spin_i, site_i) in enumerate(flavors_ind):
-        g_i = g[spin_i][
-            site_i * slices:(site_i + 1) * slices, site_i * slices:(site_i + 1) * slices]
-        occupation[k] += np.trace(g_i)
 
+def field_pairs(interaction):
+    """Green function blocks coupled by each Ising field, with the
+    positive sign first, as an array of shape (fields, 2)"""
+    pairs = [np.argsort(-c)[[0, -1]] for c in interaction.T]
+    return np.array(pairs, np.intp).reshape(-1, 2)
 
-def double_occupation(g, double_occ, slices, flavor_pairs):
-    """Calculates the density-density correlator between spin flavors"""
-    for k, (i, j) in enumerate(flavor_pairs):
-        spin_i, site_i = i
-        g_i = g[spin_i][
-            site_i * slices:(site_i + 1) * slices, site_i * slices:(site_i + 1) * slices]
-        spin_j, site_j = j
-        g_j = g[spin_j][
-            site_j * slices:(site_j + 1) * slices, site_j * slices:(site_j + 1) * slices]
-        double_occ[k] += np.einsum('ii,ii', g_i, g_j)
 
+def block_partners(interaction, blocks):
+    """Lists for every Green function block those whose density it
+    interacts with through the Ising fields"""
+    i_pairs = field_pairs(interaction)
+    return [[dw if up == blk else up for up, dw in i_pairs if blk in (up, dw)]
+            for blk in range(blocks)]
 
-def susceptibility(v):
-    """Calculate the susceptibility from the Ising fields"""
-    pass
 
+def improved_sigma(f_tau, g_tau, n_partner, flavors, U, beta):
+    r"""Self-energy from the improved estimator [bulla]_
 
-def save_output(params, occupation, double_occ, acceptance, chi, vlog, ar):
+    .. math:: \Sigma(i\omega_n) = U F(i\omega_n) G^{-1}(i\omega_n)
+        - \frac{U}{2} k
+
+    with :math:`F(\tau) = -\sum_{\bar{\sigma}}\langle T
+    n_{\bar{\sigma}}(\tau) c_\sigma(\tau) c^\dagger_\sigma(0)\rangle`
+    summed over the k flavors interacting with :math:`\sigma`, the
+    :math:`-U/2` per flavor comes from the particle-hole symmetric form of
+    the interaction. The estimator avoids the inversion of the bath
+    Green function, so it does not amplify the statistical noise of
+    :math:`G` at high frequencies as the Dyson equation does. Both
+    functions are transformed with the same time slices, their first
+    moments are 1 and :math:`n_{\bar{\sigma}}`. With the density centered
+    on the interaction vertex, see `hffast.measure_f`, it agrees with the
+    Dyson self-energy up to the second order Trotter error.
+
+    Parameters
+    ----------
+    f_tau : ndarray
+        :math:`F(\tau)` of shape (blocks, SITES, SITES, slices)
+    g_tau : ndarray
+        :math:`G(\tau)` of the same shape
+    n_partner : 2D ndarray
+        density of the flavors interacting with each block and site
+    flavors : list of int
+        number k of flavors interacting with each block
+    U : float
+        Local interaction
+    beta : float
+        Inverse temperature
+
+    Returns
+    -------
+    complex ndarray : :math:`\Sigma(i\omega_n)` of shape (blocks, SITES,
+        SITES, slices/2)
+
+    References
+    ----------
+    .. [bulla] R. Bulla, A. C. Hewson and Th. Pruschke, J. Phys.: Condens.
+       Matter 10, 8365 (1998)
+    """
+    slices = g_tau.shape[-1]
+    sites = g_tau.shape[1]
+    tau = np.arange(slices) * beta / slices
+    w_n = np.pi * (1 + 2 * np.arange(slices // 2)) / beta
+    eye = np.eye(sites)[..., None]
+    g_iw = gt_fouriertrans(g_tau, tau, w_n, [eye, 0., 0.])
+    f_iw = gt_fouriertrans(f_tau, tau, w_n,
+                           [n_partner[..., None, None] * eye, 0., 0.])
+    # Sigma = F G^-1 frequency by frequency, as solve(G^T, F^T)^T
+    g_iw = np.moveaxis(g_iw, -1, 1).swapaxes(-1, -2)
+    f_iw = np.moveaxis(f_iw, -1, 1).swapaxes(-1, -2)
+    sigma = np.linalg.solve(g_iw, f_iw).swapaxes(-1, -2)
+    sigma -= .5 * np.reshape(flavors, (-1, 1, 1, 1)) * np.eye(sites)
+    return U * np.moveaxis(sigma, 1, -1)
+
+
+def save_output(params, occupation, double_occ, acceptance, chi, vlog, ar,
+                drift=None, errors=None, gl=None, stats=None):
     """Saves the simulation status"""
     if not os.path.exists(params['work_dir']):
         os.makedirs(params['work_dir'])
@@ -214,13 +1452,25 @@ def save_output(params, occupation, double_occ, acceptance, chi, vlog, ar):
     np.save(params['work_dir'] + '/double_occ', double_occ)
     np.save(params['work_dir'] + '/acceptance', acceptance)
     np.save(params['work_dir'] + '/chi', chi)
+    np.save(params['work_dir'] + '/chi_iw', susceptibility(chi, params['BETA']))
+    if drift is not None:
+        np.save(params['work_dir'] + '/drift', drift)
+    if gl is not None:
+        np.save(params['work_dir'] + '/gl', gl)
+    if stats is not None:
+        stats.save(params['work_dir'] + '/stats.npz')
+    if errors is not None:
+        np.savez(params['work_dir'] + '/errors',
+                 **{name + '_' + key: val
+                    for name, stats in errors.items()
+                    for key, val in stats.items()})
 
     if params['save_logs']:
         np.save(params['work_dir'] + '/v_ising', np.asarray(vlog))
         np.save(params['work_dir'] + '/acceptance_log', np.asarray(ar))
 
 
-def retarded_weiss(g0tau):
+def retarded_weiss(g0tau, out=None):
     r"""
     Takes the propagator :math:`\mathcal{G}^0(\tau)` corresponding to the
     Weiss mean field of the electronic bath and transforms it
@@ -233,54 +1483,86 @@ def retarded_weiss(g0tau):
     matrix expresion. :math:`\alpha,\beta` block indices :math:`i,j` indices
     within the blocks
 
+    Every block is a Toeplitz matrix, it is read as a sliding window over
+    the antiperiodic extension of :math:`\mathcal{G}^0(\tau)` and copied
+    in a single operation, without index matrices.
+
     Parameters
     ----------
-    g0tau : 3D ndarray, of retarded weiss field
-        First axis numerical values, second and third axis are block indices
-    """
-    g0t_shape = g0tau.shape
-    if len(g0t_shape) > 1:
-        n1, n2, slices = g0t_shape
-    else:
-        n1, n2, slices = 1, 1, g0t_shape[0]
-        g0tau = g0tau.reshape(1, 1, -1)
-
-    delta_tau = np.arange(slices)
-
-    gind = slices + np.subtract.outer(delta_tau, delta_tau)
-    g0t_mat = np.empty((slices * n1, slices * n2), g0tau.dtype)
-
-    for i in range(n1):
-        for j in range(n2):
-            g0t_mat[i * slices:(i + 1) * slices,
-                    j * slices:(j + 1) * slices] = np.concatenate(
-                        (g0tau[i, j], -g0tau[i, j]))[gind]
-    return g0t_mat
-
-
-def avg_gblock(gmat):
-    """Averages along the diagonals respecting the translational invariance of
-    the Greens Function"""
+    g0tau : ndarray, of retarded weiss field
+        Last axis numerical values, the two before it block indices. A 1D
+        array is a single block and a 2D one a stack of single site
+        blocks. A 4D array is a stack of blocks along its first axis, all
+        of them are built at once
+    out : ndarray, optional
+        C ordered buffer of the shape and dtype of the result to write it
+        into, else a ValueError is raised
 
-    slices = gmat.shape[0]
-    xga = np.zeros(2 * slices, gmat.dtype)
-    for i in range(2 * slices):
-        xga[i] = np.trace(gmat, offset=slices - i)
+    Returns
+    -------
+    ndarray : of shape (slices * n1, slices * n2), preceded by the stack
+        axis if there is one
+    """
+    g0tau = np.asarray(g0tau)
+    if g0tau.ndim < 3:
+        g0tau = g0tau[..., None, None, :]
+    stack = g0tau.shape[:-3]
+    n1, n2, slices = g0tau.shape[-3:]
+
+    # window[..., r, c] = rev[slices - 1 - r + c] = -g0tau(r - c) antiperiodic
+    rev = np.concatenate((-g0tau[..., ::-1], g0tau[..., ::-1]), -1)
+    step = rev.strides[-1]
+    window = np.lib.stride_tricks.as_strided(
+        rev[..., slices - 1:], stack + (n1, n2, slices, slices),
+        rev.strides[:-1] + (-step, step), writeable=False)
+
+    shape = stack + (slices * n1, slices * n2)
+    if out is None:
+        out = np.empty(shape, g0tau.dtype)
+    elif out.shape != shape or out.dtype != g0tau.dtype or \
+            not out.flags.c_contiguous:
+        raise ValueError('out must be a C ordered array of shape {} and '
+                         'dtype {}'.format(shape, g0tau.dtype))
+    out.reshape(stack + (n1, slices, n2, slices))[:] = \
+        window.swapaxes(-3, -2)
+    return out
+
+
+class ToeplitzWeiss(object):
+    r"""Retarded Weiss field matrix kept as its generating vector
+
+    Stands in for the dense matrix of :func:`retarded_weiss`, with its
+    shape and dtype, and only builds it when converted to an array, as
+    :func:`gnewclean` does. The dense matrix is thus held just during the
+    clean updates.
 
-    xg = (xga[slices:] - xga[:slices]) / slices
+    Parameters
+    ----------
+    g0tau : ndarray
+        Weiss field :math:`\mathcal{G}^0(\tau)` of one block as for
+        retarded_weiss
+    """
 
-    return xg
+    def __init__(self, g0tau):
+        g0tau = np.array(g0tau)
+        self.generator = g0tau.reshape((1, 1) + g0tau.shape[-1:]) \
+            if g0tau.ndim == 1 else g0tau
+        n1, n2, slices = self.generator.shape
+        self.shape = (slices * n1, slices * n2)
+        self.dtype = self.generator.dtype
+        self.ndim = 2
 
+    def dense(self, out=None):
+        """Dense retarded Weiss field matrix"""
+        return retarded_weiss(self.generator, out)
 
-def avg_g(gst, parms):
-    n1, n2, slices = parms['SITES'], parms['SITES'], parms['N_MATSUBARA'] * 2
+    def first_column(self):
+        """First column of the dense matrix"""
+        return -self.generator[:, 0].ravel()
 
-    gst_m = np.empty((n1, n2, slices), gst.dtype)
-    for i in range(n1):
-        for j in range(n2):
-            gst_m[i, j] = avg_gblock(gst[i * slices:(i + 1) * slices,
-                                         j * slices:(j + 1) * slices])
-    return gst_m
+    def __array__(self, dtype=None, copy=None):
+        gmat = self.dense()
+        return gmat if dtype is None else gmat.astype(dtype)
 
 
 def gnewclean(g0t, v, kroneker):
@@ -299,6 +1581,7 @@ def gnewclean(g0t, v, kroneker):
     the vector :math:`v_j` contains the effective Ising fields. For
     multiorbital systems it asumes that it is already the fields addition
     """
+    g0t = np.asarray(g0t)
     u_j = np.exp(v) - 1.
     b = kroneker - u_j * (g0t - kroneker)
 
@@ -371,6 +1654,75 @@ def interaction_matrix(bands):
     return int_matrix
 
 
+class DensityControl(object):
+    r"""Chemical potential update towards a target density
+
+    Every DMFT iteration the measured density :math:`n` moves the chemical
+    potential by a secant step
+
+    .. math:: \mu \leftarrow \mu + w \frac{n_0 - n}{\partial n/\partial\mu}
+
+    where the compressibility :math:`\partial n/\partial\mu` is a
+    Broyden estimate, updated with the secant of the last two iterations
+    only when their densities differ by more than twice their statistical
+    error and the secant is positive. The weight
+
+    .. math:: w = \text{damping}\frac{(n_0 - n)^2}{(n_0 - n)^2 +
+        \sigma_n^2}
+
+    shrinks the steps once the deviation is within the noise, so the
+    chemical potential settles instead of following the Monte Carlo
+    fluctuations. Steps are capped at max_step.
+
+    Parameters
+    ----------
+    target : float
+        Density to reach
+    mu : float
+        Starting chemical potential
+    dndmu : float
+        Initial guess of the compressibility
+    damping : float
+        Fraction of the secant step taken
+    max_step : float
+        Largest change of the chemical potential in one update
+    """
+
+    def __init__(self, target, mu, dndmu=1., damping=.5, max_step=.5):
+        self.target = target
+        self.mu = mu
+        self.dndmu = dndmu
+        self.damping = damping
+        self.max_step = max_step
+        self.history = []
+
+    def update(self, density, error=0.):
+        """Records the density measured at the current chemical potential
+        and returns the next one"""
+        if self.history:
+            mu_prev, n_prev, err_prev = self.history[-1]
+            dmu, dn = self.mu - mu_prev, density - n_prev
+            if dmu != 0 and abs(dn) > 2 * np.hypot(error, err_prev) and \
+                    dn / dmu > 0:
+                self.dndmu += self.damping * (dn / dmu - self.dndmu)
+        self.history.append((self.mu, density, error))
+
+        deviation = self.target - density
+        weight = self.damping * deviation**2 / (deviation**2 + error**2) \
+            if deviation else 0.
+        step = weight * deviation / self.dndmu
+        self.mu += float(np.clip(step, -self.max_step, self.max_step))
+        return self.mu
+
+    def converged(self, tol):
+        """Whether the last density is within tol, or twice its error, of
+        the target"""
+        if not self.history:
+            return False
+        _, density, error = self.history[-1]
+        return abs(density - self.target) <= max(tol, 2 * error)
+
+
 def setup_PM_sim(parms):
     """Setup the default state for a Paramagnetic simulation"""
     tau, w_n = tau_wn_setup(parms)
@@ -409,6 +1761,68 @@ def do_input(help_string):
                         help='Monte Carlo sweeps of thermalization')
     parser.add_argument('-meas', type=int, default=3,
                         help='Number of Updates before measurements')
+    parser.add_argument('-clean_interval', type=int, default=500,
+                        help='Sweeps between recalculations of the Green '
+                        'function from scratch')
+    parser.add_argument('-drift_tol', type=float, default=0.,
+                        help='If positive adapt the clean interval, up to '
+                        '8 times -clean_interval, to keep the drift of the '
+                        'fast updates below this value')
+    parser.add_argument('-checkpoint', type=int, default=0,
+                        help='Sweeps between checkpoints of the Markov chains'
+                        ' from which an interrupted run resumes. 0 disables')
+    parser.add_argument('-target_error', type=float, default=0.,
+                        help='Statistical error at which to stop sampling, '
+                        'sweeps then caps the thermalization and '
+                        'measurements. 0 runs the fixed sweep count')
+    parser.add_argument('-target_observable', default='gtau',
+                        choices=['gtau', 'double_occ'],
+                        help='Observable whose error is targeted')
+    parser.add_argument('-check_interval', type=int, default=100,
+                        help='Sweeps between checks of the error target')
+    parser.add_argument('-chi_interval', type=int, default=10,
+                        help='Measurements between accumulations of the '
+                        'local spin susceptibility. 0 disables')
+    parser.add_argument('-legendre', type=int, default=0,
+                        help='Number of Legendre coefficients to reduce and '
+                        'store G(tau) in. 0 keeps the time slices')
+    parser.add_argument('-swap_interval', type=int, default=10,
+                        help='Sweeps between replica exchanges when '
+                        'tempering')
+    parser.add_argument('-warm_start', default='',
+                        help='Work directory of a previous run whose Ising '
+                        'configurations start the Markov chains')
+    parser.add_argument('-warm_therm', type=int, default=200,
+                        help='Thermalization sweeps of warm started chains')
+    parser.add_argument('-cluster_size', type=int, default=2,
+                        help='Sites flipped together at one time slice by '
+                        'the cluster moves of double_flip_prob, 0 for all')
+    parser.add_argument('-precision', default='double',
+                        choices=['double', 'single', 'therm'],
+                        help='Precision of the Green functions during the '
+                        'sweeps, therm keeps single precision for the '
+                        'thermalization only')
+    parser.add_argument('-improved_sigma', action='store_true',
+                        help='Measure the self-energy with the improved '
+                        'estimator, returned after the Green functions')
+    parser.add_argument('-toeplitz_weiss', action='store_true',
+                        help='Keep the retarded Weiss fields as generating '
+                        'vectors and build the dense matrices only for the '
+                        'clean updates')
+    parser.add_argument('-python_driver', dest='compiled_driver',
+                        action='store_false',
+                        help='Run every sweep from Python instead of the '
+                        'compiled driver between the measurement points')
+    parser.add_argument('-chains', type=int, default=1,
+                        help='Independent Markov chains run in threads '
+                        'by every MPI process')
+    parser.add_argument('-backend', default='threads',
+                        choices=['threads', 'processes'],
+                        help='Pool running the Markov chains of every MPI '
+                        'process')
+    parser.add_argument('-delay', type=int, default=1,
+                        help='Accepted spin flips accumulated before they '
+                        'are applied to the Green function as one update')
     parser.add_argument('-Niter', metavar='N', type=int,
                         default=20, help='Number of iterations')
     parser.add_argument('-U', '--urange', nargs='+', type=float, default=[2.5],
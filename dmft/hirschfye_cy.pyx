@@ -5,32 +5,171 @@ cimport numpy as np
 import cython
 from libc.math cimport exp, sqrt
 from libcpp cimport bool
+from libc.string cimport memcpy
 
 
-cdef extern from "hfc.h":
+cdef extern from "hfc.h" nogil:
     void cgnew(size_t N, double *g, double dv, size_t k)
     void cg2flip(size_t N, double *g, double *dv, size_t l, size_t k)
+    double cdelayed_diag(size_t N, double *g, double *X, double *Yt, size_t m,
+                         size_t k)
+    void cdelayed_push(size_t N, double *g, double *X, double *Yt, size_t m,
+                       double dv, size_t k)
+    void cdelayed_flush(size_t N, double *g, double *X, double *Yt, size_t m)
 
-def gnew(np.ndarray[np.float64_t, ndim=2] g, double dv, size_t k):
+    void sgnew(size_t N, float *g, double dv, size_t k)
+    void sg2flip(size_t N, float *g, double *dv, size_t l, size_t k)
+    float sdelayed_diag(size_t N, float *g, float *X, float *Yt, size_t m,
+                        size_t k)
+    void sdelayed_push(size_t N, float *g, float *X, float *Yt, size_t m,
+                       double dv, size_t k)
+    void sdelayed_flush(size_t N, float *g, float *X, float *Yt, size_t m)
+
+    void zgnew(size_t N, double complex *g, double dv, size_t k)
+    void zg2flip(size_t N, double complex *g, double *dv, size_t l, size_t k)
+    double complex zdelayed_diag(size_t N, double complex *g,
+                                 double complex *X, double complex *Yt,
+                                 size_t m, size_t k)
+    void zdelayed_push(size_t N, double complex *g, double complex *X,
+                       double complex *Yt, size_t m, double dv, size_t k)
+    void zdelayed_flush(size_t N, double complex *g, double complex *X,
+                        double complex *Yt, size_t m)
+
+    double ckflip_ratio(size_t N, double *g, double *dv, size_t *l, size_t k,
+                        double *U, double *mat, int *ipiv)
+    void ckflip_update(size_t N, double *g, size_t *l, size_t k, double *U,
+                       double *V, double *mat, int *ipiv)
+    float skflip_ratio(size_t N, float *g, double *dv, size_t *l, size_t k,
+                       float *U, float *mat, int *ipiv)
+    void skflip_update(size_t N, float *g, size_t *l, size_t k, float *U,
+                       float *V, float *mat, int *ipiv)
+    double complex zkflip_ratio(size_t N, double complex *g, double *dv,
+                                size_t *l, size_t k, double complex *U,
+                                double complex *mat, int *ipiv)
+    void zkflip_update(size_t N, double complex *g, size_t *l, size_t k,
+                       double complex *U, double complex *V,
+                       double complex *mat, int *ipiv)
+
+    int cgclean(size_t N, double *g0t, double *v, double *g, double *a,
+                double *x, int *ipiv, double *drift)
+    int zgclean(size_t N, double complex *g0t, double *v, double complex *g,
+                double complex *a, double complex *x, int *ipiv,
+                double *drift)
+
+# Green functions of real or complex Weiss fields, every kernel below
+# dispatches on it to the BLAS d or z routines. Single precision real ones
+# run the s routines of the mixed precision sweeps
+ctypedef fused scalar:
+    float
+    double
+    double complex
+
+# The clean updates solve in double precision only
+ctypedef fused dscalar:
+    double
+    double complex
+
+cdef inline double real(scalar x) noexcept nogil:
+    if scalar is double or scalar is float:
+        return x
+    else:
+        return x.real
+
+cdef inline void fgnew(size_t N, scalar *g, double dv, size_t k) noexcept nogil:
+    if scalar is double:
+        cgnew(N, g, dv, k)
+    elif scalar is float:
+        sgnew(N, g, dv, k)
+    else:
+        zgnew(N, g, dv, k)
+
+cdef inline void fg2flip(size_t N, scalar *g, double *dv,
+                         size_t l, size_t k) noexcept nogil:
+    if scalar is double:
+        cg2flip(N, g, dv, l, k)
+    elif scalar is float:
+        sg2flip(N, g, dv, l, k)
+    else:
+        zg2flip(N, g, dv, l, k)
+
+cdef inline scalar fdelayed_diag(size_t N, scalar *g, scalar *X, scalar *Yt,
+                                 size_t m, size_t k) noexcept nogil:
+    if scalar is double:
+        return cdelayed_diag(N, g, X, Yt, m, k)
+    elif scalar is float:
+        return sdelayed_diag(N, g, X, Yt, m, k)
+    else:
+        return zdelayed_diag(N, g, X, Yt, m, k)
+
+cdef inline void fdelayed_push(size_t N, scalar *g, scalar *X, scalar *Yt,
+                               size_t m, double dv, size_t k) noexcept nogil:
+    if scalar is double:
+        cdelayed_push(N, g, X, Yt, m, dv, k)
+    elif scalar is float:
+        sdelayed_push(N, g, X, Yt, m, dv, k)
+    else:
+        zdelayed_push(N, g, X, Yt, m, dv, k)
+
+cdef inline void fdelayed_flush(size_t N, scalar *g, scalar *X, scalar *Yt,
+                                size_t m) noexcept nogil:
+    if scalar is double:
+        cdelayed_flush(N, g, X, Yt, m)
+    elif scalar is float:
+        sdelayed_flush(N, g, X, Yt, m)
+    else:
+        zdelayed_flush(N, g, X, Yt, m)
+
+cdef inline scalar fkflip_ratio(size_t N, scalar *g, double *dv, size_t *l,
+                                size_t k, scalar *U, scalar *mat,
+                                int *ipiv) noexcept nogil:
+    if scalar is double:
+        return ckflip_ratio(N, g, dv, l, k, U, mat, ipiv)
+    elif scalar is float:
+        return skflip_ratio(N, g, dv, l, k, U, mat, ipiv)
+    else:
+        return zkflip_ratio(N, g, dv, l, k, U, mat, ipiv)
+
+cdef inline void fkflip_update(size_t N, scalar *g, size_t *l, size_t k,
+                               scalar *U, scalar *V, scalar *mat,
+                               int *ipiv) noexcept nogil:
+    if scalar is double:
+        ckflip_update(N, g, l, k, U, V, mat, ipiv)
+    elif scalar is float:
+        skflip_update(N, g, l, k, U, V, mat, ipiv)
+    else:
+        zkflip_update(N, g, l, k, U, V, mat, ipiv)
+
+cdef inline int fgclean(size_t N, dscalar *g0t, double *v, dscalar *g,
+                        dscalar *a, dscalar *x, int *ipiv,
+                        double *drift) noexcept nogil:
+    if dscalar is double:
+        return cgclean(N, g0t, v, g, a, x, ipiv, drift)
+    else:
+        return zgclean(N, g0t, v, g, a, x, ipiv, drift)
+
+def gnew(np.ndarray[scalar, ndim=2] g, double dv, size_t k):
     cdef int N=g.shape[0]
-    cgnew(N, &g[0,0], dv, k)
+    fgnew(N, &g[0,0], dv, k)
 
-def g2flip(np.ndarray[np.float64_t, ndim=2] g, double[::1] dv, size_t l, size_t k):
+def g2flip(np.ndarray[scalar, ndim=2] g, double[::1] dv, size_t l, size_t k):
     cdef int N=g.shape[0]
-    cg2flip(N, &g[0,0], &dv[0], l, k)
+    fg2flip(N, &g[0,0], &dv[0], l, k)
 
 
-cdef extern from "gsl/gsl_rng.h":
+cdef extern from "gsl/gsl_rng.h" nogil:
     ctypedef struct gsl_rng_type:
         pass
     ctypedef struct gsl_rng:
         pass
     gsl_rng_type *gsl_rng_mt19937
     gsl_rng *gsl_rng_alloc(gsl_rng_type * T)
+    void gsl_rng_free(gsl_rng *r)
+    void *gsl_rng_state(gsl_rng *r)
+    size_t gsl_rng_size(gsl_rng *r)
     double uniform "gsl_rng_uniform"(gsl_rng *r)
     void cyset_seed "gsl_rng_set"(gsl_rng *r, unsigned long int)
 
-cdef extern from "gsl/gsl_randist.h":
+cdef extern from "gsl/gsl_randist.h" nogil:
     double normal "gsl_ran_gaussian"(gsl_rng *r, double sigma)
 
 cdef gsl_rng *r = gsl_rng_alloc(gsl_rng_mt19937)
@@ -38,52 +177,611 @@ cdef gsl_rng *r = gsl_rng_alloc(gsl_rng_mt19937)
 def set_seed(seed):
     cyset_seed(r, seed)
 
+cdef bytes rng_get_state(gsl_rng *rng):
+    return (<char *> gsl_rng_state(rng))[:gsl_rng_size(rng)]
+
+cdef rng_set_state(gsl_rng *rng, bytes state):
+    if len(state) != gsl_rng_size(rng):
+        raise ValueError('Random generator state of wrong size')
+    memcpy(gsl_rng_state(rng), <char *> state, gsl_rng_size(rng))
+
+def get_state():
+    return rng_get_state(r)
+
+def set_state(bytes state):
+    rng_set_state(r, state)
+
+
+cdef class Rng:
+    """Random number generator state of one Markov chain, to be used
+    instead of the module wide generator when running chains in threads"""
+    cdef gsl_rng *r
+
+    def __cinit__(self, unsigned long seed=0):
+        self.r = gsl_rng_alloc(gsl_rng_mt19937)
+        cyset_seed(self.r, seed)
+
+    def __dealloc__(self):
+        if self.r is not NULL:
+            gsl_rng_free(self.r)
+
+    def set_seed(self, unsigned long seed):
+        cyset_seed(self.r, seed)
+
+    def uniform(self):
+        return uniform(self.r)
+
+    def get_state(self):
+        return rng_get_state(self.r)
+
+    def set_state(self, bytes state):
+        rng_set_state(self.r, state)
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-def updateDHS(np.ndarray[np.float64_t, ndim=2] gup,
-              np.ndarray[np.float64_t, ndim=2] gdw,
-              np.ndarray[np.float64_t, ndim=1] v,
-              int subblock_len,
-              double double_flip_prob = 0.,
-              bool Heatbath = True):
-    cdef double dv, ratup, ratdw, rat
-    cdef int j, pair, sn, N=v.shape[0], acc = 0, nrat = 0
-    cdef int jns
-    cdef int[2] slic = [1, 1]
+cdef int sweep(size_t N, scalar *gup, scalar *gdw, double *v,
+               int subblock_len, double double_flip_prob, bool Heatbath,
+               size_t delay, scalar *Xup, scalar *Yup,
+               scalar *Xdw, scalar *Ydw, size_t cluster, scalar *work,
+               int *ipiv, size_t *sites, double *dvk, gsl_rng *rng,
+               int *nrat, int *accepted) noexcept nogil:
+    """One sweep over the Ising fields v. With delay > 1 the accepted
+    flips are accumulated in the X, Y buffers of the delayed update.
+    With probability double_flip_prob a cluster move instead flips the
+    field at the same time slice of cluster consecutive sites, its
+    Woodbury update runs in the work, ipiv, sites and dvk buffers.
+    For complex Green functions the real part of the weight ratio is
+    sampled and its negative values counted in nrat. Unless NULL,
+    accepted[j] counts the accepted moves proposed at site j"""
+    cdef double dv, rat
+    cdef scalar ratup, ratdw
+    cdef size_t j, f, m = 0
+    cdef int sn, acc = 0
+    cdef scalar *Uup = work
+    cdef scalar *Udw = work + N*cluster
+    cdef scalar *V = work + 2*N*cluster
+    cdef scalar *matup = work + 3*N*cluster
+    cdef scalar *matdw = matup + cluster*cluster
     sn = int(N/subblock_len)
     for j in range(N):
         dv = -2.*v[j]
-        ratup = 1. + (1. - gup[j, j])*(exp( dv)-1.)
-        ratdw = 1. + (1. - gdw[j, j])*(exp(-dv)-1.)
-        if uniform(r)>double_flip_prob:
-            rat = ratup * ratdw
+        if uniform(rng)>double_flip_prob:
+            if delay > 1:
+                ratup = 1. + (1. - fdelayed_diag(N, gup, Xup, Yup, m, j))*(exp( dv)-1.)
+                ratdw = 1. + (1. - fdelayed_diag(N, gdw, Xdw, Ydw, m, j))*(exp(-dv)-1.)
+            else:
+                ratup = 1. + (1. - gup[j*N + j])*(exp( dv)-1.)
+                ratdw = 1. + (1. - gdw[j*N + j])*(exp(-dv)-1.)
+            rat = real(ratup * ratdw)
             if rat<0:
-                nrat += 1
+                nrat[0] += 1
             if Heatbath:
                 rat = rat/(1.+rat)
 
-            if rat > uniform(r):
+            if rat > uniform(rng):
                 acc += 1
+                if accepted != NULL:
+                    accepted[j] += 1
                 v[j] *= -1.
-                cgnew(N, &gup[0,0],  dv, j)
-                cgnew(N, &gdw[0,0], -dv, j)
+                if delay > 1:
+                    fdelayed_push(N, gup, Xup, Yup, m,  dv, j)
+                    fdelayed_push(N, gdw, Xdw, Ydw, m, -dv, j)
+                    m += 1
+                    if m == delay:
+                        fdelayed_flush(N, gup, Xup, Yup, m)
+                        fdelayed_flush(N, gdw, Xdw, Ydw, m)
+                        m = 0
+                else:
+                    fgnew(N, gup,  dv, j)
+                    fgnew(N, gdw, -dv, j)
         elif sn > 1:
-            jns = j+subblock_len if j<subblock_len else j-subblock_len
-            dv = -2.*v[jns]
-            ratup *= 1. + (1. - gup[jns, jns])*(exp( dv)-1.)
-            ratdw *= 1. + (1. - gdw[jns, jns])*(exp(-dv)-1.)
-            rat = ratup * ratdw
+            if delay > 1:
+                fdelayed_flush(N, gup, Xup, Yup, m)
+                fdelayed_flush(N, gdw, Xdw, Ydw, m)
+                m = 0
+            for f in range(cluster):
+                sites[f] = ((j/subblock_len + f) % sn)*subblock_len + \
+                    j % subblock_len
+                dvk[f] = -2.*v[sites[f]]
+            ratup = fkflip_ratio(N, gup, dvk, sites, cluster, Uup, matup,
+                                 ipiv)
+            for f in range(cluster):
+                dvk[f] = -dvk[f]
+            ratdw = fkflip_ratio(N, gdw, dvk, sites, cluster, Udw, matdw,
+                                 ipiv + cluster)
+            rat = real(ratup * ratdw)
 
             if rat<0:
-                nrat += 1
+                nrat[0] += 1
             if Heatbath:
                 rat = rat/(1.+rat)
 
-            if rat > uniform(r):
+            if rat > uniform(rng):
                 acc += 1
-                slic = [j, jns]
-                v[slic] *= -1.
-                g2flip(gup,  2*v[slic], j, jns)
-                g2flip(gdw, -2*v[slic], j, jns)
+                if accepted != NULL:
+                    accepted[j] += 1
+                for f in range(cluster):
+                    v[sites[f]] *= -1.
+                fkflip_update(N, gup, sites, cluster, Uup, V, matup, ipiv)
+                fkflip_update(N, gdw, sites, cluster, Udw, V, matdw,
+                              ipiv + cluster)
+
+    if delay > 1:
+        fdelayed_flush(N, gup, Xup, Yup, m)
+        fdelayed_flush(N, gdw, Xdw, Ydw, m)
+    return acc
+
+
+def cluster_workspace(gup, size_t N, int subblock_len, int cluster):
+    """Buffers of the cluster moves of sweep, flipping cluster sites or
+    all of them if cluster is 0 or more than there are"""
+    sn = N // subblock_len
+    if cluster <= 0 or cluster > sn:
+        cluster = sn
+    cluster = max(cluster, 1)
+    return (cluster,
+            np.empty(3*N*cluster + 2*cluster*cluster, gup.dtype),
+            np.empty(2*cluster, np.intc),
+            np.empty(cluster, np.uintp),
+            np.empty(cluster))
+
+
+def updateDHS(np.ndarray[scalar, ndim=2] gup,
+              np.ndarray[scalar, ndim=2] gdw,
+              np.ndarray[np.float64_t, ndim=1, mode='c'] v,
+              int subblock_len,
+              double double_flip_prob = 0.,
+              bool Heatbath = True,
+              Rng rng = None,
+              int cluster = 2,
+              int[::1] accepted = None):
+    """Sweep over the Ising fields v updating the Green functions after
+    every accepted flip. double_flip_prob is the probability of cluster
+    moves flipping together cluster consecutive sites, all of them if 0.
+    The optional accepted array counts the accepted moves of each site"""
+    cdef int acc, nrat = 0
+    cdef int *pacc = NULL
+    cdef size_t N = v.shape[0]
+    cdef gsl_rng *cr = r if rng is None else rng.r
+    cdef scalar *pup = &gup[0,0]
+    cdef scalar *pdw = &gdw[0,0]
+    cdef double *pv = &v[0]
+    size, work, ipiv, sites, dvk = cluster_workspace(gup, N, subblock_len,
+                                                     cluster)
+    cdef np.ndarray[scalar, ndim=1] cwork = work
+    cdef int[::1] cipiv = ipiv
+    cdef size_t[::1] csites = sites
+    cdef double[::1] cdvk = dvk
+    cdef size_t csize = size
+    if accepted is not None:
+        pacc = &accepted[0]
+    with nogil:
+        acc = sweep(N, pup, pdw, pv, subblock_len, double_flip_prob,
+                    Heatbath, 1, NULL, NULL, NULL, NULL, csize, &cwork[0],
+                    &cipiv[0], &csites[0], &cdvk[0], cr, &nrat, pacc)
     return acc, nrat
+
+
+def updateDHS_delayed(np.ndarray[scalar, ndim=2] gup,
+                      np.ndarray[scalar, ndim=2] gdw,
+                      np.ndarray[np.float64_t, ndim=1, mode='c'] v,
+                      int subblock_len,
+                      int delay,
+                      double double_flip_prob = 0.,
+                      bool Heatbath = True,
+                      Rng rng = None,
+                      int cluster = 2,
+                      int[::1] accepted = None):
+    """Sweep as updateDHS but accumulates up to delay accepted spin flips
+    before applying them to the Green functions in a single rank-delay
+    update"""
+    cdef int acc, nrat = 0
+    cdef int *pacc = NULL
+    cdef size_t N = v.shape[0]
+    cdef gsl_rng *cr = r if rng is None else rng.r
+    cdef np.ndarray[scalar, ndim=2] Xup = np.empty((delay, N), gup.dtype)
+    cdef np.ndarray[scalar, ndim=2] Yup = np.empty((delay, N), gup.dtype)
+    cdef np.ndarray[scalar, ndim=2] Xdw = np.empty((delay, N), gup.dtype)
+    cdef np.ndarray[scalar, ndim=2] Ydw = np.empty((delay, N), gup.dtype)
+    cdef scalar *pup = &gup[0,0]
+    cdef scalar *pdw = &gdw[0,0]
+    cdef double *pv = &v[0]
+    cdef scalar *xup = &Xup[0,0]
+    cdef scalar *yup = &Yup[0,0]
+    cdef scalar *xdw = &Xdw[0,0]
+    cdef scalar *ydw = &Ydw[0,0]
+    size, work, ipiv, sites, dvk = cluster_workspace(gup, N, subblock_len,
+                                                     cluster)
+    cdef np.ndarray[scalar, ndim=1] cwork = work
+    cdef int[::1] cipiv = ipiv
+    cdef size_t[::1] csites = sites
+    cdef double[::1] cdvk = dvk
+    cdef size_t csize = size
+    if accepted is not None:
+        pacc = &accepted[0]
+    with nogil:
+        acc = sweep(N, pup, pdw, pv, subblock_len, double_flip_prob,
+                    Heatbath, delay, xup, yup, xdw, ydw, csize, &cwork[0],
+                    &cipiv[0], &csites[0], &cdvk[0], cr, &nrat, pacc)
+    return acc, nrat
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def updateDHS_fields(np.ndarray[scalar, ndim=3] g,
+                     np.ndarray[np.float64_t, ndim=2, mode='c'] v,
+                     np.intp_t[:, ::1] pairs,
+                     int subblock_len,
+                     int delay = 1,
+                     double double_flip_prob = 0.,
+                     bool Heatbath = True,
+                     Rng rng = None,
+                     int cluster = 2,
+                     int[:, ::1] accepted = None):
+    """Sweep over all the Ising fields, the rows of v, in one compiled
+    pass. Field i couples the Green function blocks pairs[i] of the stack
+    g, which take the updates of updateDHS, or of updateDHS_delayed when
+    delay > 1. Like for those every block g[b] must be Fortran contiguous
+    and they must follow each other in memory, as in the stacks of
+    hirschfye.block_stack. The optional accepted array counts the accepted moves of
+    each field and site. Returns the accepted moves and negative weights
+    of all fields"""
+    cdef int acc = 0, nrat = 0
+    cdef size_t i, fields = v.shape[0], N = v.shape[1]
+    cdef size_t buf = max(delay, 1)
+    cdef gsl_rng *cr = r if rng is None else rng.r
+    cdef np.ndarray[scalar, ndim=3] X = np.empty((4, buf, N), g.dtype)
+    cdef scalar *pg = &g[0, 0, 0]
+    cdef scalar *px = &X[0, 0, 0]
+    cdef double *pv = &v[0, 0]
+    cdef int *pacc = NULL
+    cdef int *facc = NULL
+    size, work, ipiv, sites, dvk = cluster_workspace(g[0], N, subblock_len,
+                                                     cluster)
+    cdef np.ndarray[scalar, ndim=1] cwork = work
+    cdef int[::1] cipiv = ipiv
+    cdef size_t[::1] csites = sites
+    cdef double[::1] cdvk = dvk
+    cdef size_t csize = size
+    if pairs.shape[0] != fields:
+        raise ValueError('One pair of blocks is needed per Ising field')
+    if g.shape[1] != N or g.shape[2] != N or \
+            (g.strides[0], g.strides[1], g.strides[2]) != \
+            (N*N*g.itemsize, g.itemsize, N*g.itemsize):
+        raise ValueError('Green function blocks must be a stack of '
+                         'Fortran ordered matrices')
+    for i in range(fields):
+        if not (0 <= pairs[i, 0] < g.shape[0] and 0 <= pairs[i, 1] < g.shape[0]):
+            raise ValueError('Field couples a block outside of the stack')
+    if accepted is not None:
+        pacc = &accepted[0, 0]
+    with nogil:
+        for i in range(fields):
+            if pacc != NULL:
+                facc = pacc + i*N
+            acc += sweep(N, pg + pairs[i, 0]*N*N, pg + pairs[i, 1]*N*N,
+                         pv + i*N, subblock_len, double_flip_prob, Heatbath,
+                         delay, px, px + buf*N, px + 2*buf*N, px + 3*buf*N,
+                         csize, &cwork[0], &cipiv[0], &csites[0], &cdvk[0],
+                         cr, &nrat, facc)
+    return acc, nrat
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void accumulate_gtau(scalar[:, :] g, scalar[:, :, ::1] gtau,
+                          double[:, ::1] diag, int slices) noexcept nogil:
+    """Adds the translation averaged G(tau) of every site block of g into
+    gtau and copies the real part of the diagonal of each site block into
+    diag"""
+    cdef int R, C, a, b, r, c, N = g.shape[0]
+    cdef double norm = 1. / slices
+    for C in range(N):
+        b = C / slices
+        c = C % slices
+        for R in range(N):
+            a = R / slices
+            r = R % slices
+            if r >= c:
+                gtau[a, b, r - c] += norm * g[R, C]
+            else:
+                gtau[a, b, slices + r - c] -= norm * g[R, C]
+        diag[b, c] = real(g[C, C])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void accumulate_densities(double[:, ::1] diag, double[::1] occupation,
+                               double[::1] double_occ) noexcept nogil:
+    """Adds the occupations and density-density correlators of the flavors
+    from the diagonals of their Green functions, diag[flavor, slice]"""
+    cdef int f, h, r, k = 0
+    cdef int flavors = diag.shape[0], slices = diag.shape[1]
+    for f in range(flavors):
+        for r in range(slices):
+            occupation[f] += diag[f, r]
+        for h in range(f + 1, flavors):
+            for r in range(slices):
+                double_occ[k] += diag[f, r] * diag[h, r]
+            k += 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def measure(g, scalar[:, :, :, ::1] gtau, double[::1] occupation,
+            double[::1] double_occ, int slices):
+    """Accumulates from the Green function matrices of all blocks the
+    translation averaged G(tau), the occupation of every flavor and the
+    density-density correlators of all flavor pairs, in the order of
+    itertools.combinations. Flavors are ordered by block and then site.
+    gtau has the dtype of the Green functions."""
+    cdef int blocks = len(g), sites = g[0].shape[0] / slices
+    cdef int flavors = blocks * sites
+    cdef int blk
+    cdef scalar[:, :] gb
+    cdef scalar[:, :, ::1] gtau_b
+    cdef double[:, ::1] diag = np.empty((flavors, slices))
+    for blk in range(blocks):
+        gb = g[blk]
+        gtau_b = gtau[blk]
+        with nogil:
+            accumulate_gtau(gb, gtau_b, diag[blk*sites:(blk+1)*sites], slices)
+    with nogil:
+        accumulate_densities(diag, occupation, double_occ)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def run_sweeps(np.ndarray[dscalar, ndim=3] g,
+               np.ndarray[dscalar, ndim=3] gx,
+               np.ndarray[np.float64_t, ndim=2, mode='c'] v,
+               np.intp_t[:, ::1] pairs,
+               double[:, ::1] interaction,
+               int subblock_len,
+               long start, long stop,
+               long next_clean, long clean_interval,
+               long measure_after,
+               dscalar[:, :, :, ::1] gtau,
+               double[::1] occupation,
+               double[::1] double_occ,
+               double[:, ::1] drift,
+               int meas = 1,
+               int delay = 1,
+               double double_flip_prob = 0.,
+               bool Heatbath = True,
+               Rng rng = None,
+               int cluster = 2,
+               int[:, ::1] accepted = None,
+               double[::1] chi = None,
+               long chi_interval = 0,
+               long measured_before = 0):
+    """Runs the sweeps start to stop of a Markov chain without returning to
+    Python. Every sweep updates meas times all the Ising fields as
+    updateDHS_fields and, past the sweep measure_after, accumulates the
+    observables of measure into gtau, occupation and double_occ. With
+    chi_interval > 0 the local spin correlator of hirschfye.measure_chi is
+    added to chi at every chi_interval-th measurement of the chain, which
+    took measured_before of them before start. As there its density part
+    is the autocorrelation of the magnetization by FFT, for which the GIL
+    is taken.
+
+    At the sweep next_clean and then every clean_interval sweeps the Green
+    functions g are recomputed from the retarded Weiss fields gx, a stack
+    in the same layout, by LAPACK gesv, with the fields of each block added
+    through the interaction matrix of shape (blocks, fields). The sweep
+    and the drift of the fast updates from the clean Green functions fill
+    the next row of drift. All work arrays are allocated once per call.
+
+    Returns the accepted moves, the negative weights, the number of
+    measurements, the next clean sweep, the number of clean updates and
+    the number of spin correlator measurements"""
+    cdef int acc = 0, nrat = 0, info = 0
+    cdef size_t i, b, f, l, rep
+    cdef size_t fields = v.shape[0], N = v.shape[1], blocks = g.shape[0]
+    cdef size_t buf = max(delay, 1)
+    cdef int slices = gtau.shape[3], sites = gtau.shape[1]
+    cdef int s, d, t
+    cdef long mcs, measured = 0, cleans = 0, chi_measured = 0
+    cdef double err, block_err, chi_norm = 1. / (slices * sites)
+    moment_arr, density_arr = np.empty((sites, slices)), np.empty(slices)
+    cdef double[:, ::1] moment = moment_arr
+    cdef double[::1] density = density_arr
+    cdef double[::1] exchange = np.empty(slices)
+    cdef gsl_rng *cr = r if rng is None else rng.r
+    cdef np.ndarray[dscalar, ndim=3] X = np.empty((4, buf, N), g.dtype)
+    cdef np.ndarray[dscalar, ndim=2] A = np.empty((2, N*N), g.dtype)
+    cdef int[::1] clean_ipiv = np.empty(N, np.intc)
+    cdef double[::1] lv = np.empty(N)
+    cdef double[:, ::1] diag = np.empty((blocks*sites, slices))
+    cdef dscalar[:, :, :] gmv = g
+    cdef dscalar *pg = &g[0, 0, 0]
+    cdef dscalar *pgx = &gx[0, 0, 0]
+    cdef dscalar *px = &X[0, 0, 0]
+    cdef dscalar *pa = &A[0, 0]
+    cdef double *pv = &v[0, 0]
+    cdef int *pacc = NULL
+    cdef int *facc = NULL
+    size, work, ipiv, sites_buf, dvk = cluster_workspace(g[0], N,
+                                                         subblock_len, cluster)
+    cdef np.ndarray[dscalar, ndim=1] cwork = work
+    cdef int[::1] cipiv = ipiv
+    cdef size_t[::1] csites = sites_buf
+    cdef double[::1] cdvk = dvk
+    cdef size_t csize = size
+    if pairs.shape[0] != fields:
+        raise ValueError('One pair of blocks is needed per Ising field')
+    for stack in (g, gx):
+        if stack.shape[0] != blocks or stack.shape[1] != N or \
+                stack.shape[2] != N or \
+                (stack.strides[0], stack.strides[1], stack.strides[2]) != \
+                (N*N*stack.itemsize, stack.itemsize, N*stack.itemsize):
+            raise ValueError('Green function blocks must be a stack of '
+                             'Fortran ordered matrices')
+    for i in range(fields):
+        if not (0 <= pairs[i, 0] < blocks and 0 <= pairs[i, 1] < blocks):
+            raise ValueError('Field couples a block outside of the stack')
+    if interaction.shape[0] != blocks or interaction.shape[1] != fields:
+        raise ValueError('The interaction matrix must be of shape '
+                         '(blocks, fields)')
+    if gtau.shape[0] != blocks or sites * slices != N or \
+            occupation.shape[0] != blocks * sites:
+        raise ValueError('Accumulators do not match the Green functions')
+    if clean_interval < 1:
+        raise ValueError('The clean interval must be positive')
+    if chi_interval > 0 and (chi is None or chi.shape[0] != slices):
+        raise ValueError('chi needs one entry per time slice')
+    if next_clean < stop and drift.shape[0] < \
+            (stop - 1 - max(next_clean, start)) // clean_interval + 1:
+        raise ValueError('Not enough rows in drift for the clean updates')
+    if accepted is not None:
+        pacc = &accepted[0, 0]
+    with nogil:
+        for mcs in range(start, stop):
+            if mcs >= next_clean:
+                err = 0.
+                for b in range(blocks):
+                    for l in range(N):
+                        lv[l] = 0.
+                    for f in range(fields):
+                        if interaction[b, f] != 0.:
+                            for l in range(N):
+                                lv[l] += interaction[b, f] * pv[f*N + l]
+                    info = fgclean(N, pgx + b*N*N, &lv[0], pg + b*N*N, pa,
+                                   pa + N*N, &clean_ipiv[0], &block_err)
+                    if info != 0:
+                        break
+                    err = max(err, block_err)
+                if info != 0:
+                    break
+                drift[cleans, 0] = mcs
+                drift[cleans, 1] = err
+                cleans += 1
+                next_clean = (mcs / clean_interval + 1) * clean_interval
+
+            for rep in range(meas):
+                for i in range(fields):
+                    if pacc != NULL:
+                        facc = pacc + i*N
+                    acc += sweep(N, pg + pairs[i, 0]*N*N,
+                                 pg + pairs[i, 1]*N*N, pv + i*N,
+                                 subblock_len, double_flip_prob, Heatbath,
+                                 delay, px, px + buf*N, px + 2*buf*N,
+                                 px + 3*buf*N, csize, &cwork[0], &cipiv[0],
+                                 &csites[0], &cdvk[0], cr, &nrat, facc)
+
+            if mcs > measure_after:
+                for b in range(blocks):
+                    accumulate_gtau(gmv[b], gtau[b],
+                                    diag[b*sites:(b+1)*sites], slices)
+                accumulate_densities(diag, occupation, double_occ)
+                measured += 1
+                if chi_interval > 0 and \
+                        (measured_before + measured) % chi_interval == 0:
+                    # magnetization of every site, blocks alternate spin
+                    # up and down
+                    for s in range(sites):
+                        for t in range(slices):
+                            moment[s, t] = 0.
+                            for b in range(blocks):
+                                moment[s, t] += (.5 - (b % 2)) * \
+                                    diag[b*sites + s, t]
+                    for d in range(slices):
+                        exchange[d] = 0.
+                    for b in range(blocks):
+                        exchange_block(gmv[b], exchange, slices)
+                    with gil:  # cyclic autocorrelation by FFT
+                        moment_w = np.fft.rfft(moment_arr)
+                        density_arr[:] = np.fft.irfft(
+                            moment_w.real**2 + moment_w.imag**2,
+                            slices).sum(0)
+                    for d in range(slices):
+                        chi[d] += (density[d] + exchange[d] / 4) * chi_norm
+                    chi_measured += 1
+    if info != 0:
+        raise np.linalg.LinAlgError('Singular matrix in the clean update')
+    return acc, nrat, measured, next_clean, cleans, chi_measured
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void accumulate_weighted(scalar[:, :] g, double[::1] weight,
+                              scalar[:, :, ::1] out, int slices) noexcept nogil:
+    """As accumulate_gtau the translation average of the rows of g each
+    weighted by weight"""
+    cdef int R, C, a, b, r, c, N = g.shape[0]
+    cdef double norm = 1. / slices
+    for C in range(N):
+        b = C / slices
+        c = C % slices
+        for R in range(N):
+            a = R / slices
+            r = R % slices
+            if r >= c:
+                out[a, b, r - c] += norm * weight[R] * g[R, C]
+            else:
+                out[a, b, slices + r - c] -= norm * weight[R] * g[R, C]
+
+
+def measure_f(g, partners, scalar[:, :, :, ::1] ftau, int slices):
+    """Accumulates into ftau the translation averaged higher order
+    correlator of every block a with the densities of the blocks b it
+    interacts with, :math:`\\sum_b (1 - G^b_{RR}) G^a_{RC}`, that is
+    :math:`\\langle n c c^\\dagger \\rangle` with the Hirsch-Fye sign.
+    partners lists for each block those it interacts with.
+
+    The density is averaged over the time slice of the row and the one
+    before it, centering it on the interaction vertex. Taking it on the
+    slice alone biases the estimator to first order in the time step."""
+    cdef scalar[:, :] gb
+    cdef scalar[:, :, ::1] ftau_b
+    cdef double[::1] density
+    for blk in range(len(g)):
+        n_slice = (sum(1. - np.diag(g[other]).real
+                       for other in partners[blk]) +
+                   np.zeros(g[blk].shape[0])).reshape(-1, slices)
+        density = np.ascontiguousarray(
+            .5 * (n_slice + np.roll(n_slice, 1, axis=1)).ravel())
+        gb = g[blk]
+        ftau_b = ftau[blk]
+        with nogil:
+            accumulate_weighted(gb, density, ftau_b, slices)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void exchange_block(scalar[:, :] g, double[::1] corr,
+                         int slices) noexcept nogil:
+    """Exchange part of the density-density correlator within each site
+    block of g"""
+    cdef int s, r, c, o, sites = g.shape[0] / slices
+    for s in range(sites):
+        o = s * slices
+        for c in range(slices):
+            corr[0] += real(g[o + c, o + c])
+            for r in range(slices):
+                corr[(r - c + slices) % slices] -= \
+                    real(g[o + r, o + c] * g[o + c, o + r])
+
+
+def spin_exchange(g, double[::1] corr, int slices):
+    """Adds to corr[d] the exchange part of the equal site density-density
+    correlator, :math:`\\delta_{d0} G_{ll} - G_{l+d,l} G_{l,l+d}`, summed
+    over the time slices l, the sites and blocks of g"""
+    cdef double[:, :] greal
+    cdef double complex[:, :] gcplx
+    for gb in g:
+        if np.iscomplexobj(gb):
+            gcplx = gb
+            with nogil:
+                exchange_block(gcplx, corr, slices)
+        else:
+            greal = gb
+            with nogil:
+                exchange_block(greal, corr, slices)
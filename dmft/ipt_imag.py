@@ -32,7 +32,7 @@ from numba import jit
 from scipy.integrate import quad, simps
 from scipy.optimize import fsolve
 import numpy as np
-from dmft.common import gt_fouriertrans, gw_invfouriertrans
+from dmft.common import gt_fouriertrans, gw_invfouriertrans, greenF
 import slaveparticles.quantum.dos as dos
 
 
@@ -108,6 +108,57 @@ def dmft_loop(u_int, t, g_iwn, w_n, tau, mix=1, conv=1e-3):
         g_iwn = mix * g_iwn + (1 - mix) * g_iwn_old
     return g_iwn, sigma_iwn
 
+
+def dlr_dmft_loop(u_int, t, dlr, g_iwn=None, mix=1, conv=1e-3):
+    r"""Paramagnetic self-consistent loop of :func:`dmft_loop` on the
+    sparse nodes of a discrete Lehmann representation
+
+    The Weiss field is taken to the imaginary time nodes, the self-energy
+    :math:`\Sigma(\tau) \approx U^2 \mathcal{G}^0(\tau)^3` evaluated
+    there and taken back to the Matsubara nodes through the fitted poles,
+    so that every iteration works on a few tens of points at any
+    temperature. The spectral width of dlr must enclose the self-energy,
+    about three times the bandwidth.
+
+    Parameters
+    ----------
+    u_int : float
+        Local interation strength
+    t : float
+        Hopping amplitude between bethe lattice nearest neighbors
+    dlr : dmft.dlr.DLR
+        Basis whose Matsubara nodes dlr.w_n carry the Green functions
+    g_iwn : complex float ndarray or None
+        Starting guess Green function on the Matsubara nodes, the non
+        interacting one by default
+    mix : real :math:`\in [0, 1]`
+        fraction of new solution for next input as bath Green function
+    conv : float
+        relative tolerance of the convergence
+
+    Returns
+    -------
+    tuple 2 complex ndarrays
+        Interacting Green's function and self-energy on the Matsubara
+        nodes, dlr.fit_iw gives their poles to evaluate them elsewhere
+    """
+
+    iw_n = 1j * dlr.w_n
+    if g_iwn is None:
+        g_iwn = greenF(dlr.w_n, D=2 * t)
+    for _ in range(500):
+        g_iwn_old = g_iwn.copy()
+        g_0_iwn = 1. / (iw_n - t**2 * g_iwn_old)
+        sigma_iwn = dlr.tau_to_iw(u_int**2 * dlr.iw_to_tau(g_0_iwn)**3)
+        g_iwn = g_0_iwn / (1 - sigma_iwn * g_0_iwn)
+        # Clean for Half-fill
+        g_iwn.real = 0.
+        converged = np.allclose(g_iwn_old, g_iwn, conv)
+        g_iwn = mix * g_iwn + (1 - mix) * g_iwn_old
+        if converged:
+            break
+    return g_iwn, sigma_iwn
+
 ###############################################################################
 # Energy calculations
 
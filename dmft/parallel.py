@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+r"""
+Communicators of the Monte Carlo solvers
+========================================
+
+The solvers reduce their measurements through a communicator with the
+interface of mpi4py. MPI is optional, without it or outside of ``mpirun``
+the :class:`SerialComm` of a single rank stands in for it. The reduction
+operations are exported as SUM, MAX and LAND so that the same calls work
+with both.
+"""
+
+from __future__ import division, absolute_import, print_function
+import numpy as np
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+if MPI is not None:
+    SUM, MAX, LAND = MPI.SUM, MPI.MAX, MPI.LAND
+else:
+    SUM, MAX, LAND = 'sum', 'max', 'land'
+
+
+class SerialComm(object):
+    """Communicator of a single process
+
+    Implements the subset of the mpi4py communicator interface used by
+    the solvers. With one rank every reduction returns its own input.
+    """
+
+    rank = 0
+    size = 1
+
+    def Allreduce(self, sendbuf, recvbuf, op=SUM):
+        """Copies sendbuf into recvbuf"""
+        np.copyto(recvbuf, sendbuf)
+
+    def allreduce(self, sendobj, op=SUM):
+        """Returns sendobj"""
+        return sendobj
+
+    def bcast(self, obj, root=0):
+        """Returns obj"""
+        return obj
+
+    def allgather(self, sendobj):
+        """List with the object of the only rank"""
+        return [sendobj]
+
+    def Barrier(self):
+        """Nothing to wait for"""
+
+    def Split(self, color=0, key=0):
+        """New serial communicator"""
+        return SerialComm()
+
+    def Dup(self):
+        """New serial communicator"""
+        return SerialComm()
+
+    def Free(self):
+        """Nothing to release"""
+
+
+def threaded_collectives(comm):
+    """Whether threads may run collective operations at the same time on
+    different communicators derived from comm, which needs MPI initialized
+    with THREAD_MULTIPLE"""
+    if MPI is None or isinstance(comm, SerialComm):
+        return True
+    return MPI.Query_thread() >= MPI.THREAD_MULTIPLE
+
+
+def default_comm():
+    """MPI.COMM_WORLD when mpi4py is available, a SerialComm otherwise"""
+    if MPI is None:
+        return SerialComm()
+    return MPI.COMM_WORLD
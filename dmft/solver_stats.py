@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+r"""
+Run statistics of the Monte Carlo solvers
+=========================================
+
+Wall clock time spent in each phase of a Markov chain and the acceptance
+of the moves proposed at every Ising field, to size allocations and spot
+performance regressions. The counters of independent chains and MPI ranks
+add up.
+"""
+
+from __future__ import division, absolute_import, print_function
+from contextlib import contextmanager
+import time
+import numpy as np
+from dmft.parallel import MAX
+
+
+class SolverStats(object):
+    r"""Timing and acceptance counters of Markov chains
+
+    The phases are 'sweep' for the field updates, 'clean' for the
+    recomputation of the Green functions from scratch, 'measure' for the
+    accumulation of observables, 'binning_io' for the binning analysis and
+    the binned measurement files, 'checkpoint' for saving the chain states
+    and 'reduction' for the reductions over chains and MPI ranks. The
+    stretches of sweeps run by the compiled driver, with their clean
+    updates and measurements, add up in 'driver'.
+
+    The number of clean updates after fast updated sweeps is counted in
+    cleanups and the largest deviation of the fast updated Green functions
+    from the clean ones is kept in max_drift. therm_sweeps adds up the
+    sweeps each chain spent thermalizing and measured the measurements
+    taken after them.
+
+    Parameters
+    ----------
+    fields : int
+        number of auxiliary Ising fields
+    sites : int
+        length of each field, sites times time slices
+    """
+
+    PHASES = ('sweep', 'clean', 'measure', 'driver', 'binning_io',
+              'checkpoint', 'reduction')
+
+    def __init__(self, fields=0, sites=0):
+        self.time = dict.fromkeys(self.PHASES, 0.)
+        self.calls = dict.fromkeys(self.PHASES, 0)
+        self.accepted = np.zeros((fields, sites), np.intc)
+        self.proposed = 0
+        self.nsign = 0
+        self.cleanups = 0
+        self.max_drift = 0.
+        self.therm_sweeps = 0
+        self.measured = 0
+
+    @contextmanager
+    def timer(self, phase):
+        """Adds the wall clock time of the enclosed block to phase"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.time[phase] += time.time() - start
+            self.calls[phase] += 1
+
+    def merge(self, other):
+        """Adds the counters of other into these"""
+        for phase in self.PHASES:
+            self.time[phase] += other.time[phase]
+            self.calls[phase] += other.calls[phase]
+        if not self.accepted.size:
+            self.accepted = np.zeros_like(other.accepted)
+        self.accepted += other.accepted
+        self.proposed += other.proposed
+        self.nsign += other.nsign
+        self.cleanups += other.cleanups
+        self.max_drift = max(self.max_drift, other.max_drift)
+        self.therm_sweeps += other.therm_sweeps
+        self.measured += other.measured
+        return self
+
+    def allreduce(self, comm):
+        """Sums the counters over the ranks of the MPI communicator comm"""
+        times = np.array([self.time[phase] for phase in self.PHASES])
+        calls = np.array([self.calls[phase] for phase in self.PHASES])
+        accepted = np.zeros_like(self.accepted)
+        comm.Allreduce(times.copy(), times)
+        comm.Allreduce(calls.copy(), calls)
+        comm.Allreduce(self.accepted, accepted)
+        self.time = dict(zip(self.PHASES, times.tolist()))
+        self.calls = dict(zip(self.PHASES, calls.tolist()))
+        self.accepted = accepted
+        self.proposed = comm.allreduce(self.proposed)
+        self.nsign = comm.allreduce(self.nsign)
+        self.cleanups = comm.allreduce(self.cleanups)
+        self.max_drift = comm.allreduce(self.max_drift, op=MAX)
+        self.therm_sweeps = comm.allreduce(self.therm_sweeps)
+        self.measured = comm.allreduce(self.measured)
+        return self
+
+    def acceptance(self):
+        """Acceptance rate of the moves proposed at every field and site,
+        with shape (fields, sites)"""
+        return self.accepted / max(self.proposed, 1)
+
+    def acceptance_per_field(self):
+        """Acceptance rate of each auxiliary Ising field"""
+        return self.acceptance().mean(1)
+
+    def acceptance_per_slice(self, slices):
+        """Acceptance rate at each of the time slices, over all fields and
+        sites"""
+        return self.acceptance().reshape(-1, slices).mean(0)
+
+    def total_time(self):
+        """Time spent in all phases"""
+        return sum(self.time.values())
+
+    def summary(self):
+        """Table of the time and calls of every phase"""
+        total = max(self.total_time(), 1e-300)
+        lines = ['{:<12}{:>12}{:>8}{:>10}'.format('phase', 'time [s]',
+                                                  'share', 'calls')]
+        lines += ['{:<12}{:>12.4g}{:>7.1%}{:>10}'.format(
+            phase, self.time[phase], self.time[phase] / total,
+            self.calls[phase]) for phase in self.PHASES]
+        lines.append('acceptance {:.4g} nsign {}'.format(
+            self.acceptance().mean() if self.accepted.size else 0.,
+            self.nsign))
+        lines.append('clean ups {} max drift {:.4g}'.format(self.cleanups,
+                                                           self.max_drift))
+        lines.append('thermalization sweeps {} measurements {}'.format(
+            self.therm_sweeps, self.measured))
+        return '\n'.join(lines)
+
+    def save(self, filename):
+        """Stores the counters in the npz file filename"""
+        np.savez(filename, phases=np.array(self.PHASES),
+                 time=[self.time[phase] for phase in self.PHASES],
+                 calls=[self.calls[phase] for phase in self.PHASES],
+                 accepted=self.accepted, proposed=self.proposed,
+                 nsign=self.nsign, cleanups=self.cleanups,
+                 max_drift=self.max_drift, therm_sweeps=self.therm_sweeps,
+                 measured=self.measured)
+
+    @classmethod
+    def load(cls, filename):
+        """Reads back the counters stored by save"""
+        data = np.load(filename)
+        stats = cls()
+        phases = [str(phase) for phase in data['phases']]
+        stats.time.update(zip(phases, data['time'].tolist()))
+        stats.calls.update(zip(phases, data['calls'].tolist()))
+        stats.accepted = data['accepted']
+        stats.proposed = int(data['proposed'])
+        stats.nsign = int(data['nsign'])
+        stats.cleanups = int(data['cleanups'])
+        stats.max_drift = float(data['max_drift'])
+        stats.therm_sweeps = int(data['therm_sweeps'])
+        stats.measured = int(data['measured'])
+        return stats
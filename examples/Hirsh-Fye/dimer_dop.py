@@ -7,6 +7,10 @@ QMC Hirsch - Fye Impurity solver for a Dimer
 
 To treat the dimer in a Bethe lattice and solve it using the Hirsch - Fye
 Quantum Monte Carlo algorithm
+
+With -target_density the chemical potential is adjusted after every
+iteration from the measured density, see :class:`dmft.hirschfye.DensityControl`,
+converging it together with the Weiss field in one run.
 """
 
 from __future__ import division, absolute_import, print_function
@@ -63,9 +67,6 @@ def dmft_loop_pm(simulation, U, g_iw_start=None):
     mu, tp = setup['MU'], setup['tp']
     giw_d, giw_o = dimer.gf_met(w_n, mu, tp, 0.5, 0.)
 
-    gmix = np.array([[1j * w_n + mu, -tp * np.ones_like(w_n)],
-                     [-tp * np.ones_like(w_n), 1j * w_n + mu]])
-
     giw = np.array([[giw_d, giw_o], [giw_o, giw_d]])
     g0tau0 = -0.5 * np.eye(2).reshape(2, 2, 1)
     gtu = gf.gw_invfouriertrans(giw, tau, w_n, pd.gf_tail(g0tau0, 0., mu, tp))
@@ -76,9 +77,15 @@ def dmft_loop_pm(simulation, U, g_iw_start=None):
         giw_dw = g_iw_start[1]
 
     save_dir = os.path.join(setup['ofile'].format(**setup), current_u)
+    dndmu = 1.
     try:  # try reloading data from disk
         with open(save_dir + '/setup', 'r') as conf:
-            last_loop = json.load(conf)['last_loop']
+            saved = json.load(conf)
+        last_loop = saved['last_loop']
+        if setup['target_density'] is not None:
+            # resume the chemical potential control where it stopped
+            mu = saved.get('next_mu', saved['MU'])
+            dndmu = saved.get('dndmu', dndmu)
         gtu = np.load(os.path.join(save_dir,
                                    'it{:03}'.format(last_loop),
                                    'gtau_up.npy')).reshape(2, 2, -1)
@@ -94,13 +101,20 @@ def dmft_loop_pm(simulation, U, g_iw_start=None):
                          L=setup['SITES'] * setup['n_tau_mc'],
                          polar=setup['spin_polarization'])
 
+    control = None
+    if setup['target_density'] is not None:
+        setup['error_analysis'] = True
+        control = hf.DensityControl(setup['target_density'], mu, dndmu,
+                                    damping=setup['mu_damping'])
+
     for iter_count in range(last_loop, last_loop + setup['Niter']):
         work_dir = os.path.join(save_dir, 'it{:03}'.format(iter_count))
         setup['work_dir'] = work_dir
 
+        setup['MU'] = mu
         if comm.rank == 0:
             print('On loop', iter_count, 'beta', setup['BETA'],
-                  'U', U, 'tp', tp)
+                  'U', U, 'tp', tp, 'mu', mu)
         # paramagnetic cleaning
         gtu = 0.5 * (gtu + gtd)
         gtd = gtu
@@ -109,6 +123,8 @@ def dmft_loop_pm(simulation, U, g_iw_start=None):
         giw_dw = gf.gt_fouriertrans(gtd, tau, w_n, pd.gf_tail(gtd, U, mu, tp))
 
         # Bethe lattice bath
+        gmix = np.array([[1j * w_n + mu, -tp * np.ones_like(w_n)],
+                         [-tp * np.ones_like(w_n), 1j * w_n + mu]])
         g0iw_up = dimer.mat_2_inv(gmix - 0.25 * giw_up)
         g0iw_dw = dimer.mat_2_inv(gmix - 0.25 * giw_dw)
 
@@ -119,7 +135,24 @@ def dmft_loop_pm(simulation, U, g_iw_start=None):
 
         # Impurity solver
 
-        gtu, gtd = hf.imp_solver([g0tau_dw, g0tau_up], V_field, intm, setup)
+        if control is None:
+            gtu, gtd = hf.imp_solver([g0tau_dw, g0tau_up], V_field, intm,
+                                     setup)
+        else:
+            out = hf.imp_solver_results([g0tau_dw, g0tau_up], V_field,
+                                        intm, setup)
+            gtu, gtd = out['gtau']
+            errors = out['errors']
+            # Hirsch-Fye occupation is 1 - n of every flavor
+            occ = errors['occupation']
+            setup['density'] = (occ['mean'].size - occ['mean'].sum()) / \
+                setup['SITES']
+            density_err = np.sqrt((occ['error']**2).sum()) / setup['SITES']
+            mu = control.update(setup['density'], density_err)
+            setup['next_mu'], setup['dndmu'] = control.mu, control.dndmu
+            if comm.rank == 0:
+                print('density', setup['density'], '+-', density_err,
+                      'next mu', mu)
 
         # Save output
         if comm.rank == 0:
@@ -139,6 +172,12 @@ if __name__ == "__main__":
                         help='Probability for double spin flip on equal sites')
     parser.add_argument('-afm', '--AFM', action='store_true',
                         help='Use the self-consistency for Antiferromagnetism')
+    parser.add_argument('-target_density', type=float, default=None,
+                        help='Electrons per site to reach by adjusting the '
+                        'chemical potential between iterations')
+    parser.add_argument('-mu_damping', type=float, default=0.5,
+                        help='Fraction of the secant step of the chemical '
+                        'potential taken every iteration')
     parser.set_defaults(ofile='DIMER_{simt}_B{BETA}_tp{tp}_MU{MU}')
 
     SETUP = vars(parser.parse_args())
@@ -65,6 +65,8 @@ def dmft_loop_pm(simulation, U, g_iw_start=None):
         gtd = np.load(os.path.join(save_dir,
                                    'it{:03}'.format(last_loop),
                                    'gtau_dw.npy')).reshape(2, 2, -1)
+        setup['warm_start'] = os.path.join(save_dir,
+                                           'it{:03}'.format(last_loop))
 
         last_loop += 1
     except (IOError, KeyError, ValueError):  # if no data clean start
@@ -111,6 +113,8 @@ def dmft_loop_pm(simulation, U, g_iw_start=None):
         # Impurity solver
 
         gtu, gtd = hf.imp_solver([g0tau_dw, g0tau_up], V_field, intm, setup)
+        # Next iteration keeps V_field and only rethermalizes briefly
+        setup['warm_start'] = work_dir
 
         # Save output
         if comm.rank == 0:
@@ -121,6 +125,9 @@ def dmft_loop_pm(simulation, U, g_iw_start=None):
                 json.dump(setup, conf, indent=2)
         sys.stdout.flush()
 
+    # The next U starts from the last Ising fields of this one
+    simulation['warm_start'] = setup.get('warm_start', '')
+
 
 if __name__ == "__main__":
     parser = hf.do_input('DMFT loop for Hirsh-Fye dimer lattice')
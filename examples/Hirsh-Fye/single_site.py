@@ -48,6 +48,8 @@ def dmft_loop_pm(simulation, U, g_iw_start=None):
         gtau = np.load(os.path.join(save_dir,
                                     'it{:03}'.format(last_loop),
                                     'gtau.npy'))
+        setup['warm_start'] = os.path.join(save_dir,
+                                           'it{:03}'.format(last_loop))
         last_loop += 1
     except (IOError, OSError):
         last_loop = 0
@@ -78,6 +80,8 @@ def dmft_loop_pm(simulation, U, g_iw_start=None):
             gtu, gtd = hf.imp_solver([g0tau]*2, v_aux, intm, setup)
             gtau = np.squeeze(0.5 * (gtu+gtd))
 
+        # Next iteration starts from the thermalized Ising fields
+        setup['warm_start'] = work_dir
 
         if COMM.rank == 0:
             np.save(work_dir + '/gtau', gtau)
@@ -86,6 +90,8 @@ def dmft_loop_pm(simulation, U, g_iw_start=None):
                 json.dump(setup, conf, indent=2)
         sys.stdout.flush()
 
+    # and so does the next U
+    simulation['warm_start'] = setup.get('warm_start', '')
     return giw
 
 
@@ -26,7 +26,9 @@ setup(
     license="GNU General Public License v3 (GPLv3)",
 
     install_requires=['numpy', 'scipy', 'matplotlib', 'slaveparticles',
-                      'joblib', 'pandas', 'numba', 'h5py', 'mpi4py'],
+                      'joblib', 'pandas', 'numba', 'h5py',
+                      'futures; python_version < "3"'],
+    extras_require={'mpi': ['mpi4py']},
     setup_requires=['sphinx', 'cython', 'pytest-runner'],
     tests_require=['pytest-cov', 'pytest'],  # Somehow this order is relevant
     cmdclass={'build_ext': build_ext},
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the streaming binning analysis
+"""
+
+from __future__ import division, absolute_import, print_function
+import numpy as np
+import pytest
+from dmft.binning import LogBinning, jackknife
+
+
+def ar1_series(rho, size, seed=4213):
+    """Autoregressive series with known autocorrelation time"""
+    rng = np.random.RandomState(seed)
+    noise = rng.randn(size)
+    series = np.zeros(size)
+    for i in range(1, size):
+        series[i] = rho * series[i - 1] + noise[i]
+    return series
+
+
+@pytest.mark.parametrize("rho", [0., 0.5, 0.8])
+def test_logbinning_autocorrelation(rho):
+    """Binning recovers the error and autocorrelation time of AR(1)"""
+    series = ar1_series(rho, 2**16)
+    binning = LogBinning((2,))
+    for sample in series:
+        binning.add([sample, -2 * sample])
+
+    tau = rho / (1 - rho)
+    error = np.sqrt(series.var() / series.size * (1 + 2 * tau))
+    assert np.allclose(binning.mean(), [series.mean(), -2 * series.mean()])
+    assert np.allclose(binning.tau_int(), tau, atol=0.25 * (1 + 2 * tau))
+    assert np.allclose(binning.error(), [error, 2 * error], rtol=0.2)
+
+
+def test_logbinning_coarse_bins():
+    """The coarse bins stay bounded and keep the average"""
+    series = ar1_series(0.5, 5000)
+    binning = LogBinning(max_bins=16)
+    for sample in series:
+        binning.add(sample)
+
+    bins = np.array(binning.bins)
+    assert 16 <= len(bins) < 32
+    assert np.allclose(bins.mean(), series[:len(bins) * binning.bin_size].mean())
+
+
+def test_jackknife():
+    """Jackknife matches the standard error for the mean and removes the
+    leading bias of non linear functions"""
+    rng = np.random.RandomState(10)
+    bins = rng.randn(200) + 3.
+    mean, error = jackknife(bins)
+    assert np.allclose(mean, bins.mean())
+    assert np.allclose(error, bins.std(ddof=1) / np.sqrt(bins.size))
+
+    square, error = jackknife(bins, lambda x: x**2)
+    assert abs(square - 9.) < 3 * error
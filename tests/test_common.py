@@ -26,6 +26,45 @@ def test_fourier_trasforms(chempot, beta=50., n_matsubara=128):
         assert np.allclose(gwr, g_iomega)
 
 
+def test_fourier_plan(beta=50., n_matsubara=128):
+    """Plans are reused on the same grids and transform into the given
+    buffers as the direct formulas"""
+    tau, w_n = gf.tau_wn_setup({'BETA': beta, 'N_MATSUBARA': n_matsubara})
+    plan = gf.fourier_plan(tau, w_n)
+    assert gf.fourier_plan(tau.copy(), w_n.copy()) is plan
+    assert gf.fourier_plan(tau[::2], w_n[:64]) is not plan
+
+    tail = [1., -0.3, 0.25]
+    giw = gf.greenF(w_n, mu=0.3)
+    freq_tail, time_tail = gf.freq_tail_fourier(tail, beta, tau, w_n)
+    g_tau = (np.fft.fft(giw - freq_tail, len(tau)) *
+             np.exp(-1j * np.pi * tau / beta) * 2 / beta).real + time_tail
+    out_tau = np.empty((2, len(tau)))
+    assert plan.inverse(np.array([giw, giw]), tail, out_tau) is out_tau
+    assert np.allclose(out_tau, g_tau)
+
+    out_iw = np.empty(len(w_n), complex)
+    assert plan.forward(g_tau, tail, out_iw) is out_iw
+    assert np.allclose(out_iw, beta * np.fft.ifft(
+        (g_tau - time_tail) * np.exp(1j * np.pi * tau / beta))[:len(w_n)] +
+        freq_tail)
+
+
+@pytest.mark.parametrize("chempot", [0, 0.5, -0.8])
+def test_legendre_transforms(chempot, beta=50., n_matsubara=128):
+    """Green function through its Legendre expansion"""
+    parms = {'BETA': beta, 'N_MATSUBARA': n_matsubara}
+    tau, w_n = gf.tau_wn_setup(parms)
+    giw = gf.greenF(w_n, mu=chempot)
+    g_tau = gf.gw_invfouriertrans(giw, tau, w_n, [1., -chempot, 0.25])
+
+    g_l = gf.gt_legendretrans(np.array([g_tau, g_tau]), tau, 60)
+    assert g_l.shape == (2, 60)
+    assert np.allclose(gf.gl_fouriertrans(g_l, w_n, beta), giw, atol=1e-4)
+    assert np.allclose(gf.gl_invlegendretrans(g_l, tau, beta), g_tau,
+                       atol=1e-4)
+
+
 def test_fit_gf():
     """Test the interpolation of Green function in Bethe Lattice"""
     w_n = gf.matsubara_freq(100, 3)
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""Tests of the discrete Lehmann representation"""
+
+from __future__ import division, absolute_import, print_function
+import numpy as np
+import pytest
+import dmft.common as gf
+from dmft.dlr import DLR
+
+
+@pytest.mark.parametrize("beta", [10., 100., 1000.])
+def test_dlr_bethe(beta, chempot=0.3):
+    """The Bethe lattice Green function is recovered from its values at
+    the sparse nodes"""
+    basis = DLR(beta, 4.)
+    assert basis.rank == len(basis.tau) < 100
+    assert len(np.unique(basis.n)) == len(basis.n) == basis.rank
+    assert np.all(basis.w_n > 0)
+
+    coef = basis.fit_iw(gf.greenF(basis.w_n, mu=chempot))
+    w_n = gf.matsubara_freq(beta, 2048)
+    assert np.allclose(basis.eval_iw(coef, w_n), gf.greenF(w_n, mu=chempot),
+                       atol=1e-10)
+
+    g_tau = basis.eval_tau(coef)
+    assert np.allclose(basis.iw_to_tau(basis.tau_to_iw(g_tau)), g_tau,
+                       atol=1e-10)
+    tau = np.linspace(0, beta, 7)
+    assert np.allclose(basis.iw_to_tau(basis.eval_iw(coef), tau),
+                       basis.eval_tau(coef, tau), atol=1e-10)
+
+
+def test_dlr_fit_grids(beta=20.):
+    """Green functions sampled on the usual grids are fitted by least
+    squares"""
+    tau, w_n = gf.tau_wn_setup({'BETA': beta, 'N_MATSUBARA': 256})
+    giw = gf.greenF(w_n)
+    g_tau = gf.gw_invfouriertrans(giw, tau, w_n, [1., 0., 0.25])
+    basis = DLR(beta, 4.)
+
+    stacked = np.array([giw, 2 * giw])
+    coef = basis.fit_iw(stacked, w_n)
+    assert coef.shape == (2, basis.rank)
+    assert np.allclose(basis.eval_iw(coef, w_n), stacked, atol=1e-8)
+    assert np.allclose(basis.eval_tau(basis.fit_tau(g_tau, tau), tau), g_tau,
+                       atol=1e-6)
+    assert np.allclose(basis.eval_iw(basis.fit_tau(g_tau, tau), w_n[:10]),
+                       giw[:10], atol=1e-4)
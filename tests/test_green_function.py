@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Tests of the Green function container"""
+
+from __future__ import division, absolute_import, print_function
+import numpy as np
+import pytest
+import dmft.common as gf
+from dmft.green_function import GreenFunction
+
+
+def dimer_giw(w_n, tp=0.3):
+    """Non interacting Green function matrix of a dimer on the Bethe
+    lattice, with particle-hole symmetry"""
+    g_bond = gf.greenF(w_n, mu=tp)
+    g_anti = gf.greenF(w_n, mu=-tp)
+    return np.array([[g_bond + g_anti, g_bond - g_anti],
+                     [g_bond - g_anti, g_bond + g_anti]]) / 2
+
+
+def test_lazy_transforms(monkeypatch):
+    """The other representation is transformed once and until the data
+    change"""
+    tau, w_n = gf.tau_wn_setup({'BETA': 40., 'N_MATSUBARA': 128})
+    giw = gf.greenF(w_n, mu=0.2)
+    gfunc = GreenFunction(tau, w_n, tail=[1., -0.2, 0.25], giw=giw)
+    gtau = gf.gw_invfouriertrans(giw, tau, w_n, [1., -0.2, 0.25])
+    gtau_0 = gf.gw_invfouriertrans(giw, tau, w_n, [1., -0.2, 0.])
+    calls = []
+    inverse = gfunc.plan.inverse
+    monkeypatch.setattr(gfunc.plan, 'inverse',
+                        lambda *args: calls.append(1) or inverse(*args))
+
+    assert np.allclose(gfunc.gtau, gtau)
+    assert np.allclose(gfunc.gtau, gtau)
+    assert len(calls) == 1
+    with pytest.raises(ValueError):
+        gfunc.gtau[0] = 1.
+
+    gfunc.tail = [1., -0.2, 0.]
+    assert np.allclose(gfunc.gtau, gtau_0)
+    assert len(calls) == 2
+    assert np.allclose(gfunc.giw, giw)
+    with pytest.raises(KeyError):
+        gfunc['up']
+
+    gfunc.gtau = gtau_0
+    assert np.allclose(gfunc.giw, giw)
+    assert len(calls) == 2
+
+
+def test_symmetric_storage(tmpdir):
+    """Declared symmetries store the independent components"""
+    tau, w_n = gf.tau_wn_setup({'BETA': 40., 'N_MATSUBARA': 128})
+    giw = dimer_giw(w_n)
+    tail = [np.eye(2), [[0, 0.3], [0.3, 0]], np.eye(2) * 0.34]
+    full = GreenFunction(tau, w_n, (2, 2), ['up', 'dw'], tail,
+                         giw=[giw, giw])
+    sym = GreenFunction(tau, w_n, (2, 2), ['up', 'dw'], tail,
+                        ['paramagnetic', 'particle_hole'],
+                        giw=[1.1 * giw, 0.9 * giw])
+
+    assert sym.nbytes * 4 == full.nbytes
+    assert np.allclose(sym.giw, full.giw)
+    assert np.allclose(sym['dw'], giw)
+    with pytest.raises(KeyError):
+        sym['dn']
+    assert np.allclose(sym.gtau, full.gtau)
+    assert np.allclose(full.gtau[0, 0, 0],
+                       gf.gw_invfouriertrans(giw[0, 0], tau, w_n,
+                                             [1., 0., 0.34]))
+
+    fname = str(tmpdir.join('gf.npz'))
+    sym.save(fname)
+    loaded = GreenFunction.load(fname)
+    assert loaded.symmetry == sym.symmetry and loaded.blocks == sym.blocks
+    assert np.allclose(loaded.giw, sym.giw)
+    assert np.allclose(loaded.gtau, sym.gtau)
+    with pytest.raises(ValueError):
+        GreenFunction(tau, w_n, symmetry='paramagnetic')
@@ -9,6 +9,7 @@ from __future__ import division, absolute_import, print_function
 import numpy as np
 from dmft import ipt_imag
 from dmft.common import greenF, tau_wn_setup
+from dmft.dlr import DLR
 import dmft.dimer as dimer
 import slaveparticles.quantum.operators as op
 import pytest
@@ -77,6 +78,18 @@ def test_ipt_pm_g(u_int, result, beta=50., n_matsubara=64):
     assert np.allclose(result, g_iwn, atol=3e-3)
 
 
+@pytest.mark.parametrize("u_int, result", ipt_ref_res)
+def test_ipt_dlr_pm_g(u_int, result, beta=50.):
+    """The loop on the nodes of the discrete Lehmann representation finds
+    the solution of the full Matsubara grid"""
+    _, w_n = tau_wn_setup(dict(BETA=beta, N_MATSUBARA=64))
+    basis = DLR(beta, 8.)
+    g_iwn, _ = ipt_imag.dlr_dmft_loop(u_int, 0.5, basis, conv=1e-5)
+
+    assert np.allclose(result, basis.eval_iw(basis.fit_iw(g_iwn), w_n),
+                       atol=3e-3)
+
+
 @pytest.mark.parametrize("u_int, result", ipt_ref_res)
 def test_ipt_dimer_pm_g(u_int, result, beta=50.):
     tau, w_n = tau_wn_setup(dict(BETA=beta, N_MATSUBARA=256))
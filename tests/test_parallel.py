@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the communicators of the solvers
+"""
+
+from __future__ import division, absolute_import, print_function
+import sys
+import numpy as np
+import dmft.parallel as par
+
+
+def test_serial_comm():
+    """A single rank reduces to its own data"""
+    comm = par.SerialComm()
+    recv = np.zeros(3)
+    comm.Allreduce(np.arange(3.), recv)
+    assert np.array_equal(recv, np.arange(3.))
+    assert comm.allreduce(2.5, op=par.MAX) == 2.5
+    assert comm.allgather({'a': 1}) == [{'a': 1}]
+    assert comm.bcast(7) == 7
+    group = comm.Split(0, comm.rank)
+    assert (group.rank, group.size) == (0, 1)
+    group.Free()
+
+
+def test_threaded_collectives(monkeypatch):
+    """Concurrent collectives need MPI with THREAD_MULTIPLE"""
+    assert par.threaded_collectives(par.SerialComm())
+    if par.MPI is not None:
+        monkeypatch.setattr(par.MPI, 'Query_thread',
+                            lambda: par.MPI.THREAD_SERIALIZED)
+        assert not par.threaded_collectives(par.MPI.COMM_WORLD)
+        assert par.threaded_collectives(par.SerialComm())
+
+
+def test_without_mpi(monkeypatch):
+    """Without mpi4py the default communicator is serial"""
+    monkeypatch.setitem(sys.modules, 'mpi4py', None)
+    try:
+        reload_par = __import__('importlib').reload(par)
+        assert reload_par.MPI is None
+        assert isinstance(reload_par.default_comm(), reload_par.SerialComm)
+    finally:
+        monkeypatch.undo()
+        __import__('importlib').reload(par)
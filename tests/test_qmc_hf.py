@@ -6,12 +6,14 @@ Created on Tue Nov 25 12:44:23 2014
 """
 
 from __future__ import division, absolute_import, print_function
-from itertools import product
+from itertools import combinations, product
 from random import randrange
 import os
+import shutil
 import numpy as np
 import scipy.linalg as la
 import pytest
+import dmft.common as gf
 import dmft.common_complex as cgf
 import dmft.hirschfye as hf
 import dmft.plot.hf_single_site as phf
@@ -118,14 +120,66 @@ def generate_random_gf(beta, size):
     return g_tau
 
 
+def block_average(gmat, sites, slices):
+    """Averages along the diagonals of every site block of gmat, the
+    antiperiodic function of the time difference they hold"""
+    gtau = np.empty((sites, sites, slices), gmat.dtype)
+    for i, j in product(range(sites), repeat=2):
+        block = gmat[i * slices:(i + 1) * slices, j * slices:(j + 1) * slices]
+        diag = np.array([np.trace(block, offset=slices - k)
+                         for k in range(2 * slices)])
+        gtau[i, j] = (diag[slices:] - diag[:slices]) / slices
+    return gtau
+
+
 @pytest.mark.parametrize("sites", [1, 2, 3])
 def test_retardedweissfield_and_back(sites):
     g0t = generate_random_gf(16, sites)
     g0ttp = hf.retarded_weiss(g0t)
-    col_g0t = -1 * hf.avg_g(g0ttp, dict(SITES=sites, N_MATSUBARA=16))
+    col_g0t = -1 * block_average(g0ttp, sites, 32)
     assert np.allclose(g0t, col_g0t)
 
 
+@pytest.mark.parametrize("sites", [1, 2])
+def test_retarded_weiss_stack(sites):
+    """All blocks at once, into a buffer or from the generating vector,
+    give the antiperiodic Toeplitz matrices"""
+    g0t = np.array([generate_random_gf(16, sites) for _ in range(3)])
+    slices = g0t.shape[-1]
+    step = np.arange(slices)
+    lag = np.subtract.outer(step, step)
+    out = np.empty((3, slices * sites, slices * sites), g0t.dtype)
+    assert hf.retarded_weiss(g0t, out) is out
+    for bad in (np.empty_like(out).swapaxes(1, 2), out[:2],
+                out.astype(np.float32)):
+        with pytest.raises(ValueError):
+            hf.retarded_weiss(g0t, bad)
+    for g0b, gmat in zip(g0t, out):
+        for i, j in product(range(sites), repeat=2):
+            block = gmat[i * slices:(i + 1) * slices,
+                         j * slices:(j + 1) * slices]
+            assert np.allclose(block, np.where(lag >= 0, -1, 1) *
+                               g0b[i, j][lag % slices])
+        assert np.array_equal(gmat, hf.retarded_weiss(g0b))
+        weiss = hf.ToeplitzWeiss(g0b)
+        assert weiss.shape == gmat.shape
+        assert np.array_equal(np.asarray(weiss), gmat)
+        assert np.array_equal(weiss.first_column(), gmat[:, 0])
+
+
+def test_solver_toeplitz_weiss():
+    """Keeping only the generating vectors samples the same chain"""
+    parms = dict(SOLVER_PARAMS, U=2., MU=0., SITES=1, sweeps=300, therm=100,
+                 work_dir='/tmp/testdmft_toeplitz')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n)
+    dense = hf.imp_solver([g0t, g0t], v.copy(), intm, parms)
+    toeplitz = hf.imp_solver([g0t, g0t], v.copy(), intm,
+                             dict(parms, toeplitz_weiss=True))
+    assert np.allclose(dense, toeplitz)
+
+
 @pytest.mark.parametrize("chempot, u_int, updater",
                          product([0, 0.3], [2, 2.3], [hf.g2flip, hffast.g2flip]))
 def test_hf_fast_2flip(chempot, u_int, updater):
@@ -147,6 +201,300 @@ def test_hf_fast_2flip(chempot, u_int, updater):
     assert np.allclose(g_flip, g_fast_flip)
 
 
+@pytest.mark.parametrize("sites, delay, double_flip_prob",
+                         [(1, 4, 0.), (1, 64, 0.), (2, 16, 0.), (2, 8, 0.3)])
+def test_hf_delayed_sweep(sites, delay, double_flip_prob):
+    """Test the delayed update sweep against the one flip at a time sweep"""
+    parms = dict(UPDATE_PARAMS, MU=0., U=2.5, SITES=sites)
+    _, _, g0t, _, v, _ = hf.setup_PM_sim(parms)
+    v = np.squeeze(v)
+    if sites > 1:
+        g0t = np.array([[g0t, .1 * g0t], [.1 * g0t, g0t]])
+    g0ttp = hf.retarded_weiss(g0t)
+    kroneker = np.eye(v.size)
+    gup = hf.gnewclean(g0ttp, v, kroneker)
+    gdw = hf.gnewclean(g0ttp, -v, kroneker)
+
+    ref = [np.copy(gup), np.copy(gdw), np.copy(v)]
+    hffast.set_seed(2017)
+    acc_ref = hffast.updateDHS(ref[0], ref[1], ref[2], 32, double_flip_prob)
+
+    delayed = [np.copy(gup), np.copy(gdw), np.copy(v)]
+    hffast.set_seed(2017)
+    acc = hffast.updateDHS_delayed(delayed[0], delayed[1], delayed[2], 32,
+                                   delay, double_flip_prob)
+
+    assert acc == acc_ref
+    assert np.allclose(ref[2], delayed[2])
+    assert np.allclose(ref[0], delayed[0])
+    assert np.allclose(ref[1], delayed[1])
+    assert np.allclose(hf.gnewclean(g0ttp, delayed[2], kroneker), delayed[0])
+
+
+@pytest.mark.parametrize("delay, double_flip_prob",
+                         [(1, 0.), (1, 0.3), (8, 0.), (8, 0.3)])
+def test_hf_complex_sweep(delay, double_flip_prob):
+    """A complex Weiss field related to a real one by a gauge
+    transformation is sampled identically by the complex kernels"""
+    parms = dict(UPDATE_PARAMS, MU=0., U=2.5, SITES=2)
+    _, _, g0t, _, v, _ = hf.setup_PM_sim(parms)
+    v = np.squeeze(v)
+    g0t = np.array([[g0t, .1 * g0t], [.1 * g0t, g0t]])
+    g0ttp = hf.retarded_weiss(g0t)
+    phase = np.exp(1j * np.random.RandomState(5).uniform(0, 6, v.size))
+    g0ttp_c = phase[:, None] * g0ttp * phase.conj()
+    kroneker = np.eye(v.size)
+
+    real = [hf.gnewclean(g0ttp, v, kroneker),
+            hf.gnewclean(g0ttp, -v, kroneker), np.copy(v)]
+    cplx = [hf.gnewclean(g0ttp_c, v, kroneker),
+            hf.gnewclean(g0ttp_c, -v, kroneker), np.copy(v)]
+    for g in (real, cplx):
+        hffast.set_seed(2017)
+        if delay > 1:
+            g.append(hffast.updateDHS_delayed(g[0], g[1], g[2], 32, delay,
+                                              double_flip_prob))
+        else:
+            g.append(hffast.updateDHS(g[0], g[1], g[2], 32,
+                                      double_flip_prob))
+
+    assert cplx[0].dtype == np.complex128
+    assert cplx[3] == real[3]
+    assert np.allclose(cplx[2], real[2])
+    for gc, gr in zip(cplx[:2], real[:2]):
+        assert np.allclose(gc, phase[:, None] * gr * phase.conj())
+    assert np.allclose(hf.gnewclean(g0ttp_c, cplx[2], kroneker), cplx[0])
+
+
+@pytest.mark.parametrize("delay, double_flip_prob",
+                         [(1, 0.), (1, 0.3), (8, 0.)])
+def test_hf_single_precision_sweep(delay, double_flip_prob):
+    """Float32 sweeps accept the same flips as the float64 ones"""
+    parms = dict(UPDATE_PARAMS, MU=0., U=2.5, SITES=2)
+    _, _, g0t, _, v, _ = hf.setup_PM_sim(parms)
+    v = np.squeeze(v)
+    g0t = np.array([[g0t, .1 * g0t], [.1 * g0t, g0t]])
+    g0ttp = hf.retarded_weiss(g0t)
+    kroneker = np.eye(v.size)
+
+    double = [hf.gnewclean(g0ttp, v, kroneker),
+              hf.gnewclean(g0ttp, -v, kroneker), np.copy(v)]
+    single = [double[0].astype(np.float32), double[1].astype(np.float32),
+              np.copy(v)]
+    for g in (double, single):
+        hffast.set_seed(2017)
+        if delay > 1:
+            g.append(hffast.updateDHS_delayed(g[0], g[1], g[2], 32, delay,
+                                              double_flip_prob))
+        else:
+            g.append(hffast.updateDHS(g[0], g[1], g[2], 32,
+                                      double_flip_prob))
+
+    assert single[0].dtype == np.float32
+    assert single[3] == double[3]
+    assert np.array_equal(single[2], double[2])
+    for gs, gd in zip(single[:2], double[:2]):
+        assert np.allclose(gs, gd, atol=1e-4)
+
+
+@pytest.mark.parametrize("sites, cluster, dtype",
+                         [(2, 2, np.float64), (3, 0, np.float64),
+                          (3, 2, np.complex128), (3, 0, np.float32)])
+def test_hf_cluster_sweep(sites, cluster, dtype):
+    """Cluster moves keep the Green functions exact and sample the
+    determinant weight of the Ising fields"""
+    parms = dict(UPDATE_PARAMS, MU=0., U=4., SITES=sites, BETA=1.,
+                 N_MATSUBARA=1)
+    _, _, g0t, _, v, _ = hf.setup_PM_sim(parms)
+    v = np.squeeze(v)
+    g0t = np.array([[g0t if a == b else .3 * g0t for b in range(sites)]
+                    for a in range(sites)])
+    g0ttp = hf.retarded_weiss(g0t).astype(dtype)
+    kroneker = np.eye(v.size)
+    lam = np.abs(v).max()
+
+    configs = np.array(list(product([-1, 1], repeat=v.size)))
+    weight = np.array([np.prod([la.det(kroneker - (np.exp(sign * lam * c) - 1)
+                                       * (g0ttp - kroneker)).real
+                                for sign in (1, -1)]) for c in configs])
+    weight /= weight.sum()
+
+    g = [hf.gnewclean(g0ttp, v, kroneker).astype(dtype),
+         hf.gnewclean(g0ttp, -v, kroneker).astype(dtype)]
+    rng = hffast.Rng(5)
+    counts = {}
+    for _ in range(20000):
+        hffast.updateDHS(g[0], g[1], v, 2, 0.5, False, rng, cluster)
+        key = tuple(np.sign(v).astype(int))
+        counts[key] = counts.get(key, 0) + 1
+    sampled = np.array([counts.get(tuple(c), 0) for c in configs]) / 20000.
+
+    assert np.allclose(sampled, weight, atol=0.015)
+    atol = 5e-3 if dtype == np.float32 else 1e-8
+    assert np.allclose(g[0], hf.gnewclean(g0ttp, v, kroneker), atol=atol)
+    assert np.allclose(g[1], hf.gnewclean(g0ttp, -v, kroneker), atol=atol)
+
+
+@pytest.mark.parametrize("bands, delay", product([2, 3], [1, 4]))
+def test_hf_fields_sweep(bands, delay):
+    """One compiled pass over all the Ising fields matches sweeping them
+    one at a time"""
+    parms = dict(UPDATE_PARAMS, MU=0., U=2., SITES=1, BANDS=bands)
+    _, _, g0t, _, v, intm = hf.setup_PM_sim(parms)
+    g0ttp = hf.retarded_weiss(g0t)
+    kroneker = np.eye(v.shape[1])
+    g_clean = [hf.gnewclean(g0ttp, lv, kroneker) for lv in np.dot(intm, v)]
+    pairs = hf.field_pairs(intm)
+    assert pairs.shape == (bands * (2 * bands - 1), 2)
+
+    g_ref, v_ref, rng = [np.copy(gb) for gb in g_clean], np.copy(v), \
+        hffast.Rng(3)
+    acc_ref = 0
+    for _ in range(3):
+        for i, (up, dw) in enumerate(pairs):
+            acc_ref += hffast.updateDHS_delayed(g_ref[up], g_ref[dw], v_ref[i],
+                                                32, delay, 0., True, rng)[0]
+
+    g, rng = hf.block_stack(g_clean, np.float64), hffast.Rng(3)
+    accepted = np.zeros(v.shape, np.intc)
+    acc = sum(hffast.updateDHS_fields(g, v, pairs, 32, delay, 0., True, rng,
+                                      2, accepted)[0] for _ in range(3))
+
+    assert acc == acc_ref == accepted.sum()
+    assert np.array_equal(v, v_ref)
+    assert np.allclose(g, g_ref)
+    for gb, lv in zip(g, np.dot(intm, v)):
+        assert np.allclose(gb, hf.gnewclean(g0ttp, lv, kroneker))
+    with pytest.raises(ValueError):
+        hffast.updateDHS_fields(np.array(g_clean), v, pairs, 32)
+
+
+def test_hf_run_sweeps():
+    """The compiled driver sweeps, cleans and measures as the separate
+    kernels"""
+    parms = dict(UPDATE_PARAMS, MU=0., U=2., SITES=1, BANDS=1)
+    _, _, g0t, _, v, intm = hf.setup_PM_sim(parms)
+    gx = hf.retarded_weiss(g0t)
+    slices = v.shape[1]
+    kroneker = np.eye(slices)
+    pairs = hf.field_pairs(intm)
+    g_clean = [hf.gnewclean(gx, lv, kroneker) for lv in np.dot(intm, v)]
+    gtau, occ, docc = np.zeros((2, 1, 1, slices)), np.zeros(2), np.zeros(1)
+
+    g_ref, v_ref, rng = hf.block_stack(g_clean, float), v.copy(), \
+        hffast.Rng(5)
+    gtau_ref, occ_ref, docc_ref = np.zeros_like(gtau), np.zeros(2), np.zeros(1)
+    chi_ref, chi = np.zeros(slices), np.zeros(slices)
+    acc_ref, drift_ref = 0, []
+    for mcs in range(6):
+        if mcs == 4:
+            clean = [hf.gnewclean(gx, lv, kroneker)
+                     for lv in np.dot(intm, v_ref)]
+            drift_ref.append(np.abs(np.array(clean) - g_ref).max())
+            g_ref = hf.block_stack(clean, float)
+        for _ in range(2):
+            acc_ref += hffast.updateDHS_fields(g_ref, v_ref, pairs, slices,
+                                               1, 0., True, rng)[0]
+        if mcs > 1:
+            hffast.measure(g_ref, gtau_ref, occ_ref, docc_ref, slices)
+            if mcs % 2 == 0:  # every second measurement, after one
+                hf.measure_chi(g_ref, chi_ref, slices)
+
+    g, rng = hf.block_stack(g_clean, float), hffast.Rng(5)
+    drift = np.zeros((2, 2))
+    acc, nrat, measured, next_clean, cleans, chi_measured = \
+        hffast.run_sweeps(g, hf.block_stack([gx, gx], float), v, pairs,
+                          intm.astype(float), slices, 0, 6, 4, 4, 1, gtau,
+                          occ, docc, drift, 2, 1, 0., True, rng, chi=chi,
+                          chi_interval=2, measured_before=1)
+
+    assert acc == acc_ref
+    assert (measured, next_clean, cleans, chi_measured) == (4, 8, 1, 2)
+    assert np.allclose(chi, chi_ref)
+    assert np.array_equal(v, v_ref)
+    assert np.allclose(g, g_ref)
+    assert np.allclose(gtau, gtau_ref)
+    assert np.allclose(occ, occ_ref) and np.allclose(docc, docc_ref)
+    assert drift[0, 0] == 4 and np.isclose(drift[0, 1], drift_ref[0])
+    with pytest.raises(ValueError):
+        hffast.run_sweeps(g, hf.block_stack([gx, gx], float), v, pairs,
+                          intm.astype(float), slices, 0, 12, 4, 4, 1, gtau,
+                          occ, docc, np.zeros((1, 2)))
+
+
+def test_solver_multiband():
+    """All flavors of a degenerate two band model agree"""
+    parms = dict(SOLVER_PARAMS, U=1.5, MU=0., SITES=1, BANDS=2, sweeps=2000,
+                 therm=300, work_dir='/tmp/testdmft_bands')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n)
+    gt = np.squeeze(hf.imp_solver([g0t] * 4, v, intm, parms))
+    assert gt.shape == (4, len(tau))
+    g_mean = gt.mean(0)
+    assert np.allclose(gt, g_mean, atol=0.04)
+    assert np.allclose(g_mean[1:], g_mean[:0:-1], atol=0.01)
+    assert np.load(os.path.join(parms['work_dir'], 'double_occ.npy')).size == 6
+
+
+def test_hf_chain_rng():
+    """Sweeps with their own random generator are reproducible and
+    independent of the module wide generator"""
+    parms = dict(UPDATE_PARAMS, MU=0., U=2.5, SITES=1)
+    _, _, g0t, _, v, _ = hf.setup_PM_sim(parms)
+    v = np.squeeze(v)
+    g0ttp = hf.retarded_weiss(g0t)
+    kroneker = np.eye(v.size)
+    gup = hf.gnewclean(g0ttp, v, kroneker)
+    gdw = hf.gnewclean(g0ttp, -v, kroneker)
+
+    chains = []
+    for seed in [7, 7, 8]:
+        chain = [np.copy(gup), np.copy(gdw), np.copy(v)]
+        rng = hffast.Rng(seed)
+        hffast.set_seed(seed + 100)
+        for _ in range(3):
+            hffast.updateDHS(chain[0], chain[1], chain[2], 32, rng=rng)
+        chains.append(chain)
+
+    assert np.allclose(chains[0][0], chains[1][0])
+    assert np.array_equal(chains[0][2], chains[1][2])
+    assert not np.array_equal(chains[0][2], chains[2][2])
+
+
+@pytest.mark.parametrize("drift, interval", [(1e-5, 50), (5e-7, 100),
+                                             (1e-9, 200)])
+def test_adapt_clean_interval(drift, interval):
+    assert hf.adapt_clean_interval(100, drift, 1e-6, 800) == interval
+    assert hf.adapt_clean_interval(800, 1e-9, 1e-6, 800) == 800
+
+
+@pytest.mark.parametrize("sites", [1, 2, 3])
+def test_measure(sites):
+    """The compiled measurements match the matrix averages"""
+    slices = 16
+    g = [np.asfortranarray(np.random.randn(sites * slices, sites * slices)),
+         np.random.randn(sites * slices, sites * slices)]
+    flavors_ind = list(product(range(2), range(sites)))
+    flavor_pairs = list(combinations(flavors_ind, 2))
+    diag = {(spin, site): np.diag(g[spin])[site * slices:
+                                           (site + 1) * slices]
+            for spin, site in flavors_ind}
+    occupation = np.array([diag[flavor].sum() for flavor in flavors_ind])
+    double_occ = np.array([np.dot(diag[i], diag[j])
+                           for i, j in flavor_pairs])
+    gtau_ref = [block_average(gm, sites, slices) for gm in g]
+
+    gtau = np.zeros((2, sites, sites, slices))
+    occ = np.zeros_like(occupation)
+    docc = np.zeros_like(double_occ)
+    hffast.measure(g, gtau, occ, docc, slices)
+
+    assert np.allclose(gtau_ref, gtau)
+    assert np.allclose(occupation, occ)
+    assert np.allclose(double_occ, docc)
+
+
 SOLVER_PARAMS = UPDATE_PARAMS
 SOLVER_PARAMS.update({'sweeps': 3000, 'therm': 1000, 'meas': 3, 'SEED': 4213,
                       'save_logs': False, 'global_flip': True,
@@ -191,6 +539,233 @@ def test_solver(chempot, u_int, gend):
     assert np.allclose(gend, g, atol=6e-3)
 
 
+@pytest.mark.parametrize("chempot, u_int, gend", SINGLE_BAND_GF_REF)
+def test_solver_chains(chempot, u_int, gend):
+    parms = dict(SOLVER_PARAMS, U=u_int, MU=chempot, SITES=1, chains=2,
+                 work_dir='/tmp/testdmft_chains')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n + parms['MU'] - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n, [1., -parms['MU'], 0.])
+    gtu, gtd = hf.imp_solver([g0t, g0t], v, intm, parms)
+    g = np.squeeze(0.5 * (gtu + gtd))
+    assert np.allclose(gend, g, atol=6e-3)
+
+
+@pytest.mark.parametrize("target_error", [0., 5e-3])
+def test_solver_process_pool(target_error):
+    """Chains in a process pool reproduce those run in threads"""
+    parms = dict(SOLVER_PARAMS, U=2., MU=0., SITES=1, chains=2, sweeps=300,
+                 therm=100, target_error=target_error, check_interval=50,
+                 work_dir='/tmp/testdmft_pool')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n)
+    v_threads, v_processes = v.copy(), v.copy()
+    threads = hf.imp_solver([g0t, g0t], v_threads, intm, parms,
+                            hf.SerialComm())
+    processes = hf.imp_solver([g0t, g0t], v_processes, intm,
+                              dict(parms, backend='processes'))
+    assert np.allclose(threads, processes)
+    assert np.array_equal(v_threads, v_processes)
+    with pytest.raises(ValueError):
+        hf.imp_solver([g0t, g0t], v, intm, dict(parms, backend='mpi'))
+
+
+@pytest.mark.parametrize("noise", [0., 2e-3])
+def test_density_control(noise):
+    """The secant update reaches the target density of a noisy n(mu)"""
+    rng = np.random.RandomState(4)
+    control = hf.DensityControl(1.3, 0., dndmu=0.5)
+    mu = control.mu
+    for _ in range(20):
+        density = 1 + np.tanh(1.5 * mu) + noise * rng.randn()
+        mu = control.update(density, noise)
+    assert control.converged(1e-3)
+    assert abs(mu - np.arctanh(.3) / 1.5) < 10 * noise + 1e-3
+    assert abs(control.dndmu - 1.5 / np.cosh(1.5 * mu)**2) < 0.3
+
+
+def test_solver_complex():
+    """A complex Weiss field runs the complex kernels to the same result"""
+    parms = dict(SOLVER_PARAMS, U=2.3, MU=0., SITES=1, sweeps=400, therm=100,
+                 SEED=17, work_dir='/tmp/testdmft_complex')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n)
+    gtu, gtd = hf.imp_solver([g0t, g0t], v.copy(), intm, parms)
+    g0c = g0t.astype(np.complex128)
+    gtu_c, gtd_c = hf.imp_solver([g0c, g0c], v.copy(), intm, parms)
+    assert gtu_c.dtype == np.complex128
+    assert np.allclose(gtu_c, gtu)
+    assert np.allclose(gtd_c, gtd)
+
+
+def test_solver_precision():
+    """Single precision sweeps during thermalization and measurements in
+    double precision reproduce the double precision chain"""
+    parms = dict(SOLVER_PARAMS, U=2.3, MU=0., SITES=1, sweeps=400, therm=100,
+                 SEED=17, work_dir='/tmp/testdmft_precision')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n)
+    gtu, gtd = hf.imp_solver([g0t, g0t], v.copy(), intm, parms)
+    parms['precision'] = 'therm'
+    gtu_t, gtd_t = hf.imp_solver([g0t, g0t], v.copy(), intm, parms)
+    assert gtu_t.dtype == np.float64
+    assert np.allclose(gtu_t, gtu)
+    assert np.allclose(gtd_t, gtd)
+
+    parms['precision'] = 'single'
+    gtu_s, gtd_s = hf.imp_solver([g0t, g0t], v.copy(), intm, parms)
+    assert gtu_s.dtype == np.float64
+    assert np.allclose(gtu_s, gtu, atol=1e-3)
+
+    g0c = g0t.astype(np.complex128)
+    with pytest.raises(ValueError):
+        hf.imp_solver([g0c, g0c], v.copy(), intm, parms)
+
+
+def test_precision_check():
+    """The float32 fast updates stay close to the exact Green functions"""
+    parms = dict(SOLVER_PARAMS, U=2.5, MU=0., SITES=1, SEED=3)
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    out = hf.precision_check([g0t, g0t], v, intm, parms, 20)
+    assert len(out['drift']) == 20
+    assert out['agree'] == 20
+    assert out['drift64'].max() < 1e-9
+    assert 1e-9 < out['drift'].max() < 1e-2
+    assert np.allclose(out['deviation'], out['drift'][:20], atol=1e-6)
+
+
+def test_warm_start(tmpdir):
+    """The Ising fields saved by a run seed the next one, also at a
+    different U and number of ranks"""
+    source = str(tmpdir)
+    chains_v = [np.array([[1., -1., 1., 1.]]), np.array([[-1., -1., 1., 1.]])]
+    hf.save_ising(chains_v, source, 0)
+    hf.save_ising([-chains_v[0], chains_v[1]], source, 1)
+
+    fields = [np.full((1, 4), .5), np.full((1, 4), .5)]
+    assert hf.warm_start(fields, source, 3)
+    assert np.array_equal(fields[0], -.5 * chains_v[0])
+    assert np.array_equal(fields[1], .5 * chains_v[1])
+
+    fields = [np.full((1, 4), .5)] * 3
+    assert hf.warm_start(fields, source, 0)
+    assert np.array_equal(fields[2], .5 * chains_v[0])
+    assert not hf.warm_start([np.ones((1, 6))], source, 0)
+    assert not hf.warm_start([np.ones((1, 4))], source + '/none', 0)
+
+
+def test_solver_warm_start(monkeypatch):
+    """A warm started run thermalizes parms['warm_therm'] sweeps"""
+    parms = dict(SOLVER_PARAMS, U=2.3, MU=0., SITES=1, sweeps=200, therm=400,
+                 SEED=17, work_dir='/tmp/testdmft_warm/it000')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n)
+    hf.imp_solver([g0t, g0t], v, intm, parms)
+    saved = np.load(os.path.join(parms['work_dir'], 'ising_r0.npy'))
+    assert np.array_equal(saved[0], np.sign(v))
+
+    parms.update(U=2.5, warm_therm=20, warm_start=parms['work_dir'],
+                 work_dir='/tmp/testdmft_warm/it001')
+    _, _, _, _, v_new, _ = hf.setup_PM_sim(parms)
+    calls = []
+    markov_chain = hf.markov_chain
+
+    def chain(*args):
+        calls.append(args[3]['therm_sweeps'])
+        return markov_chain(*args)
+    monkeypatch.setattr(hf, 'markov_chain', chain)
+    hf.imp_solver([g0t, g0t], v_new, intm, parms)
+    assert calls == [20]
+    assert np.allclose(np.abs(v_new),
+                       np.abs(hf.ising_v(parms['dtau_mc'], 2.5, 1)))
+
+
+def test_solver_legendre():
+    """G(tau) reduced in Legendre coefficients"""
+    chempot, u_int, gend = SINGLE_BAND_GF_REF[1]
+    parms = dict(SOLVER_PARAMS, U=u_int, MU=chempot, SITES=1, legendre=30,
+                 work_dir='/tmp/testdmft_legendre')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n + parms['MU'] - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n, [1., -parms['MU'], 0.])
+    gtu, gtd = hf.imp_solver([g0t, g0t], v, intm, parms)
+    assert np.allclose(gend, np.squeeze(0.5 * (gtu + gtd)), atol=6e-3)
+    g_l = np.load(os.path.join(parms['work_dir'], 'gl.npy'))
+    assert g_l.shape == (2, 1, 1, 30)
+    assert np.allclose(gtu, gf.gl_invlegendretrans(g_l[0], tau, parms['BETA']))
+
+
+def test_solver_drift():
+    """The adaptive clean update keeps the drift of fast updates in check"""
+    parms = dict(SOLVER_PARAMS, U=2.3, MU=0., SITES=1, sweeps=600, therm=200,
+                 clean_interval=20, drift_tol=1e-9,
+                 work_dir='/tmp/testdmft_drift')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n)
+    hf.imp_solver([g0t, g0t], v, intm, parms)
+    drift = np.load(os.path.join(parms['work_dir'], 'drift.npy'))
+    assert drift.shape[1] == 3
+    assert (drift[:, 1] < 1e-8).all()
+    assert drift[-1, 2] > 20
+
+
+def test_solver_error_analysis():
+    """Error bars of the solver cover the reference Green function"""
+    chempot, u_int, gend = SINGLE_BAND_GF_REF[1]
+    parms = dict(SOLVER_PARAMS, U=u_int, MU=chempot, SITES=1,
+                 error_analysis=True, work_dir='/tmp/testdmft_errors')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n + parms['MU'] - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n, [1., -parms['MU'], 0.])
+    out = hf.imp_solver_results([g0t, g0t], v, intm, parms)
+    gt, errors = out['gtau'], out['errors']
+    assert out['sigma'] is None
+    assert sorted(errors) == ['double_occ', 'gtau', 'occupation']
+    gerr = np.squeeze(errors['gtau']['error'])
+    assert gerr.shape == (2, 32)
+    assert (np.abs(np.squeeze(gt) - gend) < 4 * gerr + 2e-3).all()
+    assert (errors['occupation']['tau_int'] > 0).all()
+
+
+def test_improved_sigma():
+    """A density uncorrelated with G gives the Hartree self-energy"""
+    beta, dens = 16., 0.3
+    tau, w_n = gf.tau_wn_setup(dict(BETA=beta, N_MATSUBARA=32))
+    g_t = gf.gw_invfouriertrans(gf.greenF(w_n, mu=0.2), tau, w_n,
+                                [1., -0.2, 0.])
+    g_t = g_t.reshape(1, 1, 1, -1)
+    sigma = hf.improved_sigma(dens * g_t, g_t, np.array([[dens]]), [1],
+                              2., beta)
+    assert sigma.shape == (1, 1, 1, 32)
+    assert np.allclose(sigma, 2. * (dens - .5))
+
+
+def test_solver_improved_sigma():
+    """The improved estimator agrees with the Dyson self-energy"""
+    parms = dict(SOLVER_PARAMS, U=2., MU=0., SITES=1, sweeps=3000,
+                 therm=300, improved_sigma=True,
+                 work_dir='/tmp/testdmft_sigma')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n)
+    out = hf.imp_solver_results([g0t, g0t], v, intm, parms)
+    gt, sigma = out['gtau'], out['sigma']
+    assert out['errors'] is None
+    assert sigma.shape == (2, 1, 1, parms['N_MATSUBARA'])
+    assert os.path.exists(os.path.join(parms['work_dir'], 'sigma_iw.npy'))
+    g_iw = gf.gt_fouriertrans(np.squeeze(gt).mean(0), tau, w_n,
+                              [1., 0., parms['U']**2 / 4 + .25])
+    dyson = 1 / G0iw - 1 / g_iw
+    sig = np.squeeze(sigma).mean(0)
+    assert (sig.imag < 0).all()
+    assert np.allclose(sig[:5], dyson[:5], atol=0.06)
+
+
 @pytest.mark.parametrize("chempot, u_int, gend", SINGLE_BAND_GF_REF)
 def test_solver_dimer(chempot, u_int, gend):
     parms = SOLVER_PARAMS
@@ -206,3 +781,268 @@ def test_solver_dimer(chempot, u_int, gend):
     assert np.allclose(np.zeros_like(g0t), g[0, 1], atol=6e-3)
     assert np.allclose(np.zeros_like(g0t), g[1, 0], atol=6e-3)
     assert np.allclose(gend, g[1, 1], atol=6e-3)
+
+
+def test_solver_checkpoint(monkeypatch):
+    """An interrupted solver resumes from its checkpoint, which only
+    matches the same run and is removed once it finishes"""
+    parms = dict(SOLVER_PARAMS, U=2.3, MU=0., SITES=1, sweeps=400, therm=100,
+                 checkpoint=50, compiled_driver=False,
+                 work_dir='/tmp/testdmft_checkpoint')
+    if os.path.exists(parms['work_dir']):
+        shutil.rmtree(parms['work_dir'])
+    os.makedirs(parms['work_dir'])
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n)
+
+    reference = hf.imp_solver([g0t, g0t], v.copy(), intm,
+                              dict(parms, checkpoint=0))
+
+    update = hf.hffast.updateDHS_fields
+    calls = []
+
+    def preempted(*args):
+        calls.append(1)
+        if len(calls) > 260:
+            raise KeyboardInterrupt
+        return update(*args)
+
+    def update_counted(*args):
+        calls.append(1)
+        return update(*args)
+
+    monkeypatch.setattr(hf.hffast, 'updateDHS_fields', preempted)
+    with pytest.raises(KeyboardInterrupt):
+        hf.imp_solver([g0t, g0t], v.copy(), intm, parms)
+    monkeypatch.setattr(hf.hffast, 'updateDHS_fields', update)
+
+    label = os.path.join(parms['work_dir'], 'checkpoint_r0.pkl')
+    gx = hf.retarded_weiss(g0t)
+    full = hf.solver_parms(parms)
+    assert hf.load_checkpoint(label, [gx, gx], full) is not None
+    for change in ({'sweeps': 800}, {'U': 2.}, {'BETA': 20.}, {'meas': 1},
+                   {'chains': 2}):
+        assert hf.load_checkpoint(label, [gx, gx],
+                                  dict(full, **change)) is None
+    assert hf.load_checkpoint(label, [1.1 * gx, gx], full) is None
+
+    resumed = hf.imp_solver([g0t, g0t], v.copy(), intm, parms)
+    assert np.allclose(resumed, reference)
+    assert not os.path.exists(label)
+
+    reseeded = hf.imp_solver([g0t, g0t], v.copy(), intm,
+                             dict(parms, SEED=parms['SEED'] + 1))
+    assert not np.allclose(reseeded, resumed)
+
+    # a restarted job draws a new seed, the checkpoint restores the
+    # random generator
+    unseeded = {key: val for key, val in parms.items() if key != 'SEED'}
+    del calls[:]
+    monkeypatch.setattr(hf.hffast, 'updateDHS_fields', preempted)
+    with pytest.raises(KeyboardInterrupt):
+        hf.imp_solver([g0t, g0t], v.copy(), intm, unseeded)
+    assert hf.load_checkpoint(label, [gx, gx],
+                              hf.solver_parms(unseeded)) is not None
+    del calls[:]
+    monkeypatch.setattr(hf.hffast, 'updateDHS_fields', update_counted)
+    hf.imp_solver([g0t, g0t], v.copy(), intm, unseeded)
+    assert len(calls) == (parms['sweeps'] + parms['therm'] - 50) * \
+        parms['meas']
+
+
+def test_solver_stats():
+    """The solver saves its timing and per site acceptance"""
+    parms = dict(SOLVER_PARAMS, U=2.3, MU=0., SITES=1, sweeps=300, therm=100,
+                 chi_interval=10, compiled_driver=False, clean_interval=50,
+                 work_dir='/tmp/testdmft_stats')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n)
+    hf.imp_solver([g0t, g0t], v, intm, parms)
+    stats = hf.SolverStats.load(os.path.join(parms['work_dir'], 'stats.npz'))
+    acc = np.load(os.path.join(parms['work_dir'], 'acceptance.npy'))
+    assert stats.calls['sweep'] == 400
+    assert 0 < stats.calls['measure'] <= 400
+    assert stats.calls['reduction'] == 1
+    assert stats.time['sweep'] > 0
+    assert stats.proposed == 400 * parms['meas']
+    assert stats.accepted.shape == v.shape
+    assert np.isclose(stats.acceptance().mean(), acc)
+    assert stats.acceptance_per_slice(len(tau)).shape == (len(tau),)
+    drift = np.load(os.path.join(parms['work_dir'], 'drift.npy'))
+    assert stats.cleanups == len(drift)
+    assert stats.max_drift == drift[:, 1].max()
+    assert stats.therm_sweeps + stats.measured == 400
+    assert stats.therm_sweeps >= parms['therm']
+
+
+def test_solver_compiled_driver():
+    """Running the sweeps between the measurement points in the compiled
+    driver samples the same Markov chain as the Python loop"""
+    parms = dict(SOLVER_PARAMS, U=2.3, MU=0., SITES=1, sweeps=300, therm=100,
+                 clean_interval=40, chi_interval=3,
+                 work_dir='/tmp/testdmft_driver')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n)
+    python = hf.imp_solver([g0t, g0t], v.copy(), intm,
+                           dict(parms, compiled_driver=False))
+    drift = np.load(os.path.join(parms['work_dir'], 'drift.npy'))
+    chi = np.load(os.path.join(parms['work_dir'], 'chi.npy'))
+    compiled = hf.imp_solver([g0t, g0t], v.copy(), intm, parms)
+    stats = hf.SolverStats.load(os.path.join(parms['work_dir'], 'stats.npz'))
+
+    assert np.allclose(compiled, python)
+    assert np.allclose(np.load(os.path.join(parms['work_dir'], 'drift.npy')),
+                       drift)
+    assert np.allclose(np.load(os.path.join(parms['work_dir'], 'chi.npy')),
+                       chi)
+    assert chi[0] > 0
+    # the driver stops only for the global flips every parms['therm'] sweeps
+    assert stats.calls['sweep'] == 0
+    assert stats.calls['driver'] == 400 // parms['therm']
+    assert stats.proposed == 400 * parms['meas']
+
+
+def test_thermalized():
+    """The drift test fails on a relaxing series and passes once stationary"""
+    rng = np.random.RandomState(3)
+    noise = rng.normal(size=(400, 2)) * 0.1
+    relaxing = list(np.exp(-np.arange(400) / 50.)[:, None] + noise)
+    assert not hf.thermalized(relaxing[:100], 50)
+    assert not hf.thermalized(relaxing[:100], 60)
+    assert hf.thermalized(list(noise), 100)
+
+
+def test_solver_thermalization_sweeps(monkeypatch):
+    """The drift test runs on the halves of the first parms['therm']
+    sweeps, a stationary chain thermalizes after that many sweeps"""
+    parms = dict(SOLVER_PARAMS, U=2.3, MU=0., SITES=1, sweeps=2000,
+                 therm=100, target_error=1e-2, error_analysis=True,
+                 work_dir='/tmp/testdmft_therm')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n)
+    checks = []
+
+    def stationary(series, window):
+        checks.append((len(series), window))
+        return True
+
+    monkeypatch.setattr(hf, 'thermalized', stationary)
+    hf.imp_solver([g0t, g0t], v, intm, parms)
+    stats = hf.SolverStats.load(os.path.join(parms['work_dir'], 'stats.npz'))
+    assert checks == [(100, 50)]
+    assert stats.therm_sweeps == parms['therm']
+
+
+def test_solver_target_error():
+    """Sampling stops once the double occupation reaches its error target"""
+    parms = dict(SOLVER_PARAMS, U=2.3, MU=0., SITES=1, sweeps=20000,
+                 therm=100, target_error=1e-3, target_observable='double_occ',
+                 error_analysis=True, save_logs=True,
+                 work_dir='/tmp/testdmft_target')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n)
+    errors = hf.imp_solver_results([g0t, g0t], v, intm, parms)['errors']
+    assert (errors['double_occ']['error'] <= 1e-3).all()
+    vlog = np.load(os.path.join(parms['work_dir'], 'v_ising.npy'))
+    assert 100 <= len(vlog) < 20000
+    stats = hf.SolverStats.load(os.path.join(parms['work_dir'], 'stats.npz'))
+    assert 100 <= stats.therm_sweeps < 20000
+    assert stats.measured > 0
+
+
+def test_measure_chi():
+    """Without interaction the spin correlator is the bubble
+    :math:`\\chi(\\tau) = G(\\tau)G(\\beta-\\tau)/2`"""
+    parms = dict(UPDATE_PARAMS, MU=0.3, U=0., SITES=1)
+    _, _, g0t, _, v, _ = hf.setup_PM_sim(parms)
+    g0ttp = hf.retarded_weiss(g0t)
+    ntau = len(g0t)
+    chi = np.zeros(ntau)
+    hf.measure_chi([g0ttp, g0ttp], chi, ntau)
+    g_beta_tau = np.concatenate(([-1 - g0t[0]], g0t[:0:-1]))
+    assert np.allclose(chi, .5 * g0t * g_beta_tau)
+
+    chi_c = np.zeros(ntau)
+    hf.measure_chi([g0ttp.astype(complex)] * 2, chi_c, ntau)
+    assert np.allclose(chi_c, chi)
+
+
+def test_susceptibility():
+    """A constant correlator only has a static component"""
+    chi_iw = hf.susceptibility(np.ones(64) * .25, 20.)
+    assert np.allclose(chi_iw, np.r_[5., np.zeros(32)])
+
+
+def test_dtau2_extrapolation():
+    """Exact data on a line in dtau^2 is extrapolated to its intercept"""
+    dtau = np.array([.5, .4, .25])
+    values = [np.array([1., 2.]) + 3 * dt**2 for dt in dtau]
+    errors = [np.array([.01, 0.])] * 3
+    value, error = hf.dtau2_extrapolation(dtau, values, errors)
+    assert np.allclose(value, [1., 2.])
+    assert error[0] > .01 and error[1] < 1e-50
+
+
+@pytest.mark.parametrize("threads", [True, False])
+def test_trotter_extrapolation(monkeypatch, threads):
+    """Solves on several Trotter grids and extrapolates, concurrently or
+    one grid after the other"""
+    monkeypatch.setattr(hf, 'threaded_collectives', lambda comm: threads)
+    parms = dict(SOLVER_PARAMS, U=2.3, MU=0., SITES=1, sweeps=400, therm=100,
+                 work_dir='/tmp/testdmft_trotter')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n)
+    res = hf.trotter_extrapolation([g0t, g0t], tau, intm, parms, [32, 48])
+    assert np.allclose(res['dtau'], parms['BETA'] / np.array([32, 48]))
+    assert res['gtau']['value'].shape == (2, 1, 1, len(tau))
+    assert (res['gtau']['error'] > 0).all()
+    assert (res['double_occ']['error'] > 0).all()
+    assert (res['gtau']['value'] < 0).all()
+    assert len(res['grids']) == 2
+    assert os.path.exists(os.path.join(parms['work_dir'], 'L48',
+                                       'double_occ.npy'))
+    saved = np.load(os.path.join(parms['work_dir'], 'trotter.npz'))
+    assert np.allclose(saved['double_occ_value'], res['double_occ']['value'])
+
+
+def test_replica_log_weight():
+    """The weight ratio of two Ising configurations is the determinant ratio
+    of the fast update"""
+    parms = dict(UPDATE_PARAMS, MU=0., U=2.5, SITES=1)
+    _, _, g0t, _, v, intm = hf.setup_PM_sim(parms)
+    gx = hf.retarded_weiss(g0t)
+    kroneker = np.eye(v.size)
+    g = hf.gnewclean(gx, np.squeeze(v), kroneker)
+    flipped = v.copy()
+    flipped[0, 3] *= -1
+    ratio = 1 + (1 - g[3, 3]) * (np.exp(-2 * v[0, 3]) - 1)
+    g_dw = hf.gnewclean(gx, -np.squeeze(v), kroneker)
+    ratio *= 1 + (1 - g_dw[3, 3]) * (np.exp(2 * v[0, 3]) - 1)
+    log_ratio = hf.replica_log_weight([gx, gx], flipped, intm) - \
+        hf.replica_log_weight([gx, gx], v, intm)
+    assert np.allclose(log_ratio, np.log(abs(ratio)))
+
+
+def test_replica_exchange():
+    """Replicas of the same problem always swap"""
+    parms = dict(SOLVER_PARAMS, U=2.3, MU=0., SITES=1, sweeps=300, therm=100,
+                 swap_interval=20, work_dir='/tmp/testdmft_tempering')
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n)
+    out = hf.replica_exchange([[g0t, g0t]] * 3, intm, parms,
+                              [{'U': 2.3}, {'U': 2.3}, {'U': 2.7}])
+    assert len(out) == 3
+    assert out[0][0].shape == (1, 1, len(tau))
+    acceptance = np.load(os.path.join(parms['work_dir'],
+                                      'swap_acceptance.npy'))
+    assert acceptance[0] == 1.
+    assert 0 < acceptance[1] < 1
+    assert os.path.exists(os.path.join(parms['work_dir'], 'replica2',
+                                       'double_occ.npy'))
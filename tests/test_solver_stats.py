@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the run statistics of the Monte Carlo solvers
+"""
+
+from __future__ import division, absolute_import, print_function
+import numpy as np
+from dmft.solver_stats import SolverStats
+
+
+def test_stats_merge_and_save(tmpdir):
+    """Counters of several chains add up and survive a round trip to disk"""
+    chains = [SolverStats(2, 8) for _ in range(3)]
+    for i, stats in enumerate(chains):
+        with stats.timer('sweep'):
+            stats.accepted[:, ::2] += i + 1
+        stats.proposed += 4
+        stats.nsign += i
+        stats.cleanups += 2
+        stats.max_drift = 1e-6 * (i + 1)
+        stats.therm_sweeps += 10
+
+    total = SolverStats()
+    for stats in chains:
+        total.merge(stats)
+    assert total.calls['sweep'] == 3
+    assert total.calls['clean'] == 0
+    assert total.proposed == 12 and total.nsign == 3
+    assert total.cleanups == 6 and total.max_drift == 3e-6
+    assert total.therm_sweeps == 30
+    assert np.allclose(total.acceptance_per_field(), [.25, .25])
+    assert np.allclose(total.acceptance_per_slice(4), [.5, 0, .5, 0])
+    assert 'sweep' in total.summary()
+
+    fname = str(tmpdir.join('stats.npz'))
+    total.save(fname)
+    loaded = SolverStats.load(fname)
+    assert loaded.time == total.time
+    assert loaded.calls == total.calls
+    assert np.array_equal(loaded.accepted, total.accepted)
+    assert loaded.proposed == total.proposed
+    assert loaded.cleanups == total.cleanups
+    assert loaded.max_drift == total.max_drift
+    assert loaded.therm_sweeps == total.therm_sweeps